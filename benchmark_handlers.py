@@ -0,0 +1,327 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Benchmark dos handlers do bot com usuários sintéticos.
+#
+# Gera usuários com 1k/10k/100k/1M transações, executa os handlers reais com objetos
+# Update/CallbackQuery/Bot falsos (que apenas registram as chamadas de saída) e mede
+# latência (p50/p90/p99), pico de memória e bytes gravados/enviados por handler.
+#
+# Uso:
+#   python benchmark_handlers.py
+#   python benchmark_handlers.py --tamanhos 1000 10000 100000 1000000 --repeticoes 10 --saida resultados.json
+
+import os
+import sys
+import json
+import time
+import random
+import asyncio
+import argparse
+import itertools
+import datetime
+import platform
+import tempfile
+import subprocess
+import tracemalloc
+from io import BytesIO
+from types import SimpleNamespace
+
+import telegram_bot as bot
+
+TAMANHOS_PADRAO = [1000, 10000, 100000]
+REPETICOES_PADRAO = 5
+DIAS_HISTORICO = 365
+
+# Objeto falso que registra todas as chamadas de método assíncronas (answer, edit_message_text, send_photo...)
+class Gravador:
+    def __init__(self, chamadas):
+        self._chamadas = chamadas
+
+    def __getattr__(self, nome):
+        async def chamada(*args, **kwargs):
+            self._chamadas.append((nome, args, kwargs))
+            return SimpleNamespace(message_id=len(self._chamadas))
+        return chamada
+
+class MensagemFalsa(Gravador):
+    def __init__(self, chamadas, texto=None, chat_id=None):
+        super().__init__(chamadas)
+        self.text = texto
+        self.chat_id = chat_id
+
+class CallbackQueryFalsa(Gravador):
+    def __init__(self, chamadas, data, chat_id):
+        super().__init__(chamadas)
+        self.data = data
+        self.message = MensagemFalsa(chamadas, chat_id=chat_id)
+
+class UpdateFalso:
+    def __init__(self, user_id, chamadas, data=None, texto=None):
+        self.effective_user = SimpleNamespace(id=user_id, first_name="Benchmark")
+        self.effective_chat = SimpleNamespace(id=user_id)
+        self.callback_query = CallbackQueryFalsa(chamadas, data, user_id) if data is not None else None
+        self.message = MensagemFalsa(chamadas, texto, user_id) if texto is not None else None
+
+class ContextoFalso:
+    def __init__(self, chamadas, user_data=None):
+        self.user_data = user_data if user_data is not None else {}
+        self.bot_data = {}
+        self.chat_data = {}
+        self.bot = Gravador(chamadas)
+
+# Função para gerar um usuário sintético com n transações distribuídas no último ano
+def gerar_usuario_sintetico(user_id, n_transacoes, semente=42):
+    aleatorio = random.Random(semente)
+    dados = bot.criar_dados_iniciais()
+
+    fim = datetime.datetime.now().replace(microsecond=0)
+    inicio = fim - datetime.timedelta(days=DIAS_HISTORICO)
+    intervalo = (fim - inicio).total_seconds()
+    instantes = sorted(aleatorio.random() * intervalo for _ in range(n_transacoes))
+
+    for i, segundos in enumerate(instantes):
+        tipo = 'entrada' if aleatorio.random() < 0.3 else 'saida'
+        categorias = dados['categorias_entrada'] if tipo == 'entrada' else dados['categorias_saida']
+        bot.registrar_transacao(dados, {
+            'tipo': tipo,
+            'categoria_id': aleatorio.choice(categorias),
+            'valor': round(aleatorio.uniform(5, 2000 if tipo == 'entrada' else 500), 2),
+            'descricao': f"Transação sintética {i}",
+            'data': (inicio + datetime.timedelta(seconds=segundos)).strftime("%d/%m/%Y %H:%M:%S"),
+            'id': f"sintetica-{i}"
+        })
+
+    bot.salvar_dados_usuario(user_id, dados)
+    return dados
+
+# Função para medir os bytes enviados ao Telegram a partir das chamadas registradas
+def bytes_enviados(chamadas):
+    total = 0
+    for nome, args, kwargs in chamadas:
+        arquivos = []
+        if nome == 'send_photo':
+            arquivos.append(kwargs.get('photo'))
+        elif nome == 'send_document':
+            arquivos.append(kwargs.get('document'))
+        elif nome == 'send_media_group':
+            arquivos.extend(item.media for item in kwargs.get('media', []))
+
+        for arquivo in arquivos:
+            if isinstance(arquivo, BytesIO):
+                total += arquivo.getbuffer().nbytes
+            elif hasattr(arquivo, 'input_file_content'):
+                total += len(arquivo.input_file_content)
+
+        textos = [a for a in args if isinstance(a, str)]
+        textos += [kwargs[chave] for chave in ('text', 'caption') if isinstance(kwargs.get(chave), str)]
+        total += sum(len(texto.encode('utf-8')) for texto in textos)
+    return total
+
+# Contador dos bytes gravados em disco pelo salvar_dados_usuario
+class ContadorGravacao:
+    def __init__(self):
+        self.bytes = 0
+        self._original = bot.salvar_dados_usuario
+
+    def __enter__(self):
+        def salvar_contando(user_id, dados):
+            self._original(user_id, dados)
+            self.bytes += os.path.getsize(f"{bot.DATA_DIR}/dados_{user_id}.json")
+        bot.salvar_dados_usuario = salvar_contando
+        return self
+
+    def __exit__(self, *exc):
+        bot.salvar_dados_usuario = self._original
+
+# Cenários: cada um devolve (preparar, executar). preparar roda fora da medição.
+def cenario_gerar_relatorio(user_id):
+    async def preparar(chamadas):
+        return UpdateFalso(user_id, chamadas, data='relatorio_personalizado'), ContextoFalso(chamadas)
+
+    async def executar(update, context):
+        fim = datetime.datetime.now()
+        inicio = fim - datetime.timedelta(days=30)
+        await bot.gerar_relatorio(update, context, inicio, fim, "Relatório dos últimos 30 dias")
+
+    return preparar, executar
+
+def cenario_confirmar_transacao(user_id):
+    async def preparar(chamadas):
+        dados = bot.carregar_dados_usuario(user_id)
+        categoria_id = dados['categorias_saida'][0]
+        context = ContextoFalso(chamadas, {
+            'dados': dados,
+            'transacao_temp': {
+                'tipo': 'saida',
+                'categoria_id': categoria_id,
+                'categoria': bot.nome_categoria(dados, categoria_id),
+                'valor': 42.5,
+                'descricao': "Benchmark"
+            }
+        })
+        return UpdateFalso(user_id, chamadas, data='confirmar_transacao'), context
+
+    return preparar, bot.confirmar_transacao
+
+def cenario_mostrar_historico(user_id):
+    async def preparar(chamadas):
+        return UpdateFalso(user_id, chamadas, data='historico'), ContextoFalso(chamadas)
+
+    return preparar, bot.mostrar_historico
+
+def cenario_grafico_relatorio(user_id):
+    async def preparar(chamadas):
+        context = ContextoFalso([])
+        await cenario_gerar_relatorio(user_id)[1](UpdateFalso(user_id, [], data='relatorio_personalizado'), context)
+        context.bot = Gravador(chamadas)
+        return UpdateFalso(user_id, chamadas, data='grafico_relatorio'), context
+
+    return preparar, bot.grafico_relatorio
+
+def cenario_exportar_todos_dados(user_id):
+    async def preparar(chamadas):
+        return UpdateFalso(user_id, chamadas, data='exportar_dados'), ContextoFalso(chamadas)
+
+    return preparar, bot.exportar_todos_dados
+
+def cenario_processar_edicao_categoria(user_id):
+    contador = itertools.count()
+
+    async def preparar(chamadas):
+        dados = bot.carregar_dados_usuario(user_id)
+        categoria_id = dados['categorias_saida'][0]
+        context = ContextoFalso(chamadas, {
+            'edit_categoria': {
+                'tipo': 'saida',
+                'categoria_id': categoria_id,
+                'categoria_antiga': bot.nome_categoria(dados, categoria_id)
+            }
+        })
+        return UpdateFalso(user_id, chamadas, texto=f"Categoria {next(contador)}"), context
+
+    return preparar, bot.processar_edicao_categoria
+
+CENARIOS = {
+    'gerar_relatorio': cenario_gerar_relatorio,
+    'confirmar_transacao': cenario_confirmar_transacao,
+    'mostrar_historico': cenario_mostrar_historico,
+    'grafico_relatorio': cenario_grafico_relatorio,
+    'exportar_todos_dados': cenario_exportar_todos_dados,
+    'processar_edicao_categoria': cenario_processar_edicao_categoria
+}
+
+# Função para calcular um percentil (interpolação linear) de uma lista de valores
+def percentil(valores, p):
+    ordenados = sorted(valores)
+    posicao = (len(ordenados) - 1) * p / 100
+    inferior = int(posicao)
+    superior = min(inferior + 1, len(ordenados) - 1)
+    return ordenados[inferior] + (ordenados[superior] - ordenados[inferior]) * (posicao - inferior)
+
+# Função para medir um handler: latência nas repetições e memória em uma execução extra com tracemalloc
+async def medir_handler(nome, user_id, repeticoes):
+    preparar, executar = CENARIOS[nome](user_id)
+    latencias = []
+    bytes_disco = []
+    bytes_rede = []
+
+    for _ in range(repeticoes):
+        chamadas = []
+        update, context = await preparar(chamadas)
+        with ContadorGravacao() as contador:
+            inicio = time.perf_counter()
+            await executar(update, context)
+            latencias.append((time.perf_counter() - inicio) * 1000)
+        bytes_disco.append(contador.bytes)
+        bytes_rede.append(bytes_enviados(chamadas))
+
+    # O tracemalloc deixa a execução mais lenta, então a memória é medida separadamente
+    chamadas = []
+    update, context = await preparar(chamadas)
+    tracemalloc.start()
+    await executar(update, context)
+    _, pico = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    return {
+        'repeticoes': repeticoes,
+        'latencia_ms': {
+            'min': min(latencias),
+            'p50': percentil(latencias, 50),
+            'p90': percentil(latencias, 90),
+            'p99': percentil(latencias, 99),
+            'max': max(latencias),
+            'media': sum(latencias) / len(latencias)
+        },
+        'pico_memoria_bytes': pico,
+        'bytes_gravados': max(bytes_disco),
+        'bytes_enviados': max(bytes_rede),
+        'chamadas_api': len(chamadas)
+    }
+
+# Função para obter o commit atual (para comparar resultados entre versões)
+def versao_codigo():
+    try:
+        return subprocess.run(
+            ['git', 'rev-parse', '--short', 'HEAD'],
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+            capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+async def executar_benchmark(tamanhos, handlers, repeticoes):
+    resultados = []
+    for user_id, tamanho in enumerate(tamanhos, start=1):
+        print(f"Gerando usuário sintético com {tamanho} transações...", file=sys.stderr)
+        inicio = time.perf_counter()
+        gerar_usuario_sintetico(user_id, tamanho)
+        print(f"  gerado em {time.perf_counter() - inicio:.1f}s", file=sys.stderr)
+
+        for nome in handlers:
+            medicao = await medir_handler(nome, user_id, repeticoes)
+            medicao.update({'handler': nome, 'transacoes': tamanho})
+            resultados.append(medicao)
+            print(
+                f"  {nome:<28} p50={medicao['latencia_ms']['p50']:9.1f}ms "
+                f"p99={medicao['latencia_ms']['p99']:9.1f}ms "
+                f"mem={medicao['pico_memoria_bytes'] / 1024 / 1024:8.1f}MB "
+                f"disco={medicao['bytes_gravados'] / 1024:9.1f}KB "
+                f"rede={medicao['bytes_enviados'] / 1024:9.1f}KB",
+                file=sys.stderr
+            )
+    return resultados
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark dos handlers do bot financeiro")
+    parser.add_argument('--tamanhos', type=int, nargs='+', default=TAMANHOS_PADRAO,
+                        help="Quantidades de transações dos usuários sintéticos")
+    parser.add_argument('--handlers', nargs='+', choices=list(CENARIOS), default=list(CENARIOS),
+                        help="Handlers a medir")
+    parser.add_argument('--repeticoes', type=int, default=REPETICOES_PADRAO,
+                        help="Execuções medidas por handler")
+    parser.add_argument('--saida', default="benchmark_resultados.json",
+                        help="Arquivo JSON com os resultados")
+    args = parser.parse_args()
+
+    # Os dados sintéticos ficam em um diretório temporário, longe dos dados reais
+    with tempfile.TemporaryDirectory(prefix="benchmark_bot_") as diretorio:
+        bot.DATA_DIR = diretorio
+        bot.logger.setLevel('WARNING')
+        resultados = asyncio.run(executar_benchmark(args.tamanhos, args.handlers, args.repeticoes))
+
+    relatorio = {
+        'versao': versao_codigo(),
+        'data': datetime.datetime.now().isoformat(timespec='seconds'),
+        'python': platform.python_version(),
+        'plataforma': platform.platform(),
+        'resultados': resultados
+    }
+    with open(args.saida, 'w', encoding='utf-8') as f:
+        json.dump(relatorio, f, ensure_ascii=False, indent=2)
+
+    print(f"Resultados salvos em {args.saida}", file=sys.stderr)
+
+if __name__ == '__main__':
+    main()
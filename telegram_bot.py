@@ -5,17 +5,52 @@ import os
 import logging
 import json
 import datetime
-from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup, ReplyKeyboardMarkup, ReplyKeyboardRemove
-from telegram.ext import Application, CommandHandler, MessageHandler, CallbackQueryHandler, ConversationHandler, ContextTypes, filters
-from io import BytesIO
+from telegram import Bot, Update, InlineKeyboardButton, InlineKeyboardMarkup, ReplyKeyboardMarkup, ReplyKeyboardRemove, InputMediaPhoto, InputMediaDocument
+from telegram.helpers import escape_markdown
+from telegram.error import NetworkError, TimedOut, Forbidden, TelegramError, BadRequest, InvalidToken
+from telegram.ext import Application, CommandHandler, MessageHandler, CallbackQueryHandler, ConversationHandler, ContextTypes, filters, AIORateLimiter, BasePersistence, PersistenceInput
+from aiolimiter import AsyncLimiter
+from io import BytesIO, StringIO
 import pandas as pd
 import uuid
 import calendar
+import asyncio
+import random
+import time
+import cProfile
+import pstats
+import tracemalloc
+import csv
+import copy
+import pickle
+import hashlib
+import sqlite3
+import zlib
+import signal
+import multiprocessing
+import io
+import re
+try:
+    from re import _parser as analisador_regex  # Python 3.11+
+except ImportError:
+    import sre_parse as analisador_regex
+import unicodedata
+import difflib
+import bisect
+import heapq
+import itertools
 import locale
 import matplotlib.pyplot as plt
 import matplotlib
 import numpy as np
+from PIL import Image
 from decimal import Decimal
+from http import HTTPStatus
+from collections import OrderedDict, deque, Counter as Multiconjunto
+from functools import lru_cache, wraps
+from types import coroutine
+from prometheus_client import Counter, Gauge, Histogram, REGISTRY, start_http_server
+from prometheus_client.core import CounterMetricFamily
 
 # Configuração para gráficos bonitos
 matplotlib.use('Agg')
@@ -41,6 +76,10 @@ EMOJI = {
     "remover": "➖",
     "editar": "✏️",
     "exportar": "📤",
+    "importar": "📥",
+    "regra": "🏷️",
+    "aprender": "🧠",
+    "desfazer": "↩️",
     "historico": "📋",
     "fechamento": "🔒",
     "dinheiro": "💵",
@@ -52,7 +91,10 @@ EMOJI = {
     "sucesso": "✅",
     "carteira": "👛",
     "lupa": "🔍",
-    "hora": "⏰"
+    "hora": "⏰",
+    "recorrente": "🔁",
+    "orcamento": "🎯",
+    "previsao": "🔮"
 }
 
 # Configurando o locale para português brasileiro
@@ -71,6 +113,33 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
+# Métricas expostas no formato do Prometheus (ver iniciar_servidor_metricas)
+PORTA_METRICAS_PADRAO = 8000
+
+LATENCIA_HANDLER = Histogram(
+    'bot_handler_latencia_segundos', 'Tempo de execução de cada handler', ['handler'],
+    buckets=(0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+)
+ERROS_HANDLER = Counter('bot_handler_erros_total', 'Exceções não tratadas nos handlers', ['handler'])
+LATENCIA_ARMAZENAMENTO = Histogram(
+    'bot_armazenamento_latencia_segundos', 'Tempo para carregar/salvar os dados de um usuário', ['operacao'],
+    buckets=(0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5)
+)
+BYTES_ARMAZENAMENTO = Counter('bot_armazenamento_bytes_total', 'Bytes lidos/gravados nos arquivos de dados', ['operacao'])
+LATENCIA_GRAFICO = Histogram(
+    'bot_grafico_render_segundos', 'Tempo para renderizar cada gráfico', ['grafico'],
+    buckets=(0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+)
+BYTES_GRAFICO = Histogram(
+    'bot_grafico_bytes', 'Tamanho de cada gráfico após a codificação', ['grafico'],
+    buckets=(25_000, 50_000, 100_000, 150_000, 250_000, 500_000, 1_000_000)
+)
+CHAMADAS_API = Counter('bot_api_chamadas_total', 'Chamadas feitas à Bot API', ['endpoint'])
+ERROS_API = Counter('bot_api_erros_total', 'Chamadas à Bot API que falharam', ['endpoint', 'erro'])
+CONVERSAS_ATIVAS = Gauge('bot_conversas_ativas', 'Conversas em andamento no ConversationHandler')
+ATUALIZACOES_DESPACHADAS = Counter('bot_atualizacoes_despachadas_total', 'Atualizações repassadas pelo despachante', ['worker'])
+REINICIOS_WORKERS = Counter('bot_workers_reiniciados_total', 'Workers reiniciados pelo despachante', ['worker'])
+
 # Estados para o ConversationHandler
 (
     MENU_PRINCIPAL,
@@ -89,19 +158,289 @@ logger = logging.getLogger(__name__)
     EDITAR_CATEGORIA,
     DEFINIR_META,
     AJUSTAR_SALDO,
-    CONFIRMAR_APAGAR_DADOS
-) = range(17)
+    CONFIRMAR_APAGAR_DADOS,
+    IMPORTAR_EXTRATO,
+    CONFIRMAR_IMPORTACAO,
+    REGRAS_CATEGORIZACAO,
+    ADICIONAR_REGRA,
+    ORCAMENTOS
+) = range(22)
 
 # Diretório para armazenar os dados do bot
 DATA_DIR = "bot_data"
 os.makedirs(DATA_DIR, exist_ok=True)
 
+# Horário padrão do lembrete diário
+HORARIO_LEMBRETE_PADRAO = "20:00"
+
+# Categorias padrão para novos usuários
+CATEGORIAS_PADRAO = {
+    "entrada": ["Venda", "Investimento", "Salário", "Outro"],
+    "saida": ["Mercadoria", "Pagamento", "Compra", "Alimentação", "Transporte", "Outro"]
+}
+
+# Função para criar a estrutura inicial dos dados de um usuário
+def criar_dados_iniciais():
+    dados = {
+        "transacoes": [],
+        "categorias": {},
+        "categorias_entrada": [],
+        "categorias_saida": [],
+        "proximo_id_categoria": 1,
+        "saldo_atual": 0,
+        "data_ultimo_fechamento": None,
+        "metas": {
+            "economia_mensal": 0,
+            "limite_gastos": 0,
+        },
+        "notificacoes": {
+            "alerta_limite": True,
+            "lembrete_diario": False,
+            "horario_lembrete": HORARIO_LEMBRETE_PADRAO,
+            "fechamento_automatico": False,
+            "resumo_fechamento": True,
+            "alerta_meta_economia": True
+        },
+        "totais_diarios": {},
+        "totais_mensais": {},
+        "regras_categorizacao": [],
+        "proximo_id_regra": 1,
+        "recorrentes": [],
+        "proximo_id_recorrente": 1,
+        "orcamentos": {}
+    }
+    for tipo, nomes in CATEGORIAS_PADRAO.items():
+        for nome in nomes:
+            criar_categoria(dados, nome, tipo)
+    return dados
+
+# Livro binário de transações para usuários com histórico muito grande: em vez da lista no JSON, as transações
+# ficam em registros de largura fixa (livro_{id}.bin, aberto com mmap) e a descrição e os campos raros de cada
+# uma ficam em um arquivo à parte (livro_{id}.txt), no deslocamento gravado no registro.
+LIMITE_TRANSACOES_JSON = int(os.environ.get("LIMITE_TRANSACOES_JSON", 50_000))  # 0 mantém tudo no JSON
+DTYPE_LIVRO = np.dtype([
+    ('timestamp', '<i8'),  # segundos desde 01/01/1970, na hora local (como as datas do JSON)
+    ('centavos', '<i8'),
+    ('tipo', 'u1'),  # índice em TIPOS_LIVRO
+    ('categoria', '<u4'),
+    ('id', 'S36'),
+    ('descricao', '<u8'),  # deslocamento do JSON com a descrição e os campos extras
+    ('tamanho_descricao', '<u4'),
+])
+TIPOS_LIVRO = ('entrada', 'saida')
+EPOCA_LIVRO = datetime.datetime(1970, 1, 1)
+
+# Função para mapear um arquivo de registros na memória (vazio se o arquivo não existir)
+def mapear_arquivo(arquivo, dtype, tamanho=None):
+    try:
+        quantidade = os.path.getsize(arquivo) // dtype.itemsize
+    except FileNotFoundError:
+        quantidade = 0
+    if tamanho is not None:
+        quantidade = min(quantidade, tamanho)
+    if quantidade == 0:
+        return np.empty(0, dtype=dtype)
+    return np.memmap(arquivo, dtype=dtype, mode='r', shape=(quantidade,))
+
+# Erro ao gravar um livro que outra instância alterou depois de ele ser aberto (as transações dela se perderiam)
+class ConflitoLivroTransacoes(Exception):
+    pass
+
+# Sequência de transações de um usuário guardada no livro binário. Funciona como a lista de transações
+# (iteração, índices, fatias, extend, pop), montando os dicionários só quando são lidos; as análises usam
+# as colunas do NumPy. As alterações ficam em memória até gravar(), chamada por salvar_dados_usuario.
+class LivroTransacoes:
+    def __init__(self, user_id, tamanho):
+        self.arquivo = f"{DATA_DIR}/livro_{user_id}.bin"
+        self.arquivo_descricoes = f"{DATA_DIR}/livro_{user_id}.txt"
+        self._cauda = []  # transações depois dos registros gravados (novas ou deslocadas por um pop)
+        self._alterado = False
+        self._abrir(tamanho)
+    
+    # Função para criar o livro de um usuário a partir da lista de transações do JSON
+    @classmethod
+    def criar(cls, user_id, transacoes):
+        remover_livro_transacoes(user_id)
+        livro = cls(user_id, 0)
+        livro.extend(transacoes)
+        return livro
+    
+    def _abrir(self, tamanho):
+        # Registros além de "tamanho" vêm de uma gravação interrompida antes do JSON e são ignorados
+        self.registros = mapear_arquivo(self.arquivo, DTYPE_LIVRO, tamanho)
+        self._descricoes = mapear_arquivo(self.arquivo_descricoes, np.dtype(np.uint8))
+        self._tamanho_arquivo = os.path.getsize(self.arquivo) if os.path.exists(self.arquivo) else 0
+    
+    def __len__(self):
+        return len(self.registros) + len(self._cauda)
+    
+    def __iter__(self):
+        for indice in range(len(self.registros)):
+            yield self._transacao(indice)
+        yield from self._cauda
+    
+    def __getitem__(self, indice):
+        if isinstance(indice, slice):
+            return [self[i] for i in range(*indice.indices(len(self)))]
+        if indice < 0:
+            indice += len(self)
+        if not 0 <= indice < len(self):
+            raise IndexError(indice)
+        if indice >= len(self.registros):
+            return self._cauda[indice - len(self.registros)]
+        return self._transacao(indice)
+    
+    # Função para montar o dicionário de uma transação gravada
+    def _transacao(self, indice):
+        registro = self.registros[indice]
+        transacao = {
+            'tipo': TIPOS_LIVRO[registro['tipo']],
+            'categoria_id': str(registro['categoria']),
+            'valor': int(registro['centavos']) / 100,
+            'data': (EPOCA_LIVRO + datetime.timedelta(seconds=int(registro['timestamp']))).strftime("%d/%m/%Y %H:%M:%S")
+        }
+        if registro['id']:
+            transacao['id'] = registro['id'].decode('ascii')
+        inicio = int(registro['descricao'])
+        if registro['tamanho_descricao']:
+            transacao.update(json.loads(self._descricoes[inicio:inicio + int(registro['tamanho_descricao'])].tobytes()))
+        return transacao
+    
+    def append(self, transacao):
+        self.extend([transacao])
+    
+    def extend(self, transacoes):
+        self._cauda.extend(transacoes)
+        self._alterado = True
+    
+    def pop(self, indice=-1):
+        if indice < 0:
+            indice += len(self)
+        gravados = len(self.registros)
+        self._alterado = True
+        if indice >= gravados:
+            return self._cauda.pop(indice - gravados)
+        # Os registros seguintes passam para a cauda e são regravados (normalmente são poucos: desfazer é recente)
+        transacao = self._transacao(indice)
+        self._cauda[:0] = [self._transacao(i) for i in range(indice + 1, gravados)]
+        self.registros = self.registros[:indice]
+        return transacao
+    
+    # Função para gravar as alterações nos arquivos do livro; retorna a quantidade de registros
+    def gravar(self):
+        if not self._alterado:
+            return len(self)
+        
+        # Outra instância gravou depois desta abrir o livro: truncar apagaria os registros dela
+        tamanho_arquivo = os.path.getsize(self.arquivo) if os.path.exists(self.arquivo) else 0
+        if tamanho_arquivo != self._tamanho_arquivo:
+            raise ConflitoLivroTransacoes(f"{self.arquivo} foi alterado por outra gravação")
+        
+        gravados = len(self.registros)
+        novos = np.zeros(len(self._cauda), dtype=DTYPE_LIVRO)
+        textos = bytearray()
+        for registro, transacao in zip(novos, self._cauda):
+            extras = {chave: valor for chave, valor in transacao.items() if chave not in ('tipo', 'valor', 'categoria_id', 'data', 'id')}
+            registro['tipo'] = TIPOS_LIVRO.index(transacao['tipo'])
+            registro['centavos'] = round(transacao['valor'] * 100)
+            try:
+                registro['timestamp'] = int((datetime.datetime.strptime(transacao['data'], "%d/%m/%Y %H:%M:%S") - EPOCA_LIVRO).total_seconds())
+            except (ValueError, TypeError):
+                extras['data'] = transacao['data']
+            try:
+                registro['categoria'] = int(transacao['categoria_id'])
+            except (ValueError, TypeError):
+                extras['categoria_id'] = transacao['categoria_id']
+            id_transacao = transacao.get('id')
+            if isinstance(id_transacao, str) and id_transacao.isascii() and len(id_transacao) <= 36:
+                registro['id'] = id_transacao.encode('ascii')
+            elif id_transacao is not None:
+                extras['id'] = id_transacao
+            if extras:
+                texto = json.dumps(extras, ensure_ascii=False, default=str).encode('utf-8')
+                registro['descricao'] = len(textos)  # relativo; somado ao fim do arquivo na gravação
+                registro['tamanho_descricao'] = len(texto)
+                textos += texto
+        
+        # Os mapeamentos são liberados antes de alterar os arquivos (necessário no Windows)
+        self.registros = self._descricoes = None
+        # O deslocamento vem do fim real do arquivo de descrições, não do tamanho mapeado ao abrir
+        with open(self.arquivo_descricoes, 'ab') as f:
+            deslocamento = f.tell()
+            f.write(textos)
+        novos['descricao'][novos['tamanho_descricao'] > 0] += deslocamento
+        with open(self.arquivo, 'r+b' if os.path.exists(self.arquivo) else 'wb') as f:
+            f.truncate(gravados * DTYPE_LIVRO.itemsize)
+            f.seek(gravados * DTYPE_LIVRO.itemsize)
+            f.write(novos.tobytes())
+        
+        self._cauda = []
+        self._alterado = False
+        self._abrir(gravados + len(novos))
+        return len(self)
+    
+    # Função para obter as transações de um período filtrando pela coluna de datas
+    def no_periodo(self, data_inicio, data_fim):
+        inicio = (data_inicio - EPOCA_LIVRO).total_seconds()
+        fim = (data_fim - EPOCA_LIVRO).total_seconds()
+        timestamps = self.registros['timestamp']
+        indices = np.flatnonzero((timestamps >= inicio) & (timestamps <= fim))
+        transacoes = [self._transacao(indice) for indice in indices]
+        return transacoes + filtrar_transacoes_periodo(self._cauda, data_inicio, data_fim)
+    
+    # Função para montar um DataFrame a partir das colunas (as descrições só são lidas se pedidas)
+    def dataframe(self, com_descricao=False):
+        registros = self.registros
+        # Poucas categorias distintas: converte só os IDs únicos para texto
+        categorias, posicoes = np.unique(registros['categoria'], return_inverse=True)
+        df = pd.DataFrame({
+            'tipo': np.array(TIPOS_LIVRO, dtype=object)[registros['tipo']],
+            'categoria_id': categorias.astype(str).astype(object)[posicoes],
+            'valor': registros['centavos'] / 100,
+            'data': registros['timestamp'].astype('datetime64[s]')
+        })
+        if com_descricao:
+            transacoes = [self._transacao(indice) for indice in range(len(registros))]
+            df['descricao'] = [transacao.get('descricao', '') for transacao in transacoes]
+            df['id'] = [transacao.get('id') for transacao in transacoes]
+        if self._cauda:
+            cauda = pd.DataFrame(self._cauda)
+            cauda['data'] = pd.to_datetime(cauda['data'], format="%d/%m/%Y %H:%M:%S", errors='coerce')
+            df = pd.concat([df, cauda[[coluna for coluna in df.columns if coluna in cauda.columns]]], ignore_index=True)
+        return df
+
+# Função para apagar os arquivos do livro binário de um usuário
+def remover_livro_transacoes(user_id):
+    for arquivo in (f"{DATA_DIR}/livro_{user_id}.bin", f"{DATA_DIR}/livro_{user_id}.txt"):
+        if os.path.exists(arquivo):
+            os.remove(arquivo)
+
+# Função para filtrar as transações de um período (no livro binário, sem montar as transações fora do período)
+def filtrar_transacoes_periodo(transacoes, data_inicio, data_fim):
+    if isinstance(transacoes, LivroTransacoes):
+        return transacoes.no_periodo(data_inicio, data_fim)
+    filtradas = []
+    for t in transacoes:
+        try:
+            data_transacao = datetime.datetime.strptime(t['data'], "%d/%m/%Y %H:%M:%S")
+        except Exception:
+            # Ignorar transações com formato de data inválido
+            continue
+        if data_inicio <= data_transacao <= data_fim:
+            filtradas.append(t)
+    return filtradas
+
 # Função para carregar os dados de um usuário
 def carregar_dados_usuario(user_id):
     arquivo = f"{DATA_DIR}/dados_{user_id}.json"
     try:
-        with open(arquivo, 'r', encoding='utf-8') as f:
+        with LATENCIA_ARMAZENAMENTO.labels('carregar').time(), open(arquivo, 'r', encoding='utf-8') as f:
             dados = json.load(f)
+            BYTES_ARMAZENAMENTO.labels('carregar').inc(f.tell())
+            
+            # Usuários grandes têm as transações no livro binário
+            if 'tamanho_livro' in dados:
+                dados['transacoes'] = LivroTransacoes(user_id, dados.pop('tamanho_livro'))
             
             # Garantir que todas as chaves necessárias existam (para compatibilidade com versões anteriores)
             if "metas" not in dados:
@@ -115,31 +454,305 @@ def carregar_dados_usuario(user_id):
                     "alerta_limite": True,
                     "lembrete_diario": False
                 }
+            dados["notificacoes"].setdefault("horario_lembrete", HORARIO_LEMBRETE_PADRAO)
+            dados["notificacoes"].setdefault("fechamento_automatico", False)
+            dados["notificacoes"].setdefault("resumo_fechamento", True)
+            dados["notificacoes"].setdefault("alerta_meta_economia", True)
+            
+            if "categorias" not in dados:
+                migrar_categorias(dados)
+            
+            if "totais_diarios" not in dados:
+                calcular_totais_diarios(dados)
+            
+            if "totais_mensais" not in dados:
+                calcular_totais_mensais(dados)
+            
+            dados.setdefault("regras_categorizacao", [])
+            dados.setdefault("proximo_id_regra", 1)
+            dados.setdefault("recorrentes", [])
+            dados.setdefault("proximo_id_recorrente", 1)
+            dados.setdefault("orcamentos", {})
                 
             return dados
     except (FileNotFoundError, json.JSONDecodeError):
         # Estrutura inicial dos dados
-        return {
-            "transacoes": [],
-            "categorias_entrada": ["Venda", "Investimento", "Salário", "Outro"],
-            "categorias_saida": ["Mercadoria", "Pagamento", "Compra", "Alimentação", "Transporte", "Outro"],
-            "saldo_atual": 0,
-            "data_ultimo_fechamento": None,
-            "metas": {
-                "economia_mensal": 0,
-                "limite_gastos": 0,
-            },
-            "notificacoes": {
-                "alerta_limite": True,
-                "lembrete_diario": False
-            }
-        }
+        return criar_dados_iniciais()
+
+# Função para criar uma categoria na tabela de categorias do usuário
+# (categorias de sistema, como "Ajuste Manual", não aparecem nos menus)
+def criar_categoria(dados, nome, tipo, sistema=False):
+    cat_id = str(dados.get('proximo_id_categoria', 1))
+    dados['proximo_id_categoria'] = int(cat_id) + 1
+    
+    categoria = {'nome': nome, 'tipo': tipo, 'uso': 0}
+    if sistema:
+        categoria['sistema'] = True
+    else:
+        dados[f"categorias_{tipo}"].append(cat_id)
+        incrementar_versao_categorias(dados)
+    
+    dados['categorias'][cat_id] = categoria
+    return cat_id
+
+# Função para buscar o ID de uma categoria ativa pelo nome
+def buscar_categoria(dados, tipo, nome, incluir_sistema=False):
+    for cat_id, categoria in dados['categorias'].items():
+        if categoria.get('removida') or (categoria.get('sistema') and not incluir_sistema):
+            continue
+        if categoria['tipo'] == tipo and categoria['nome'] == nome:
+            return cat_id
+    return None
+
+# Função para obter (ou criar) uma categoria de sistema
+def obter_categoria_sistema(dados, tipo, nome):
+    cat_id = buscar_categoria(dados, tipo, nome, incluir_sistema=True)
+    if cat_id is None:
+        cat_id = criar_categoria(dados, nome, tipo, sistema=True)
+    return cat_id
+
+# Função para resolver o ID efetivo de uma categoria (categorias removidas apontam para a substituta)
+def resolver_categoria(dados, cat_id):
+    categoria = dados['categorias'].get(cat_id)
+    while categoria is not None and categoria.get('removida'):
+        cat_id = categoria['substituta']
+        categoria = dados['categorias'].get(cat_id)
+    return cat_id
+
+# Função para obter o nome atual de uma categoria
+def nome_categoria(dados, cat_id):
+    categoria = dados['categorias'].get(resolver_categoria(dados, cat_id))
+    return categoria['nome'] if categoria else "Outro"
+
+# Função para montar o mapa ID -> nome atual de todas as categorias do usuário
+def mapa_nomes_categorias(dados):
+    return {cat_id: nome_categoria(dados, cat_id) for cat_id in dados['categorias']}
+
+# Função para migrar dados antigos (categorias por nome) para a tabela de categorias por ID
+def migrar_categorias(dados):
+    nomes_por_tipo = {
+        'entrada': dados.get('categorias_entrada', []),
+        'saida': dados.get('categorias_saida', [])
+    }
+    
+    dados['categorias'] = {}
+    dados['categorias_entrada'] = []
+    dados['categorias_saida'] = []
+    dados['proximo_id_categoria'] = 1
+    
+    ids_por_nome = {}
+    for tipo, nomes in nomes_por_tipo.items():
+        for nome in nomes:
+            ids_por_nome[(tipo, nome)] = criar_categoria(dados, nome, tipo)
+    
+    for transacao in dados['transacoes']:
+        if 'categoria_id' in transacao:
+            continue
+        chave = (transacao['tipo'], transacao.pop('categoria', 'Outro'))
+        if chave not in ids_por_nome:
+            # Categorias que não estão nas listas (ex: "Ajuste Manual") viram categorias de sistema
+            ids_por_nome[chave] = criar_categoria(dados, chave[1], chave[0], sistema=True)
+        transacao['categoria_id'] = ids_por_nome[chave]
+        dados['categorias'][transacao['categoria_id']]['uso'] += 1
+
+# Função para obter a chave do dia ("AAAA-MM-DD") de uma data no formato "DD/MM/AAAA HH:MM:SS"
+def chave_dia(data_str):
+    return f"{data_str[6:10]}-{data_str[3:5]}-{data_str[0:2]}"
+
+# Função para somar uma transação aos totais do dia.
+# 'revisao' guarda a última alteração do dia (usada para revalidar os relatórios em cache).
+def acumular_totais_diarios(dados, transacao, revisao=0):
+    totais = dados['totais_diarios'].setdefault(chave_dia(transacao['data']), {'entrada': 0, 'saida': 0, 'quantidade': 0})
+    totais[transacao['tipo']] += transacao['valor']
+    totais['quantidade'] += 1
+    totais['revisao'] = revisao
+
+# Função para obter um novo número de revisão das transações do usuário
+def nova_revisao_transacoes(dados):
+    dados['revisao_transacoes'] = dados.get('revisao_transacoes', 0) + 1
+    return dados['revisao_transacoes']
+
+# Função para calcular os totais diários a partir das transações (dados antigos)
+def calcular_totais_diarios(dados):
+    dados['totais_diarios'] = {}
+    for transacao in dados['transacoes']:
+        acumular_totais_diarios(dados, transacao)
+
+# Função para obter a chave do mês ("AAAA-MM") de uma data no formato "DD/MM/AAAA HH:MM:SS"
+def chave_mes(data_str):
+    return f"{data_str[6:10]}-{data_str[3:5]}"
+
+# Função para somar (sinal=1) ou subtrair (sinal=-1) uma transação dos totais do mês, também por categoria
+def acumular_totais_mensais(dados, transacao, sinal=1):
+    chave = chave_mes(transacao['data'])
+    totais = dados['totais_mensais'].setdefault(chave, {
+        'entrada': 0, 'saida': 0, 'quantidade': 0, 'categorias': {'entrada': {}, 'saida': {}}
+    })
+    valor = sinal * transacao['valor']
+    totais[transacao['tipo']] += valor
+    totais['quantidade'] += sinal
+    
+    categorias = totais['categorias'][transacao['tipo']]
+    cat_id = transacao['categoria_id']
+    categorias[cat_id] = categorias.get(cat_id, 0) + valor
+    if abs(categorias[cat_id]) < 0.005:
+        del categorias[cat_id]
+    
+    if totais['quantidade'] <= 0:
+        del dados['totais_mensais'][chave]
+
+# Função para calcular os totais mensais a partir das transações (dados antigos)
+def calcular_totais_mensais(dados):
+    dados['totais_mensais'] = {}
+    for transacao in dados['transacoes']:
+        acumular_totais_mensais(dados, transacao)
+
+# Função para registrar uma transação (atualiza saldo, contador de uso da categoria e totais diários)
+def registrar_transacao(dados, transacao):
+    registrar_transacoes(dados, [transacao])
+
+# Função para registrar várias transações de uma vez (o saldo é atualizado uma única vez)
+def registrar_transacoes(dados, transacoes):
+    revisao = nova_revisao_transacoes(dados)
+    variacao_saldo = 0
+    for transacao in transacoes:
+        variacao_saldo += transacao['valor'] if transacao['tipo'] == 'entrada' else -transacao['valor']
+        
+        categoria = dados['categorias'].get(resolver_categoria(dados, transacao['categoria_id']))
+        if categoria is not None:
+            categoria['uso'] += 1
+        
+        acumular_totais_diarios(dados, transacao, revisao)
+        acumular_totais_mensais(dados, transacao)
+    
+    dados['transacoes'].extend(transacoes)
+    dados['saldo_atual'] += variacao_saldo
+
+# Função para remover uma transação pelo ID, desfazendo o efeito no saldo, no uso da categoria e nos totais diários e mensais
+def remover_transacao(dados, transacao_id):
+    # As transações desfeitas normalmente são as mais recentes
+    for indice in range(len(dados['transacoes']) - 1, -1, -1):
+        if dados['transacoes'][indice].get('id') == transacao_id:
+            break
+    else:
+        return None
+    
+    transacao = dados['transacoes'].pop(indice)
+    dados['saldo_atual'] -= transacao['valor'] if transacao['tipo'] == 'entrada' else -transacao['valor']
+    
+    categoria = dados['categorias'].get(resolver_categoria(dados, transacao['categoria_id']))
+    if categoria is not None and categoria['uso'] > 0:
+        categoria['uso'] -= 1
+    
+    dia = chave_dia(transacao['data'])
+    totais = dados['totais_diarios'].get(dia)
+    if totais is not None:
+        totais[transacao['tipo']] -= transacao['valor']
+        totais['quantidade'] -= 1
+        totais['revisao'] = nova_revisao_transacoes(dados)
+        if totais['quantidade'] <= 0:
+            del dados['totais_diarios'][dia]
+    
+    if chave_mes(transacao['data']) in dados['totais_mensais']:
+        acumular_totais_mensais(dados, transacao, sinal=-1)
+    
+    return transacao
+
+# Índice de saldos por usuário: somas prefixadas dos totais diários (dias em ordem e saldo no fim de cada dia).
+# É reconstruído quando as transações ou o saldo mudam; as consultas de saldo em uma data são buscas binárias.
+LIMITE_CACHE_SALDOS = 10000  # usuários
+_cache_indices_saldo = OrderedDict()
+
+# Função para obter (ou reconstruir) o índice de saldos de um usuário: (dias, saldos).
+# saldos[0] é o saldo antes do primeiro dia com movimento e saldos[i + 1] o saldo no fim de dias[i].
+def obter_indice_saldos(user_id, dados):
+    assinatura = (dados.get('revisao_transacoes', 0), dados['saldo_atual'], len(dados['totais_diarios']))
+    em_cache = _cache_indices_saldo.get(user_id)
+    if em_cache is not None and em_cache[0] == assinatura:
+        _cache_indices_saldo.move_to_end(user_id)
+        return em_cache[1]
+    
+    dias = sorted(dados['totais_diarios'])
+    movimentos = [dados['totais_diarios'][dia]['entrada'] - dados['totais_diarios'][dia]['saida'] for dia in dias]
+    # O saldo atual é a âncora: o que não vem das transações conta como saldo anterior ao primeiro dia
+    saldos = list(itertools.accumulate(movimentos, initial=dados['saldo_atual'] - sum(movimentos)))
+    indice = (dias, saldos)
+    
+    _cache_indices_saldo[user_id] = (assinatura, indice)
+    _cache_indices_saldo.move_to_end(user_id)
+    if len(_cache_indices_saldo) > LIMITE_CACHE_SALDOS:
+        _cache_indices_saldo.popitem(last=False)
+    return indice
+
+# Função para descartar o índice de saldos de um usuário (ex: dados apagados)
+def invalidar_indice_saldos(user_id):
+    _cache_indices_saldo.pop(user_id, None)
+
+# Função para obter o saldo no fim de um dia ("AAAA-MM-DD")
+def saldo_no_fim_do_dia(indice, chave):
+    dias, saldos = indice
+    return saldos[bisect.bisect_right(dias, chave)]
+
+# Função para obter a curva de saldo (dias com movimento e saldo no fim de cada um) entre dois dias ("AAAA-MM-DD")
+def curva_saldos(indice, inicio=None, fim=None):
+    dias, saldos = indice
+    primeiro = bisect.bisect_left(dias, inicio) if inicio else 0
+    ultimo = bisect.bisect_right(dias, fim) if fim else len(dias)
+    return dias[primeiro:ultimo], saldos[primeiro + 1:ultimo + 1]
+
+# Função para calcular o fechamento de caixa de um dia a partir dos totais diários e do índice de saldos
+def calcular_fechamento(user_id, dados, dia):
+    chave = dia.strftime("%Y-%m-%d")
+    totais = dados['totais_diarios'].get(chave, {'entrada': 0, 'saida': 0, 'quantidade': 0})
+    saldo_final = saldo_no_fim_do_dia(obter_indice_saldos(user_id, dados), chave)
+    
+    return {
+        'data': dia.strftime("%d/%m/%Y"),
+        'saldo_inicial': saldo_final - (totais['entrada'] - totais['saida']),
+        'saldo_final': saldo_final,
+        'total_entradas': totais['entrada'],
+        'total_saidas': totais['saida']
+    }
+
+# Função para formatar o resumo de um fechamento de caixa
+def formatar_resumo_fechamento(fechamento):
+    texto = f"{EMOJI['calendario']} Data: *{fechamento['data']}*\n\n"
+    texto += f"{EMOJI['saldo']} Saldo Inicial: *{formatar_valor(fechamento['saldo_inicial'])}*\n"
+    texto += f"{EMOJI['entrada']} Total de Entradas: *{formatar_valor(fechamento['total_entradas'])}*\n"
+    texto += f"{EMOJI['saida']} Total de Saídas: *{formatar_valor(fechamento['total_saidas'])}*\n"
+    texto += f"{EMOJI['saldo']} Saldo Final: *{formatar_valor(fechamento['saldo_final'])}*\n\n"
+    return texto
+
+# Função para criar um DataFrame das transações com o nome atual das categorias
+# (no livro binário, a coluna 'data' já vem como datetime e a descrição só é lida se pedida)
+def criar_dataframe_transacoes(transacoes, nomes_categorias, com_descricao=True):
+    if isinstance(transacoes, LivroTransacoes):
+        df = transacoes.dataframe(com_descricao)
+    else:
+        df = pd.DataFrame(transacoes)
+    df['categoria'] = df['categoria_id'].map(nomes_categorias).fillna("Outro")
+    return df
 
 # Função para salvar os dados de um usuário
 def salvar_dados_usuario(user_id, dados):
     arquivo = f"{DATA_DIR}/dados_{user_id}.json"
-    with open(arquivo, 'w', encoding='utf-8') as f:
-        json.dump(dados, f, ensure_ascii=False, indent=2, default=str)
+    acompanhar_meta_economia(user_id, dados)
+    with LATENCIA_ARMAZENAMENTO.labels('salvar').time():
+        # Acima do limite, as transações passam para o livro binário (gravado antes do JSON, que registra o tamanho)
+        transacoes = dados['transacoes']
+        if isinstance(transacoes, list) and LIMITE_TRANSACOES_JSON and len(transacoes) > LIMITE_TRANSACOES_JSON:
+            transacoes = dados['transacoes'] = LivroTransacoes.criar(user_id, transacoes)
+        if isinstance(transacoes, LivroTransacoes):
+            dados_json = {chave: valor for chave, valor in dados.items() if chave != 'transacoes'}
+            dados_json['tamanho_livro'] = transacoes.gravar()
+        else:
+            dados_json = dados
+        
+        with open(arquivo, 'w', encoding='utf-8') as f:
+            json.dump(dados_json, f, ensure_ascii=False, indent=2, default=str)
+            BYTES_ARMAZENAMENTO.labels('salvar').inc(f.tell())
+    revalidar_cache_relatorios(user_id, dados)
+    guardar_resumo_menu(user_id, dados)
 
 # Função para formatar valor em reais
 def formatar_valor(valor):
@@ -173,6 +786,124 @@ def obter_datas_mes(ano, mes):
     ultimo_dia = datetime.datetime(ano, mes, ultimo_dia_num, 23, 59, 59)
     return primeiro_dia, ultimo_dia
 
+# Codificação dos gráficos enviados: "png" (PNG com paleta de cores), "webp" ou "jpeg".
+# Cada gráfico é renderizado na maior resolução da lista que caiba no limite de bytes.
+FORMATO_GRAFICO = os.environ.get("FORMATO_GRAFICO", "png").lower()
+LIMITE_BYTES_GRAFICO = int(os.environ.get("LIMITE_BYTES_GRAFICO", 100_000))
+DPIS_GRAFICO = (100, 85, 72)  # abaixo de 72 dpi os textos ficam ilegíveis no celular
+CORES_PALETA_GRAFICO = 64
+
+# Função para codificar uma imagem renderizada no formato configurado
+def codificar_imagem(imagem, formato):
+    buf = BytesIO()
+    if formato == 'webp':
+        imagem.save(buf, format='WEBP', quality=80, method=4)
+    elif formato == 'jpeg':
+        imagem.save(buf, format='JPEG', quality=85, optimize=True)
+    else:
+        # Gráficos têm poucas cores: a paleta reduz muito o PNG sem perda visível
+        paleta = imagem.quantize(colors=CORES_PALETA_GRAFICO, method=Image.Quantize.FASTOCTREE, dither=Image.Dither.NONE)
+        paleta.save(buf, format='PNG', optimize=True)
+    return buf
+
+# Função para renderizar o gráfico atual dentro do limite de bytes (e liberar a figura)
+def salvar_grafico(nome):
+    formato = FORMATO_GRAFICO if FORMATO_GRAFICO in ('webp', 'jpeg') else 'png'
+    with LATENCIA_GRAFICO.labels(nome).time():
+        figura = plt.gcf()
+        plt.tight_layout()
+        for dpi in DPIS_GRAFICO:
+            figura.set_dpi(dpi)
+            figura.canvas.draw()
+            imagem = Image.frombuffer('RGBA', figura.canvas.get_width_height(), figura.canvas.buffer_rgba()).convert('RGB')
+            buf = codificar_imagem(imagem, formato)
+            if buf.tell() <= LIMITE_BYTES_GRAFICO:
+                break
+        plt.close(figura)
+    BYTES_GRAFICO.labels(nome).observe(buf.tell())
+    buf.name = f"{nome}.{'jpg' if formato == 'jpeg' else formato}"
+    buf.seek(0)
+    return buf
+
+# Limites das séries temporais dos gráficos (o tempo de renderização não cresce com o histórico)
+PONTOS_MAXIMOS_GRAFICO = 300  # pontos de uma curva após a redução
+PONTOS_COM_MARCADOR = 60  # acima disso as linhas são desenhadas sem marcadores
+ROTULOS_MAXIMOS_EIXO = 24  # rótulos no eixo x dos gráficos de barras mensais
+# Agrupamento dos gráficos de fluxo conforme a extensão do período: (dias máximos, frequência do pandas, rótulo)
+AGRUPAMENTOS_FLUXO = [(90, 'D', 'Diário'), (730, 'W', 'Semanal'), (None, 'MS', 'Mensal')]
+
+# Função para reduzir uma curva a no máximo "pontos" pontos preservando a forma (Largest-Triangle-Three-Buckets).
+# Retorna os índices dos pontos mantidos; o primeiro e o último sempre ficam.
+def reduzir_serie_lttb(x, y, pontos=PONTOS_MAXIMOS_GRAFICO):
+    n = len(x)
+    if n <= pontos or pontos < 3:
+        return np.arange(n)
+    
+    x = np.asarray(x, dtype=float)
+    y = np.asarray(y, dtype=float)
+    # Os pontos internos são divididos em pontos - 2 faixas; de cada uma fica o ponto que forma
+    # o maior triângulo com o ponto escolhido na faixa anterior e a média da faixa seguinte
+    limites = np.linspace(1, n - 1, pontos - 1).astype(int)
+    indices = np.empty(pontos, dtype=int)
+    indices[0], indices[-1] = 0, n - 1
+    anterior = 0
+    for faixa in range(pontos - 2):
+        inicio, fim = limites[faixa], limites[faixa + 1]
+        proxima = slice(fim, limites[faixa + 2]) if faixa + 2 < len(limites) else slice(n - 1, n)
+        media_x, media_y = x[proxima].mean(), y[proxima].mean()
+        areas = np.abs((x[anterior] - media_x) * (y[inicio:fim] - y[anterior])
+                       - (x[anterior] - x[inicio:fim]) * (media_y - y[anterior]))
+        anterior = inicio + int(np.argmax(areas))
+        indices[faixa + 1] = anterior
+    return indices
+
+# Função para agrupar um fluxo diário (DataFrame indexado por dia, colunas somáveis) em semanas ou meses
+# quando o período é longo. Retorna o fluxo agrupado e o rótulo do agrupamento ("Diário", "Semanal", "Mensal").
+def agrupar_fluxo(fluxo):
+    fluxo = fluxo.set_axis(pd.to_datetime(fluxo.index))
+    dias = (fluxo.index.max() - fluxo.index.min()).days + 1
+    for limite, frequencia, rotulo in AGRUPAMENTOS_FLUXO:
+        if limite is None or dias <= limite:
+            break
+    if frequencia != 'D':
+        fluxo = fluxo.resample(frequencia).sum()
+    return fluxo, rotulo
+
+# Função para escolher o marcador de uma linha conforme a quantidade de pontos
+def marcador_linha(quantidade, marcador='o'):
+    return marcador if quantidade <= PONTOS_COM_MARCADOR else None
+
+# Função para enviar várias imagens de uma vez (um álbum em vez de várias chamadas send_photo)
+async def enviar_fotos(context, chat_id, fotos):
+    fotos = [(buf, legenda) for buf, legenda in fotos if buf is not None]
+    if len(fotos) == 1:
+        buf, legenda = fotos[0]
+        await context.bot.send_photo(chat_id=chat_id, photo=buf, caption=legenda)
+        return
+    
+    # Um álbum aceita no máximo 10 itens
+    for inicio in range(0, len(fotos), 10):
+        await context.bot.send_media_group(
+            chat_id=chat_id,
+            media=[InputMediaPhoto(media=buf, caption=legenda) for buf, legenda in fotos[inicio:inicio + 10]]
+        )
+
+# Função para enviar vários arquivos de uma vez (um álbum em vez de várias chamadas send_document)
+async def enviar_documentos(context, chat_id, documentos):
+    if len(documentos) == 1:
+        buf, nome_arquivo, legenda = documentos[0]
+        await context.bot.send_document(chat_id=chat_id, document=buf, filename=nome_arquivo, caption=legenda)
+        return
+    
+    for inicio in range(0, len(documentos), 10):
+        await context.bot.send_media_group(
+            chat_id=chat_id,
+            media=[
+                InputMediaDocument(media=buf, filename=nome_arquivo, caption=legenda)
+                for buf, nome_arquivo, legenda in documentos[inicio:inicio + 10]
+            ]
+        )
+
 # Comando /start
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.effective_user.id
@@ -180,7 +911,6 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     
     # Carregar ou criar dados do usuário
     dados = carregar_dados_usuario(user_id)
-    context.user_data['dados'] = dados
     
     # Mensagem de boas-vindas com design melhorado
     await update.message.reply_text(
@@ -195,7 +925,8 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     
     return MENU_PRINCIPAL
 
-# Função para criar o menu principal
+# Função para criar o menu principal (estático, construído uma única vez)
+@lru_cache(maxsize=None)
 def criar_menu_principal():
     keyboard = [
         [
@@ -217,24 +948,323 @@ def criar_menu_principal():
     ]
     return InlineKeyboardMarkup(keyboard)
 
+# Função para criar um teclado com um único botão (ex: "Voltar")
+@lru_cache(maxsize=None)
+def criar_teclado_botao(emoji, texto, callback_data):
+    return InlineKeyboardMarkup([[InlineKeyboardButton(f"{EMOJI[emoji]} {texto}", callback_data=callback_data)]])
+
+# Função para criar o menu de relatórios
+@lru_cache(maxsize=None)
+def criar_menu_relatorios():
+    keyboard = [
+        [
+            InlineKeyboardButton(f"{EMOJI['calendario']} Relatório do Dia", callback_data='relatorio_dia'),
+            InlineKeyboardButton(f"{EMOJI['calendario']} Relatório da Semana", callback_data='relatorio_semana')
+        ],
+        [
+            InlineKeyboardButton(f"{EMOJI['calendario']} Relatório do Mês", callback_data='relatorio_mes'),
+            InlineKeyboardButton(f"{EMOJI['lupa']} Relatório Personalizado", callback_data='relatorio_personalizado')
+        ],
+        [
+            InlineKeyboardButton(f"{EMOJI['grafico']} Comparativo Mensal", callback_data='relatorio_comparativo'),
+            InlineKeyboardButton(f"{EMOJI['grafico']} Últimos 12 Meses", callback_data='relatorio_12_meses')
+        ],
+        [InlineKeyboardButton(f"{EMOJI['voltar']} Voltar", callback_data='voltar_menu')]
+    ]
+    return InlineKeyboardMarkup(keyboard)
+
+# Função para criar o menu exibido junto a um relatório comparativo
+@lru_cache(maxsize=None)
+def criar_menu_comparativos():
+    keyboard = [
+        [
+            InlineKeyboardButton(f"{EMOJI['grafico']} Comparativo Mensal", callback_data='relatorio_comparativo'),
+            InlineKeyboardButton(f"{EMOJI['grafico']} Últimos 12 Meses", callback_data='relatorio_12_meses')
+        ],
+        [InlineKeyboardButton(f"{EMOJI['voltar']} Voltar", callback_data='voltar_relatorios')]
+    ]
+    return InlineKeyboardMarkup(keyboard)
+
+# Função para criar o menu exibido junto ao histórico
+@lru_cache(maxsize=None)
+def criar_menu_historico():
+    keyboard = [
+        [
+            InlineKeyboardButton(f"{EMOJI['grafico']} Ver Gráfico", callback_data='grafico_historico'),
+            InlineKeyboardButton(f"{EMOJI['exportar']} Exportar", callback_data='exportar_historico')
+        ],
+        [InlineKeyboardButton(f"{EMOJI['voltar']} Voltar", callback_data='voltar_menu')]
+    ]
+    return InlineKeyboardMarkup(keyboard)
+
+# Função para criar o menu exibido junto a um relatório gerado
+@lru_cache(maxsize=None)
+def criar_menu_resultado_relatorio():
+    keyboard = [
+        [
+            InlineKeyboardButton(f"{EMOJI['grafico']} Ver Gráfico", callback_data='grafico_relatorio'),
+            InlineKeyboardButton(f"{EMOJI['exportar']} Exportar CSV", callback_data='exportar_relatorio')
+        ],
+        [InlineKeyboardButton(f"{EMOJI['voltar']} Voltar", callback_data='voltar_menu')]
+    ]
+    return InlineKeyboardMarkup(keyboard)
+
+# Função para criar o menu de configurações
+@lru_cache(maxsize=None)
+def criar_menu_configuracoes():
+    keyboard = [
+        [
+            InlineKeyboardButton(f"{EMOJI['adicionar']} Categoria Entrada", callback_data='add_cat_entrada'),
+            InlineKeyboardButton(f"{EMOJI['adicionar']} Categoria Saída", callback_data='add_cat_saida')
+        ],
+        [
+            InlineKeyboardButton(f"{EMOJI['editar']} Editar Cat. Entrada", callback_data='editar_cat_entrada'),
+            InlineKeyboardButton(f"{EMOJI['editar']} Editar Cat. Saída", callback_data='editar_cat_saida')
+        ],
+        [
+            InlineKeyboardButton(f"{EMOJI['remover']} Remover Cat. Entrada", callback_data='remover_cat_entrada'),
+            InlineKeyboardButton(f"{EMOJI['remover']} Remover Cat. Saída", callback_data='remover_cat_saida')
+        ],
+        [
+            InlineKeyboardButton(f"{EMOJI['exportar']} Exportar Dados", callback_data='exportar_dados'),
+            InlineKeyboardButton(f"{EMOJI['importar']} Importar Extrato", callback_data='importar_extrato')
+        ],
+        [
+            InlineKeyboardButton(f"{EMOJI['alerta']} Notificações", callback_data='config_notificacoes'),
+            InlineKeyboardButton(f"{EMOJI['regra']} Regras de Categoria", callback_data='regras_categoria')
+        ],
+        [
+            InlineKeyboardButton(f"{EMOJI['orcamento']} Orçamentos", callback_data='orcamentos'),
+            InlineKeyboardButton(f"{EMOJI['erro']} Apagar Dados", callback_data='apagar_dados')
+        ],
+        [InlineKeyboardButton(f"{EMOJI['voltar']} Voltar ao Menu Principal", callback_data='voltar_menu')]
+    ]
+    return InlineKeyboardMarkup(keyboard)
+
+# Função para criar o menu de metas
+@lru_cache(maxsize=None)
+def criar_menu_metas():
+    keyboard = [
+        [InlineKeyboardButton(f"{EMOJI['grafico']} Definir Meta de Economia", callback_data='meta_economia')],
+        [InlineKeyboardButton(f"{EMOJI['alerta']} Definir Limite de Gastos", callback_data='meta_limite')],
+        [InlineKeyboardButton(f"{EMOJI['voltar']} Voltar ao Menu", callback_data='voltar_menu')]
+    ]
+    return InlineKeyboardMarkup(keyboard)
+
+# Função para criar o menu de notificações (um teclado por combinação de opções)
+@lru_cache(maxsize=None)
+def criar_menu_notificacoes(alerta_limite, lembrete_diario, horario_lembrete, fechamento_automatico, resumo_fechamento, alerta_meta_economia):
+    keyboard = [
+        [InlineKeyboardButton(
+            f"{'✅' if alerta_limite else '❌'} Alertas de Limite",
+            callback_data='toggle_alerta_limite'
+        )],
+        [InlineKeyboardButton(
+            f"{'✅' if alerta_meta_economia else '❌'} Avisos da Meta de Economia",
+            callback_data='toggle_alerta_meta_economia'
+        )],
+        [InlineKeyboardButton(
+            f"{'✅' if lembrete_diario else '❌'} Lembretes Diários",
+            callback_data='toggle_lembrete_diario'
+        )],
+        [InlineKeyboardButton(
+            f"{EMOJI['hora']} Horário do Lembrete: {horario_lembrete}",
+            callback_data='escolher_horario_lembrete'
+        )],
+        [InlineKeyboardButton(
+            f"{'✅' if fechamento_automatico else '❌'} Fechamento de Caixa Automático",
+            callback_data='toggle_fechamento_automatico'
+        )],
+        [InlineKeyboardButton(
+            f"{'✅' if resumo_fechamento else '❌'} Receber Resumo do Fechamento",
+            callback_data='toggle_resumo_fechamento'
+        )],
+        [InlineKeyboardButton(f"{EMOJI['voltar']} Voltar", callback_data='voltar_config')]
+    ]
+    return InlineKeyboardMarkup(keyboard)
+
+# Função para obter o menu de notificações correspondente às preferências do usuário
+def teclado_notificacoes(notificacoes):
+    return criar_menu_notificacoes(
+        notificacoes.get('alerta_limite', True),
+        notificacoes.get('lembrete_diario', False),
+        notificacoes.get('horario_lembrete', HORARIO_LEMBRETE_PADRAO),
+        notificacoes.get('fechamento_automatico', False),
+        notificacoes.get('resumo_fechamento', True),
+        notificacoes.get('alerta_meta_economia', True)
+    )
+
+# Função para criar o menu de escolha do horário do lembrete diário
+@lru_cache(maxsize=None)
+def criar_menu_horarios_lembrete():
+    keyboard = []
+    row = []
+    for hora in range(6, 24):
+        row.append(InlineKeyboardButton(f"{hora:02d}:00", callback_data=f"horario_lembrete_{hora:02d}"))
+        if len(row) == 4:
+            keyboard.append(row)
+            row = []
+    if row:
+        keyboard.append(row)
+    keyboard.append([InlineKeyboardButton(f"{EMOJI['voltar']} Voltar", callback_data='config_notificacoes')])
+    return InlineKeyboardMarkup(keyboard)
+
+# Cache dos teclados de categorias por usuário: (user_id, tipo, acao) -> (versão das categorias, teclado)
+LIMITE_CACHE_TECLADOS = 10000
+_cache_teclados_categorias = OrderedDict()
+_acessos_cache_teclados = {'acerto': 0, 'falha': 0}
+
+# Cache dos relatórios dos períodos padrão (dia, semana, mês): user_id -> {opção: (início, fim, impressão, relatório)}.
+# Os relatórios em cache de um usuário são revalidados sempre que os dados dele são gravados,
+# então um toque repetido é respondido sem ler o arquivo de dados.
+LIMITE_CACHE_RELATORIOS = 5000  # usuários
+_cache_relatorios = OrderedDict()
+_acessos_cache_relatorios = {'acerto': 0, 'falha': 0}
+
+# Cache do resumo mostrado no menu principal (saldo e economia do mês): user_id -> resumo.
+# Atualizado a cada gravação dos dados, então abrir o menu não precisa ler o arquivo do usuário.
+LIMITE_CACHE_RESUMOS = 10000  # usuários
+_cache_resumos_menu = OrderedDict()
+_acessos_cache_resumos = {'acerto': 0, 'falha': 0}
+
+# Ações disponíveis nos teclados de categorias: (prefixo do callback, emoji, inclui "Outro", callback de voltar)
+ACOES_TECLADO_CATEGORIAS = {
+    'registrar': ('cat_', None, True, 'voltar_menu'),
+    'editar': ('edit_cat_{tipo}_', 'editar', False, 'voltar_config'),
+    'remover': ('rem_cat_{tipo}_', 'remover', False, 'voltar_config'),
+    'orcamento': ('orc_cat_', 'orcamento', True, 'voltar_config'),
+}
+
+# Função para marcar que a lista de categorias do usuário mudou (invalida os teclados em cache)
+def incrementar_versao_categorias(dados):
+    dados['versao_categorias'] = dados.get('versao_categorias', 0) + 1
+
+# Função para descartar os teclados de categorias em cache de um usuário
+def invalidar_teclados_categorias(user_id):
+    for chave in [chave for chave in _cache_teclados_categorias if chave[0] == user_id]:
+        del _cache_teclados_categorias[chave]
+
+# Função para criar (ou reutilizar do cache) o teclado de categorias de um usuário
+def criar_teclado_categorias(user_id, dados, tipo, acao):
+    chave = (user_id, tipo, acao)
+    versao = dados.get('versao_categorias', 0)
+    
+    em_cache = _cache_teclados_categorias.get(chave)
+    if em_cache is not None and em_cache[0] == versao:
+        _acessos_cache_teclados['acerto'] += 1
+        _cache_teclados_categorias.move_to_end(chave)
+        return em_cache[1]
+    
+    _acessos_cache_teclados['falha'] += 1
+    prefixo, emoji, incluir_outro, voltar = ACOES_TECLADO_CATEGORIAS[acao]
+    prefixo = prefixo.format(tipo=tipo)
+    emoji = EMOJI[emoji or tipo]
+    
+    # Layout de botões em grade (2 por linha, quando possível)
+    keyboard = []
+    row = []
+    for cat_id in dados[f"categorias_{tipo}"]:
+        nome = dados['categorias'][cat_id]['nome']
+        if nome == "Outro" and not incluir_outro:
+            continue
+        row.append(InlineKeyboardButton(f"{emoji} {nome}", callback_data=f"{prefixo}{cat_id}"))
+        if len(row) == 2:
+            keyboard.append(row)
+            row = []
+    if row:
+        keyboard.append(row)
+    
+    keyboard.append([InlineKeyboardButton(f"{EMOJI['voltar']} Voltar", callback_data=voltar)])
+    teclado = InlineKeyboardMarkup(keyboard)
+    
+    _cache_teclados_categorias[chave] = (versao, teclado)
+    _cache_teclados_categorias.move_to_end(chave)
+    if len(_cache_teclados_categorias) > LIMITE_CACHE_TECLADOS:
+        _cache_teclados_categorias.popitem(last=False)
+    
+    return teclado
+
+# Coletor das métricas de acerto/falha dos caches de teclados e relatórios (lidas apenas quando o endpoint é consultado)
+class ColetorCaches:
+    def collect(self):
+        familia = CounterMetricFamily('bot_cache_acessos', 'Acessos aos caches de teclados e relatórios', labels=['cache', 'resultado'])
+        familia.add_metric(['teclados_categorias', 'acerto'], _acessos_cache_teclados['acerto'])
+        familia.add_metric(['teclados_categorias', 'falha'], _acessos_cache_teclados['falha'])
+        familia.add_metric(['relatorios', 'acerto'], _acessos_cache_relatorios['acerto'])
+        familia.add_metric(['relatorios', 'falha'], _acessos_cache_relatorios['falha'])
+        familia.add_metric(['resumos_menu', 'acerto'], _acessos_cache_resumos['acerto'])
+        familia.add_metric(['resumos_menu', 'falha'], _acessos_cache_resumos['falha'])
+        for funcao in (criar_menu_principal, criar_teclado_botao, criar_menu_relatorios, criar_menu_historico,
+                       criar_menu_resultado_relatorio, criar_menu_configuracoes, criar_menu_metas,
+                       criar_menu_notificacoes, criar_menu_horarios_lembrete):
+            info = funcao.cache_info()
+            familia.add_metric([funcao.__name__, 'acerto'], info.hits)
+            familia.add_metric([funcao.__name__, 'falha'], info.misses)
+        yield familia
+
+REGISTRY.register(ColetorCaches())
+
+# Função para obter a economia (entradas - saídas) de um mês pelos totais mensais
+def economia_mes(dados, chave):
+    totais = dados['totais_mensais'].get(chave, {})
+    return totais.get('entrada', 0) - totais.get('saida', 0)
+
+# Função para montar o resumo do menu principal a partir dos dados do usuário
+def montar_resumo_menu(dados):
+    chave = datetime.datetime.now().strftime("%Y-%m")
+    return {
+        'mes': chave,
+        'saldo': dados['saldo_atual'],
+        'economia': economia_mes(dados, chave),
+        'meta_economia': dados.get('metas', {}).get('economia_mensal', 0)
+    }
+
+# Função para guardar o resumo do menu principal no cache (chamada a cada gravação dos dados)
+def guardar_resumo_menu(user_id, dados):
+    _cache_resumos_menu[user_id] = montar_resumo_menu(dados)
+    _cache_resumos_menu.move_to_end(user_id)
+    if len(_cache_resumos_menu) > LIMITE_CACHE_RESUMOS:
+        _cache_resumos_menu.popitem(last=False)
+
+# Função para obter o resumo do menu principal (do cache, se for do mês atual)
+def obter_resumo_menu(user_id):
+    resumo = _cache_resumos_menu.get(user_id)
+    if resumo is not None and resumo['mes'] == datetime.datetime.now().strftime("%Y-%m"):
+        _acessos_cache_resumos['acerto'] += 1
+        _cache_resumos_menu.move_to_end(user_id)
+        return resumo
+    
+    _acessos_cache_resumos['falha'] += 1
+    guardar_resumo_menu(user_id, carregar_dados_usuario(user_id))
+    return _cache_resumos_menu[user_id]
+
+# Função para montar o texto do menu principal
+def texto_menu_principal(resumo):
+    texto = f"{EMOJI['carteira']} *Menu Principal*\n\n" \
+            f"{EMOJI['saldo']} Saldo atual: *{formatar_valor(resumo['saldo'])}*"
+    
+    meta = resumo['meta_economia']
+    if meta > 0:
+        progresso = max(resumo['economia'], 0) / meta * 100
+        texto += f"\n{EMOJI['grafico']} Meta de economia: *{formatar_valor(resumo['economia'])}* de " \
+                 f"{formatar_valor(meta)} ({progresso:.0f}%)"
+    return texto
+
 # Função para voltar ao menu principal
 async def menu_principal(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
-    user_id = update.effective_user.id
-    dados = carregar_dados_usuario(user_id)
+    resumo = obter_resumo_menu(update.effective_user.id)
     
     if query:
         await query.answer()
         await query.edit_message_text(
-            text=f"{EMOJI['carteira']} *Menu Principal*\n\n"
-                 f"{EMOJI['saldo']} Saldo atual: *{formatar_valor(dados['saldo_atual'])}*",
+            text=texto_menu_principal(resumo),
             parse_mode='Markdown',
             reply_markup=criar_menu_principal()
         )
     else:
         await update.message.reply_text(
-            text=f"{EMOJI['carteira']} *Menu Principal*\n\n"
-                 f"{EMOJI['saldo']} Saldo atual: *{formatar_valor(dados['saldo_atual'])}*",
+            text=texto_menu_principal(resumo),
             parse_mode='Markdown',
             reply_markup=criar_menu_principal()
         )
@@ -250,70 +1280,33 @@ async def callback_menu_principal(update: Update, context: ContextTypes.DEFAULT_
     
     logger.info(f"Callback menu principal: {opcao}")
     
-    # Carregar dados atualizados
     dados = carregar_dados_usuario(user_id)
-    context.user_data['dados'] = dados
     
     if opcao == 'registrar_entrada':
         context.user_data['transacao_temp'] = {'tipo': 'entrada'}
-        categorias = dados['categorias_entrada']
-        
-        # Layout de botões em grade (2 por linha, quando possível)
-        keyboard = []
-        row = []
-        for i, cat in enumerate(categorias):
-            row.append(InlineKeyboardButton(f"{EMOJI['entrada']} {cat}", callback_data=f"cat_{cat}"))
-            if len(row) == 2 or i == len(categorias) - 1:
-                keyboard.append(row)
-                row = []
-        
-        keyboard.append([InlineKeyboardButton(f"{EMOJI['voltar']} Voltar", callback_data='voltar_menu')])
         
         await query.edit_message_text(
             text=f"{EMOJI['entrada']} *Registrar Entrada*\n\nSelecione a categoria:",
             parse_mode='Markdown',
-            reply_markup=InlineKeyboardMarkup(keyboard)
+            reply_markup=criar_teclado_categorias(user_id, dados, 'entrada', 'registrar')
         )
         return INFORMAR_CATEGORIA
         
     elif opcao == 'registrar_saida':
         context.user_data['transacao_temp'] = {'tipo': 'saida'}
-        categorias = dados['categorias_saida']
-        
-        # Layout de botões em grade (2 por linha, quando possível)
-        keyboard = []
-        row = []
-        for i, cat in enumerate(categorias):
-            row.append(InlineKeyboardButton(f"{EMOJI['saida']} {cat}", callback_data=f"cat_{cat}"))
-            if len(row) == 2 or i == len(categorias) - 1:
-                keyboard.append(row)
-                row = []
-                
-        keyboard.append([InlineKeyboardButton(f"{EMOJI['voltar']} Voltar", callback_data='voltar_menu')])
         
         await query.edit_message_text(
             text=f"{EMOJI['saida']} *Registrar Saída*\n\nSelecione a categoria:",
             parse_mode='Markdown',
-            reply_markup=InlineKeyboardMarkup(keyboard)
+            reply_markup=criar_teclado_categorias(user_id, dados, 'saida', 'registrar')
         )
         return INFORMAR_CATEGORIA
         
     elif opcao == 'relatorios':
-        keyboard = [
-            [
-                InlineKeyboardButton(f"{EMOJI['calendario']} Relatório do Dia", callback_data='relatorio_dia'),
-                InlineKeyboardButton(f"{EMOJI['calendario']} Relatório da Semana", callback_data='relatorio_semana')
-            ],
-            [
-                InlineKeyboardButton(f"{EMOJI['calendario']} Relatório do Mês", callback_data='relatorio_mes'),
-                InlineKeyboardButton(f"{EMOJI['lupa']} Relatório Personalizado", callback_data='relatorio_personalizado')
-            ],
-            [InlineKeyboardButton(f"{EMOJI['voltar']} Voltar", callback_data='voltar_menu')]
-        ]
         await query.edit_message_text(
             text=f"{EMOJI['relatorio']} *Relatórios Financeiros*\n\nEscolha o tipo de relatório que deseja visualizar:",
             parse_mode='Markdown',
-            reply_markup=InlineKeyboardMarkup(keyboard)
+            reply_markup=criar_menu_relatorios()
         )
         return RELATORIO
         
@@ -358,33 +1351,11 @@ async def callback_menu_principal(update: Update, context: ContextTypes.DEFAULT_
         return CONFIRMAR_FECHAMENTO_CAIXA
         
     elif opcao == 'configuracoes':
-        keyboard = [
-            [
-                InlineKeyboardButton(f"{EMOJI['adicionar']} Categoria Entrada", callback_data='add_cat_entrada'),
-                InlineKeyboardButton(f"{EMOJI['adicionar']} Categoria Saída", callback_data='add_cat_saida')
-            ],
-            [
-                InlineKeyboardButton(f"{EMOJI['editar']} Editar Cat. Entrada", callback_data='editar_cat_entrada'),
-                InlineKeyboardButton(f"{EMOJI['editar']} Editar Cat. Saída", callback_data='editar_cat_saida')
-            ],
-            [
-                InlineKeyboardButton(f"{EMOJI['remover']} Remover Cat. Entrada", callback_data='remover_cat_entrada'),
-                InlineKeyboardButton(f"{EMOJI['remover']} Remover Cat. Saída", callback_data='remover_cat_saida')
-            ],
-            [
-                InlineKeyboardButton(f"{EMOJI['exportar']} Exportar Dados", callback_data='exportar_dados'),
-                InlineKeyboardButton(f"{EMOJI['alerta']} Notificações", callback_data='config_notificacoes')
-            ],
-            [
-                InlineKeyboardButton(f"{EMOJI['erro']} Apagar Dados", callback_data='apagar_dados')
-            ],
-            [InlineKeyboardButton(f"{EMOJI['voltar']} Voltar ao Menu Principal", callback_data='voltar_menu')]
-        ]
         await query.edit_message_text(
             f"{EMOJI['config']} *Configurações*\n\n"
             f"Personalize seu assistente financeiro:",
             parse_mode='Markdown',
-            reply_markup=InlineKeyboardMarkup(keyboard)
+            reply_markup=criar_menu_configuracoes()
         )
         return CONFIGURACOES
     
@@ -392,19 +1363,13 @@ async def callback_menu_principal(update: Update, context: ContextTypes.DEFAULT_
         # Interface para definir metas financeiras
         metas = dados.get('metas', {'economia_mensal': 0, 'limite_gastos': 0})
         
-        keyboard = [
-            [InlineKeyboardButton(f"{EMOJI['grafico']} Definir Meta de Economia", callback_data='meta_economia')],
-            [InlineKeyboardButton(f"{EMOJI['alerta']} Definir Limite de Gastos", callback_data='meta_limite')],
-            [InlineKeyboardButton(f"{EMOJI['voltar']} Voltar ao Menu", callback_data='voltar_menu')]
-        ]
-        
         await query.edit_message_text(
             text=f"{EMOJI['grafico']} *Metas Financeiras*\n\n"
                  f"• Meta de economia mensal: *{formatar_valor(metas['economia_mensal'])}*\n"
                  f"• Limite de gastos mensal: *{formatar_valor(metas['limite_gastos'])}*\n\n"
                  f"Selecione uma opção para definir ou atualizar suas metas:",
             parse_mode='Markdown',
-            reply_markup=InlineKeyboardMarkup(keyboard)
+            reply_markup=criar_menu_metas()
         )
         
         return DEFINIR_META
@@ -416,7 +1381,7 @@ async def callback_menu_principal(update: Update, context: ContextTypes.DEFAULT_
                  f"Saldo atual: *{formatar_valor(dados['saldo_atual'])}*\n\n"
                  f"Digite o novo valor do saldo (use ponto para decimais):",
             parse_mode='Markdown',
-            reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton(f"{EMOJI['voltar']} Cancelar", callback_data='voltar_menu')]])
+            reply_markup=criar_teclado_botao('voltar', 'Cancelar', 'voltar_menu')
         )
         
         return AJUSTAR_SALDO
@@ -441,13 +1406,13 @@ async def ajustar_saldo(update: Update, context: ContextTypes.DEFAULT_TYPE):
         if novo_saldo < 0:
             await update.message.reply_text(
                 f"{EMOJI['erro']} O saldo não pode ser negativo. Por favor, digite novamente:",
-                reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton(f"{EMOJI['voltar']} Cancelar", callback_data='voltar_menu')]])
+                reply_markup=criar_teclado_botao('voltar', 'Cancelar', 'voltar_menu')
             )
             return AJUSTAR_SALDO
     except ValueError:
         await update.message.reply_text(
             f"{EMOJI['erro']} Valor inválido. Por favor, digite apenas números (ex: 1500.50):",
-            reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton(f"{EMOJI['voltar']} Cancelar", callback_data='voltar_menu')]])
+            reply_markup=criar_teclado_botao('voltar', 'Cancelar', 'voltar_menu')
         )
         return AJUSTAR_SALDO
     
@@ -459,16 +1424,17 @@ async def ajustar_saldo(update: Update, context: ContextTypes.DEFAULT_TYPE):
     ajuste = novo_saldo - dados['saldo_atual']
     
     if ajuste != 0:
+        tipo = 'entrada' if ajuste > 0 else 'saida'
         transacao = {
-            'tipo': 'entrada' if ajuste > 0 else 'saida',
-            'categoria': 'Ajuste Manual',
+            'tipo': tipo,
+            'categoria_id': obter_categoria_sistema(dados, tipo, 'Ajuste Manual'),
             'valor': abs(ajuste),
             'descricao': 'Ajuste manual de saldo',
             'data': obter_data_atual_formatada(),
             'id': str(uuid.uuid4())
         }
         
-        dados['transacoes'].append(transacao)
+        registrar_transacao(dados, transacao)
     
     # Atualizar o saldo
     dados['saldo_atual'] = novo_saldo
@@ -479,7 +1445,7 @@ async def ajustar_saldo(update: Update, context: ContextTypes.DEFAULT_TYPE):
         f"{EMOJI['sucesso']} Saldo ajustado com sucesso!\n\n"
         f"Saldo atual: *{formatar_valor(novo_saldo)}*",
         parse_mode='Markdown',
-        reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton(f"{EMOJI['voltar']} Voltar ao Menu", callback_data='voltar_menu')]])
+        reply_markup=criar_teclado_botao('voltar', 'Voltar ao Menu', 'voltar_menu')
     )
     
     return MENU_PRINCIPAL
@@ -493,7 +1459,7 @@ async def definir_meta(update: Update, context: ContextTypes.DEFAULT_TYPE):
         if 'meta_atual' not in context.user_data:
             await update.message.reply_text(
                 f"{EMOJI['erro']} Ocorreu um erro. Por favor, tente novamente através do menu.",
-                reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton(f"{EMOJI['voltar']} Voltar", callback_data='voltar_menu')]])
+                reply_markup=criar_teclado_botao('voltar', 'Voltar', 'voltar_menu')
             )
             return MENU_PRINCIPAL
         
@@ -505,13 +1471,13 @@ async def definir_meta(update: Update, context: ContextTypes.DEFAULT_TYPE):
             if valor_meta < 0:
                 await update.message.reply_text(
                     f"{EMOJI['erro']} O valor não pode ser negativo. Por favor, digite novamente:",
-                    reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton(f"{EMOJI['voltar']} Cancelar", callback_data='voltar_menu')]])
+                    reply_markup=criar_teclado_botao('voltar', 'Cancelar', 'voltar_menu')
                 )
                 return DEFINIR_META
         except ValueError:
             await update.message.reply_text(
                 f"{EMOJI['erro']} Valor inválido. Por favor, digite apenas números (ex: 1000.50):",
-                reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton(f"{EMOJI['voltar']} Cancelar", callback_data='voltar_menu')]])
+                reply_markup=criar_teclado_botao('voltar', 'Cancelar', 'voltar_menu')
             )
             return DEFINIR_META
         
@@ -533,7 +1499,7 @@ async def definir_meta(update: Update, context: ContextTypes.DEFAULT_TYPE):
             f"{EMOJI['sucesso']} {mensagem} definido com sucesso!\n\n"
             f"Valor: *{formatar_valor(valor_meta)}*",
             parse_mode='Markdown',
-            reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton(f"{EMOJI['voltar']} Voltar ao Menu", callback_data='voltar_menu')]])
+            reply_markup=criar_teclado_botao('voltar', 'Voltar ao Menu', 'voltar_menu')
         )
         
         # Limpar dados temporários
@@ -554,7 +1520,7 @@ async def definir_meta(update: Update, context: ContextTypes.DEFAULT_TYPE):
             text=f"{EMOJI['grafico']} *Definir Meta de Economia Mensal*\n\n"
                  f"Digite o valor da sua meta de economia mensal (quanto deseja guardar por mês):",
             parse_mode='Markdown',
-            reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton(f"{EMOJI['voltar']} Cancelar", callback_data='voltar_menu')]])
+            reply_markup=criar_teclado_botao('voltar', 'Cancelar', 'voltar_menu')
         )
         return DEFINIR_META
     
@@ -564,7 +1530,7 @@ async def definir_meta(update: Update, context: ContextTypes.DEFAULT_TYPE):
             text=f"{EMOJI['alerta']} *Definir Limite de Gastos Mensal*\n\n"
                  f"Digite o valor máximo que deseja gastar por mês:",
             parse_mode='Markdown',
-            reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton(f"{EMOJI['voltar']} Cancelar", callback_data='voltar_menu')]])
+            reply_markup=criar_teclado_botao('voltar', 'Cancelar', 'voltar_menu')
         )
         return DEFINIR_META
     
@@ -578,8 +1544,11 @@ async def selecionar_categoria(update: Update, context: ContextTypes.DEFAULT_TYP
     if query.data == 'voltar_menu':
         return await menu_principal(update, context)
     
-    # Extrair a categoria da callback_data
-    categoria = query.data[4:]  # Remove o prefixo "cat_"
+    # Extrair o ID da categoria da callback_data
+    cat_id = query.data[4:]  # Remove o prefixo "cat_"
+    dados = carregar_dados_usuario(update.effective_user.id)
+    categoria = nome_categoria(dados, cat_id)
+    context.user_data['transacao_temp']['categoria_id'] = cat_id
     context.user_data['transacao_temp']['categoria'] = categoria
     
     tipo_emoji = EMOJI['entrada'] if context.user_data['transacao_temp']['tipo'] == 'entrada' else EMOJI['saida']
@@ -589,7 +1558,7 @@ async def selecionar_categoria(update: Update, context: ContextTypes.DEFAULT_TYP
              f"Categoria: *{categoria}*\n\n"
              f"Digite o valor (apenas números, use ponto para decimais):",
         parse_mode='Markdown',
-        reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton(f"{EMOJI['voltar']} Voltar", callback_data='voltar_menu')]])
+        reply_markup=criar_teclado_botao('voltar', 'Voltar', 'voltar_menu')
     )
     
     return INFORMAR_VALOR
@@ -609,13 +1578,13 @@ async def informar_valor(update: Update, context: ContextTypes.DEFAULT_TYPE):
         if valor <= 0:
             await update.message.reply_text(
                 f"{EMOJI['erro']} O valor deve ser maior que zero. Por favor, digite novamente:",
-                reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton(f"{EMOJI['voltar']} Voltar", callback_data='voltar_menu')]])
+                reply_markup=criar_teclado_botao('voltar', 'Voltar', 'voltar_menu')
             )
             return INFORMAR_VALOR
     except ValueError:
         await update.message.reply_text(
             f"{EMOJI['erro']} Valor inválido. Por favor, digite apenas números (ex: 100.50):",
-            reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton(f"{EMOJI['voltar']} Voltar", callback_data='voltar_menu')]])
+            reply_markup=criar_teclado_botao('voltar', 'Voltar', 'voltar_menu')
         )
         return INFORMAR_VALOR
     
@@ -630,7 +1599,7 @@ async def informar_valor(update: Update, context: ContextTypes.DEFAULT_TYPE):
         f"Valor: *{formatar_valor(valor)}*\n\n"
         f"Agora, digite uma descrição breve para esta transação:",
         parse_mode='Markdown',
-        reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton(f"{EMOJI['voltar']} Voltar", callback_data='voltar_menu')]])
+        reply_markup=criar_teclado_botao('voltar', 'Voltar', 'voltar_menu')
     )
     
     return INFORMAR_DESCRICAO
@@ -648,7 +1617,7 @@ async def informar_descricao(update: Update, context: ContextTypes.DEFAULT_TYPE)
     if not descricao:
         await update.message.reply_text(
             f"{EMOJI['erro']} A descrição não pode estar vazia. Por favor, digite uma descrição:",
-            reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton(f"{EMOJI['voltar']} Voltar", callback_data='voltar_menu')]])
+            reply_markup=criar_teclado_botao('voltar', 'Voltar', 'voltar_menu')
         )
         return INFORMAR_DESCRICAO
     
@@ -677,6 +1646,82 @@ async def informar_descricao(update: Update, context: ContextTypes.DEFAULT_TYPE)
     
     return CONFIRMAR_TRANSACAO
 
+# Função para montar o alerta de limite mensal de gastos após registrar saídas (vazio se não ultrapassou)
+def verificar_limite_gastos(dados, transacoes):
+    if not any(t['tipo'] == 'saida' for t in transacoes) or not dados.get('notificacoes', {}).get('alerta_limite', True):
+        return ""
+    
+    alertas = verificar_orcamentos(dados, transacoes)
+    
+    limite_gastos = dados.get('metas', {}).get('limite_gastos', 0)
+    if limite_gastos <= 0:
+        return alertas
+    
+    # Gastos do mês atual a partir dos totais mensais
+    chave = datetime.datetime.now().strftime("%Y-%m")
+    gastos_mes = dados['totais_mensais'].get(chave, {}).get('saida', 0)
+    
+    if gastos_mes <= limite_gastos:
+        # Aviso antecipado: a previsão de fim de mês passou do limite com estas saídas
+        soma = sum(t['valor'] for t in transacoes if t['tipo'] == 'saida' and chave_mes(t['data']) == chave)
+        previsao = prever_fim_do_mes(dados) if soma else None
+        if previsao is not None and previsao['saidas'] - soma <= limite_gastos < previsao['saidas']:
+            alertas = f"\n\n{EMOJI['previsao']} *Previsão de Limite*\n" \
+                      f"Neste ritmo, seus gastos devem chegar a {formatar_valor(previsao['saidas'])} até o fim do mês.\n" \
+                      f"Seu limite: {formatar_valor(limite_gastos)}" + alertas
+        return alertas
+    return f"\n\n{EMOJI['alerta']} *Alerta de Limite*\n" \
+           f"Você ultrapassou seu limite mensal de gastos! " \
+           f"Gastos no mês: {formatar_valor(gastos_mes)}\n" \
+           f"Seu limite: {formatar_valor(limite_gastos)}" + alertas
+
+# Percentuais do orçamento de uma categoria que geram alerta quando atingidos
+LIMIARES_ORCAMENTO = (80, 100)
+
+# Função para obter o gasto de cada categoria em um mês (pelos totais mensais, sem varrer as transações).
+# Os totais guardam o ID original: o gasto de uma categoria removida conta para a substituta ("Outro")
+def gastos_categorias_mes(dados, chave):
+    gastos = {}
+    for cat_id, valor in dados['totais_mensais'].get(chave, {}).get('categorias', {}).get('saida', {}).items():
+        cat_id = resolver_categoria(dados, cat_id)
+        gastos[cat_id] = gastos.get(cat_id, 0) + valor
+    return gastos
+
+# Função para verificar os orçamentos por categoria após registrar transações (já somadas aos totais).
+# O gasto antes das transações é o total atual menos o que elas somaram, então só há alerta
+# quando um limiar é atingido agora, e não a cada nova saída de uma categoria já estourada.
+def verificar_orcamentos(dados, transacoes):
+    orcamentos = dados.get('orcamentos', {})
+    if not orcamentos:
+        return ""
+    
+    somas = {}
+    for transacao in transacoes:
+        cat_id = resolver_categoria(dados, transacao['categoria_id'])
+        if transacao['tipo'] == 'saida' and cat_id in orcamentos:
+            chave = (chave_mes(transacao['data']), cat_id)
+            somas[chave] = somas.get(chave, 0) + transacao['valor']
+    
+    alertas = ""
+    gastos_por_mes = {}
+    for (mes, cat_id), soma in somas.items():
+        orcamento = orcamentos[cat_id]
+        if mes not in gastos_por_mes:
+            gastos_por_mes[mes] = gastos_categorias_mes(dados, mes)
+        depois = gastos_por_mes[mes].get(cat_id, 0)
+        antes = depois - soma
+        atingidos = [limiar for limiar in LIMIARES_ORCAMENTO if antes < orcamento * limiar / 100 <= depois]
+        if not atingidos:
+            continue
+        
+        nome = escape_markdown(nome_categoria(dados, cat_id))
+        if atingidos[-1] >= 100:
+            alertas += f"\n\n{EMOJI['alerta']} *Orçamento estourado:* {nome}\n"
+        else:
+            alertas += f"\n\n{EMOJI['orcamento']} *{atingidos[-1]}% do orçamento:* {nome}\n"
+        alertas += f"Gasto em {mes[5:]}/{mes[:4]}: {formatar_valor(depois)} de {formatar_valor(orcamento)}"
+    return alertas
+
 # Função para confirmar transação
 async def confirmar_transacao(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
@@ -686,46 +1731,27 @@ async def confirmar_transacao(update: Update, context: ContextTypes.DEFAULT_TYPE
         return await menu_principal(update, context)
     
     user_id = update.effective_user.id
-    dados = context.user_data['dados']
-    transacao = context.user_data['transacao_temp']
-    
-    # Adicionar data e ID à transação
-    transacao['data'] = obter_data_atual_formatada()
-    transacao['id'] = str(uuid.uuid4())
+    dados = carregar_dados_usuario(user_id)
+    transacao_temp = context.user_data['transacao_temp']
+    
+    # Montar a transação (referenciando a categoria pelo ID) com data e ID
+    transacao = {
+        'tipo': transacao_temp['tipo'],
+        'categoria_id': transacao_temp['categoria_id'],
+        'valor': transacao_temp['valor'],
+        'descricao': transacao_temp['descricao'],
+        'data': obter_data_atual_formatada(),
+        'id': str(uuid.uuid4())
+    }
     
-    # Atualizar saldo
-    if transacao['tipo'] == 'entrada':
-        dados['saldo_atual'] += transacao['valor']
-    else:
-        dados['saldo_atual'] -= transacao['valor']
+    # Atualizar saldo e adicionar à lista de transações
+    registrar_transacao(dados, transacao)
     
-    # Adicionar à lista de transações
-    dados['transacoes'].append(transacao)
+    # Aprender a categoria escolhida para esta descrição
+    aprender_regra(dados, transacao['descricao'], transacao['categoria_id'], transacao['valor'], obter_classificador(user_id, dados))
     
     # Verificar limites (para saídas)
-    mensagem_alerta = ""
-    if transacao['tipo'] == 'saida' and dados.get('notificacoes', {}).get('alerta_limite', True):
-        # Calcular gastos do mês atual
-        hoje = datetime.datetime.now()
-        primeiro_dia, ultimo_dia = obter_datas_mes(hoje.year, hoje.month)
-        
-        gastos_mes = 0
-        for t in dados['transacoes']:
-            if t['tipo'] == 'saida':
-                try:
-                    data_t = datetime.datetime.strptime(t['data'], "%d/%m/%Y %H:%M:%S")
-                    if primeiro_dia <= data_t <= ultimo_dia:
-                        gastos_mes += t['valor']
-                except:
-                    continue
-        
-        # Verificar se ultrapassou o limite
-        limite_gastos = dados.get('metas', {}).get('limite_gastos', 0)
-        if limite_gastos > 0 and gastos_mes > limite_gastos:
-            mensagem_alerta = f"\n\n{EMOJI['alerta']} *Alerta de Limite*\n" \
-                             f"Você ultrapassou seu limite mensal de gastos! " \
-                             f"Gastos no mês: {formatar_valor(gastos_mes)}\n" \
-                             f"Seu limite: {formatar_valor(limite_gastos)}"
+    mensagem_alerta = verificar_limite_gastos(dados, [transacao])
     
     # Salvar dados
     salvar_dados_usuario(user_id, dados)
@@ -736,7 +1762,7 @@ async def confirmar_transacao(update: Update, context: ContextTypes.DEFAULT_TYPE
     
     await query.edit_message_text(
         f"{EMOJI['sucesso']} *{tipo} registrada com sucesso!*\n\n"
-        f"• Categoria: *{transacao['categoria']}*\n"
+        f"• Categoria: *{nome_categoria(dados, transacao['categoria_id'])}*\n"
         f"• Valor: *{formatar_valor(transacao['valor'])}*\n"
         f"• Descrição: *{transacao['descricao']}*\n\n"
         f"{EMOJI['saldo']} Seu saldo atual é: *{formatar_valor(dados['saldo_atual'])}*"
@@ -754,25 +1780,465 @@ async def confirmar_transacao(update: Update, context: ContextTypes.DEFAULT_TYPE
     
     return MENU_PRINCIPAL
 
-# Função para mostrar histórico
-async def mostrar_historico(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    query = update.callback_query
-    await query.answer()
+# Lançamento rápido em uma única mensagem: "/s 45,90 Alimentação almoço", "/e 1200 Venda" ou "+1200 Venda cliente X"
+# (uma transação por linha para lançar várias de uma vez)
+PADRAO_LANCAMENTO_RAPIDO = re.compile(r'^\s*([+-])?\s*(?:R\$\s*)?(\d[\d.,]*)(?:\s+(.*))?$', re.DOTALL)
+FILTRO_LANCAMENTO_RAPIDO = filters.TEXT & ~filters.COMMAND & filters.Regex(r'^\s*[+-]\s*(?:R\$\s*)?\d')
+MAX_PALAVRAS_CATEGORIA = 3
+LIMITE_LINHAS_LOTE = 100
+PADRAO_VALOR_MILHAR = re.compile(r'\d{1,3}(?:\.\d{3})+')
+PADRAO_VALOR_VIRGULA = re.compile(r'\d{1,3}(?:\.\d{3})+,\d+|\d+,\d+')
+PADRAO_VALOR_PONTO = re.compile(r'\d+(?:\.\d+)?')
+
+# Função para converter um valor digitado pelo usuário, no formato brasileiro: "1.200" e "1.200,50" usam o ponto
+# como milhar, "45,90" e "45.90" como decimal. Formatos ambíguos (ex: "1,200.50", "1.20.0") levantam ValueError
+def converter_valor_digitado(texto):
+    texto = texto.strip().replace('R$', '').replace(' ', '')
+    if PADRAO_VALOR_VIRGULA.fullmatch(texto):
+        return float(texto.replace('.', '').replace(',', '.'))
+    if PADRAO_VALOR_MILHAR.fullmatch(texto):
+        return float(texto.replace('.', ''))
+    if PADRAO_VALOR_PONTO.fullmatch(texto):
+        return float(texto)
+    raise ValueError(f"Valor inválido: {texto}")
+LINHAS_RESUMO_LOTE = 20
+SIMILARIDADE_MINIMA_CATEGORIA = 0.75
+TEXTO_AJUDA_LANCAMENTO_RAPIDO = (
+    f"{EMOJI['info']} *Lançamento rápido*\n\n"
+    "Registre uma transação em uma única mensagem:\n"
+    "• `/s 45,90 Alimentação almoço` — saída\n"
+    "• `/e 1200 Venda cliente X` — entrada\n"
+    "• `-45,90 Alimentação almoço` ou `+1200 Venda cliente X`\n\n"
+    "Para lançar várias de uma vez, coloque uma transação por linha "
+    "(após `/s` ou `/e`, ou com `+`/`-` em cada linha).\n\n"
+    "O nome da categoria pode ser abreviado ou ter pequenos erros de digitação. "
+    "Sem categoria, as regras de categorização escolhem uma pela descrição."
+)
+
+# Função para encontrar a categoria mencionada no início do texto (exata, abreviada ou aproximada)
+# Retorna o ID da categoria e quantas palavras do texto foram usadas pelo nome
+def encontrar_categoria_texto(dados, tipo, palavras):
+    categorias = {}
+    for cat_id in dados[f'categorias_{tipo}']:
+        categorias.setdefault(normalizar_texto(dados['categorias'][cat_id]['nome']), cat_id)
+    
+    candidatos = [normalizar_texto(' '.join(palavras[:n])) for n in range(1, min(len(palavras), MAX_PALAVRAS_CATEGORIA) + 1)]
+    
+    # Nome exato (o mais longo primeiro, para "Ajuste de Estoque" não virar "Ajuste")
+    for n in range(len(candidatos), 0, -1):
+        if candidatos[n - 1] in categorias:
+            return categorias[candidatos[n - 1]], n
+    
+    if not candidatos:
+        return None, 0
+    
+    # Abreviação da primeira palavra, se apontar para uma única categoria ("alim" -> "Alimentação")
+    primeira = candidatos[0]
+    if len(primeira) >= 3:
+        abreviadas = [cat_id for nome, cat_id in categorias.items() if nome.startswith(primeira)]
+        if len(abreviadas) == 1:
+            return abreviadas[0], 1
+    
+    # Erros de digitação ("alimentacao", "trasnporte")
+    for n in range(len(candidatos), 0, -1):
+        parecidas = difflib.get_close_matches(candidatos[n - 1], categorias, n=1, cutoff=SIMILARIDADE_MINIMA_CATEGORIA)
+        if parecidas:
+            return categorias[parecidas[0]], n
+    
+    return None, 0
+
+# Função para interpretar um lançamento rápido; levanta ValueError com a mensagem para o usuário
+def interpretar_lancamento_rapido(dados, texto, tipo, classificador):
+    correspondencia = PADRAO_LANCAMENTO_RAPIDO.match(texto)
+    if not correspondencia:
+        raise ValueError("Informe o valor logo no início (ex: `45,90 Alimentação almoço`).")
+    
+    sinal, valor_texto, resto = correspondencia.groups()
+    if sinal:
+        tipo = 'entrada' if sinal == '+' else 'saida'
+    if tipo is None:
+        raise ValueError("Use `+` para entradas ou `-` para saídas (ex: `-45,90 Alimentação`).")
     
-    logger.info("Iniciando mostrar_historico")
+    try:
+        valor = round(converter_valor_digitado(valor_texto), 2)
+    except ValueError:
+        raise ValueError(f"Valor inválido: `{valor_texto}`.")
+    if valor <= 0:
+        raise ValueError("O valor deve ser maior que zero.")
+    
+    palavras = (resto or '').split()
+    cat_id, usadas = encontrar_categoria_texto(dados, tipo, palavras)
+    descricao = ' '.join(palavras[usadas:])[:200]
+    
+    categoria_informada = cat_id is not None
+    if not categoria_informada:
+        descricao = ' '.join(palavras)[:200]
+        cat_id = (descricao and classificador.classificar(descricao, valor, tipo)) or buscar_categoria(dados, tipo, "Outro")
+        if cat_id is None:
+            raise ValueError("Não encontrei a categoria. Informe o nome logo após o valor.")
+    
+    return {
+        'tipo': tipo,
+        'categoria_id': cat_id,
+        'valor': valor,
+        'descricao': descricao or nome_categoria(dados, cat_id),
+        'data': obter_data_atual_formatada(),
+        'id': str(uuid.uuid4())
+    }, categoria_informada
+
+# Função para registrar uma transação a partir de uma única mensagem (comandos /s e /e, ou texto iniciado por + ou -)
+async def lancamento_rapido(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if update.message.text.startswith('/'):
+        comando = update.message.text.split(maxsplit=1)[0].split('@')[0].lower()
+        tipo = 'entrada' if comando == '/e' else 'saida'
+        # context.args perde as quebras de linha, necessárias para o lançamento em lote
+        partes = update.message.text.split(maxsplit=1)
+        texto = partes[1] if len(partes) > 1 else ""
+        if not texto.strip():
+            await update.message.reply_text(TEXTO_AJUDA_LANCAMENTO_RAPIDO, parse_mode='Markdown')
+            return None
+    else:
+        tipo = None
+        texto = update.message.text
     
     user_id = update.effective_user.id
     dados = carregar_dados_usuario(user_id)
+    classificador = obter_classificador(user_id, dados)
     
-    # Obter as últimas 10 transações (ou menos, se houver menos)
-    transacoes = dados['transacoes'][-10:]
+    linhas = [linha for linha in texto.splitlines() if linha.strip()]
+    if len(linhas) > 1:
+        return await preparar_lote(update, context, dados, linhas, tipo, classificador)
+    
+    try:
+        transacao, categoria_informada = interpretar_lancamento_rapido(dados, texto, tipo, classificador)
+    except ValueError as e:
+        await update.message.reply_text(f"{EMOJI['erro']} {e}\n\n{TEXTO_AJUDA_LANCAMENTO_RAPIDO}", parse_mode='Markdown')
+        return None
+    
+    registrar_transacao(dados, transacao)
+    if categoria_informada:
+        aprender_regra(dados, transacao['descricao'], transacao['categoria_id'], transacao['valor'], classificador)
+    mensagem_alerta = verificar_limite_gastos(dados, [transacao])
+    salvar_dados_usuario(user_id, dados)
+    
+    tipo_texto = "Entrada" if transacao['tipo'] == 'entrada' else "Saída"
+    tipo_emoji = EMOJI['entrada'] if transacao['tipo'] == 'entrada' else EMOJI['saida']
+    await update.message.reply_text(
+        f"{tipo_emoji} *{tipo_texto} registrada:* {formatar_valor(transacao['valor'])} em "
+        f"*{escape_markdown(nome_categoria(dados, transacao['categoria_id']))}*\n"
+        f"• Descrição: {escape_markdown(transacao['descricao'])}\n"
+        f"{EMOJI['saldo']} Saldo atual: *{formatar_valor(dados['saldo_atual'])}*"
+        f"{mensagem_alerta}",
+        parse_mode='Markdown',
+        reply_markup=criar_teclado_botao('desfazer', 'Desfazer', f"desfazer_{transacao['id']}")
+    )
+    
+    # Mantém o estado atual da conversa, se houver
+    return None
+
+# Função para interpretar várias linhas de lançamento rápido e pedir uma única confirmação
+async def preparar_lote(update: Update, context: ContextTypes.DEFAULT_TYPE, dados, linhas, tipo, classificador):
+    if len(linhas) > LIMITE_LINHAS_LOTE:
+        await update.message.reply_text(
+            f"{EMOJI['erro']} Envie no máximo {LIMITE_LINHAS_LOTE} transações por mensagem."
+        )
+        return None
+    
+    # Todas as linhas são validadas antes de qualquer registro
+    lote = []
+    erros = []
+    for numero, linha in enumerate(linhas, 1):
+        try:
+            lote.append(interpretar_lancamento_rapido(dados, linha, tipo, classificador))
+        except ValueError as e:
+            erros.append(f"• Linha {numero}: {e}")
+    
+    if erros:
+        await update.message.reply_text(
+            f"{EMOJI['erro']} *Nenhuma transação foi registrada.* Corrija as linhas abaixo e envie novamente:\n\n"
+            + "\n".join(erros[:LINHAS_RESUMO_LOTE])
+            + (f"\n• ... e mais {len(erros) - LINHAS_RESUMO_LOTE} linhas" if len(erros) > LINHAS_RESUMO_LOTE else ""),
+            parse_mode='Markdown'
+        )
+        return None
+    
+    context.user_data['lote'] = lote
+    
+    total_entradas = sum(t['valor'] for t, _ in lote if t['tipo'] == 'entrada')
+    total_saidas = sum(t['valor'] for t, _ in lote if t['tipo'] == 'saida')
+    
+    texto = f"{EMOJI['transacao']} *Lançamento em lote: {len(lote)} transações*\n\n"
+    for transacao, _ in lote[:LINHAS_RESUMO_LOTE]:
+        tipo_emoji = EMOJI['entrada'] if transacao['tipo'] == 'entrada' else EMOJI['saida']
+        texto += (f"{tipo_emoji} {formatar_valor(transacao['valor'])} • "
+                  f"{escape_markdown(nome_categoria(dados, transacao['categoria_id']))} • "
+                  f"{escape_markdown(transacao['descricao'])}\n")
+    if len(lote) > LINHAS_RESUMO_LOTE:
+        texto += f"... e mais {len(lote) - LINHAS_RESUMO_LOTE} transações\n"
+    texto += (f"\n{EMOJI['entrada']} Entradas: *{formatar_valor(total_entradas)}*\n"
+              f"{EMOJI['saida']} Saídas: *{formatar_valor(total_saidas)}*\n"
+              f"{EMOJI['saldo']} Saldo após o lote: *{formatar_valor(dados['saldo_atual'] + total_entradas - total_saidas)}*\n\n"
+              f"Confirma estas transações?")
+    
+    await update.message.reply_text(
+        texto,
+        parse_mode='Markdown',
+        reply_markup=InlineKeyboardMarkup([
+            [
+                InlineKeyboardButton(f"{EMOJI['confirmar']} Confirmar", callback_data='confirmar_lote'),
+                InlineKeyboardButton(f"{EMOJI['cancelar']} Cancelar", callback_data='cancelar_lote')
+            ]
+        ])
+    )
+    return None
+
+# Função para registrar (ou descartar) o lote pendente com uma única gravação
+async def confirmar_lote(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    query = update.callback_query
+    await query.answer()
+    
+    lote = context.user_data.pop('lote', None)
+    if query.data != 'confirmar_lote':
+        await query.edit_message_text(f"{EMOJI['cancelar']} Lançamento em lote cancelado.")
+        return None
+    if not lote:
+        await query.edit_message_text(f"{EMOJI['info']} Este lote já foi registrado ou expirou. Envie as linhas novamente.")
+        return None
+    
+    user_id = update.effective_user.id
+    dados = carregar_dados_usuario(user_id)
+    classificador = obter_classificador(user_id, dados)
+    
+    data = obter_data_atual_formatada()
+    transacoes = []
+    for transacao, categoria_informada in lote:
+        transacao['data'] = data
+        transacoes.append(transacao)
+        if categoria_informada:
+            aprender_regra(dados, transacao['descricao'], transacao['categoria_id'], transacao['valor'], classificador)
+    
+    # Um único registro (saldo atualizado uma vez), uma verificação de limite e uma gravação
+    registrar_transacoes(dados, transacoes)
+    mensagem_alerta = verificar_limite_gastos(dados, transacoes)
+    salvar_dados_usuario(user_id, dados)
+    
+    await query.edit_message_text(
+        f"{EMOJI['sucesso']} *{len(transacoes)} transações registradas!*\n\n"
+        f"{EMOJI['saldo']} Saldo atual: *{formatar_valor(dados['saldo_atual'])}*"
+        f"{mensagem_alerta}",
+        parse_mode='Markdown'
+    )
+    return None
+
+# Função para desfazer uma transação registrada pelo lançamento rápido
+async def desfazer_transacao(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    query = update.callback_query
+    await query.answer()
+    
+    user_id = update.effective_user.id
+    dados = carregar_dados_usuario(user_id)
+    transacao = remover_transacao(dados, query.data[len('desfazer_'):])
+    
+    if transacao is None:
+        await query.edit_message_text(f"{EMOJI['info']} Esta transação já foi desfeita.")
+        return None
+    
+    salvar_dados_usuario(user_id, dados)
+    
+    await query.edit_message_text(
+        f"{EMOJI['desfazer']} Transação desfeita: {formatar_valor(transacao['valor'])} em "
+        f"*{escape_markdown(nome_categoria(dados, transacao['categoria_id']))}*\n"
+        f"{EMOJI['saldo']} Saldo atual: *{formatar_valor(dados['saldo_atual'])}*",
+        parse_mode='Markdown'
+    )
+    return None
+
+# Função para consultar o saldo no fim de uma data: /saldo DD/MM[/AAAA] (sem data, o saldo atual)
+async def comando_saldo(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    user_id = update.effective_user.id
+    dados = carregar_dados_usuario(user_id)
+    
+    if not context.args:
+        await update.message.reply_text(
+            f"{EMOJI['saldo']} Saldo atual: *{formatar_valor(dados['saldo_atual'])}*\n\n"
+            f"Para consultar o saldo em uma data, envie /saldo DD/MM/AAAA",
+            parse_mode='Markdown'
+        )
+        return None
+    
+    data_texto = context.args[0]
+    try:
+        if data_texto.count('/') == 1:
+            data_texto += f"/{datetime.datetime.now().year}"
+        dia = analisar_data_br(data_texto)
+    except ValueError:
+        await update.message.reply_text(
+            f"{EMOJI['erro']} Data inválida. Use o formato DD/MM/AAAA (ex: /saldo 01/03/2025)."
+        )
+        return None
+    
+    saldo = saldo_no_fim_do_dia(obter_indice_saldos(user_id, dados), dia.strftime("%Y-%m-%d"))
+    await update.message.reply_text(
+        f"{EMOJI['saldo']} Saldo no fim de {dia.strftime('%d/%m/%Y')}: *{formatar_valor(saldo)}*",
+        parse_mode='Markdown'
+    )
+    return None
+
+# Dias da semana aceitos nas recorrências semanais (índice = datetime.weekday())
+DIAS_SEMANA = ('segunda', 'terça', 'quarta', 'quinta', 'sexta', 'sábado', 'domingo')
+
+TEXTO_AJUDA_RECORRENTES = (
+    f"{EMOJI['recorrente']} *Lançamentos recorrentes*\n\n"
+    "Cadastre entradas e saídas que se repetem e o bot as registra sozinho:\n"
+    "• `/recorrente dia 5 -1500 Moradia aluguel` — todo dia 5\n"
+    "• `/recorrente mensal +3000 Salário` — todo mês, no dia de hoje\n"
+    "• `/recorrente toda segunda -50 Academia` — toda semana\n"
+    "• `/recorrente semanal +200 Venda feira` — toda semana, no dia de hoje\n\n"
+    "O valor e a descrição seguem o lançamento rápido (`+` entrada, `-` saída). "
+    "Em meses mais curtos, o dia 31 vira o último dia do mês.\n\n"
+    "/recorrentes lista as recorrências e permite removê-las."
+)
+
+# Função para interpretar a frequência no início do texto de uma recorrência.
+# Retorna (frequência, dia, resto do texto); dia é o dia do mês (mensal) ou da semana (semanal).
+def interpretar_frequencia_recorrente(texto, hoje):
+    palavras = texto.split(maxsplit=2)
+    primeira = normalizar_texto(palavras[0]) if palavras else ''
+    
+    if primeira in ('mensal', 'semanal'):
+        dia = hoje.day if primeira == 'mensal' else hoje.weekday()
+        return primeira, dia, texto.split(maxsplit=1)[1] if len(palavras) > 1 else ''
+    
+    if primeira == 'dia' and len(palavras) > 1:
+        if not palavras[1].isdigit() or not 1 <= int(palavras[1]) <= 31:
+            raise ValueError(f"Dia do mês inválido: `{palavras[1]}` (use de 1 a 31).")
+        return 'mensal', int(palavras[1]), palavras[2] if len(palavras) > 2 else ''
+    
+    if primeira in ('todo', 'toda') and len(palavras) > 1:
+        nome_dia = normalizar_texto(palavras[1])
+        for indice, dia_semana in enumerate(DIAS_SEMANA):
+            if normalizar_texto(dia_semana).startswith(nome_dia[:3]):
+                return 'semanal', indice, palavras[2] if len(palavras) > 2 else ''
+        raise ValueError(f"Dia da semana inválido: `{palavras[1]}`.")
+    
+    raise ValueError("Comece pela frequência: `dia 5`, `mensal`, `semanal` ou `toda segunda`.")
+
+# Função para descrever a frequência de uma recorrência ("todo dia 5", "toda segunda")
+def descrever_frequencia_recorrente(recorrente):
+    if recorrente['frequencia'] == 'semanal':
+        dia = DIAS_SEMANA[recorrente['dia']]
+        return f"{'todo' if dia in ('sábado', 'domingo') else 'toda'} {dia}"
+    return f"todo dia {recorrente['dia']}"
+
+# Função para criar o teclado da lista de recorrências (um botão de remover por recorrência)
+def criar_teclado_recorrentes(dados):
+    keyboard = [
+        [InlineKeyboardButton(f"{EMOJI['remover']} {recorrente['descricao']}"[:60], callback_data=f"rem_recorrente_{recorrente['id']}")]
+        for recorrente in dados['recorrentes']
+    ]
+    return InlineKeyboardMarkup(keyboard) if keyboard else None
+
+# Função para montar o texto da lista de recorrências
+def formatar_recorrentes(dados):
+    if not dados['recorrentes']:
+        return f"{EMOJI['info']} Você não tem lançamentos recorrentes.\n\n{TEXTO_AJUDA_RECORRENTES}"
+    
+    texto = f"{EMOJI['recorrente']} *Lançamentos Recorrentes*\n\n"
+    for recorrente in dados['recorrentes']:
+        proxima = datetime.date.fromisoformat(recorrente['proxima']).strftime('%d/%m/%Y')
+        texto += (
+            f"{EMOJI[recorrente['tipo']]} {escape_markdown(recorrente['descricao'])}: *{formatar_valor(recorrente['valor'])}* "
+            f"({escape_markdown(nome_categoria(dados, recorrente['categoria_id']))})\n"
+            f"    {descrever_frequencia_recorrente(recorrente)} · próximo: {proxima}\n"
+        )
+    texto += "\nToque em uma recorrência abaixo para removê-la."
+    return texto
+
+# Função para criar uma recorrência: /recorrente dia 5 -1500 Moradia aluguel (sem argumentos, mostra a ajuda)
+async def comando_recorrente(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    partes = update.message.text.split(maxsplit=1)
+    if len(partes) < 2 or not partes[1].strip():
+        await update.message.reply_text(TEXTO_AJUDA_RECORRENTES, parse_mode='Markdown')
+        return None
+    
+    user_id = update.effective_user.id
+    dados = carregar_dados_usuario(user_id)
+    hoje = datetime.date.today()
+    try:
+        frequencia, dia, resto = interpretar_frequencia_recorrente(partes[1], hoje)
+        transacao, _ = interpretar_lancamento_rapido(dados, resto, None, obter_classificador(user_id, dados))
+    except ValueError as e:
+        await update.message.reply_text(f"{EMOJI['erro']} {e}\n\n{TEXTO_AJUDA_RECORRENTES}", parse_mode='Markdown')
+        return None
+    
+    recorrente = {
+        'id': str(dados['proximo_id_recorrente']),
+        'tipo': transacao['tipo'],
+        'categoria_id': transacao['categoria_id'],
+        'valor': transacao['valor'],
+        'descricao': transacao['descricao'],
+        'frequencia': frequencia,
+        'dia': dia
+    }
+    # A primeira ocorrência é a próxima depois de hoje (a de hoje, se houver, o usuário já registrou)
+    recorrente['proxima'] = proxima_data_recorrente(recorrente, hoje).isoformat()
+    dados['proximo_id_recorrente'] += 1
+    dados['recorrentes'].append(recorrente)
+    salvar_dados_usuario(user_id, dados)
+    atualizar_recorrentes_usuario(user_id, dados)
+    
+    tipo = "Entrada" if recorrente['tipo'] == 'entrada' else "Saída"
+    await update.message.reply_text(
+        f"{EMOJI['recorrente']} *{tipo} recorrente criada!*\n\n"
+        f"• Categoria: *{escape_markdown(nome_categoria(dados, recorrente['categoria_id']))}*\n"
+        f"• Valor: *{formatar_valor(recorrente['valor'])}*\n"
+        f"• Descrição: *{escape_markdown(recorrente['descricao'])}*\n"
+        f"• Frequência: {descrever_frequencia_recorrente(recorrente)}\n"
+        f"• Próximo lançamento: *{datetime.date.fromisoformat(recorrente['proxima']).strftime('%d/%m/%Y')}*",
+        parse_mode='Markdown'
+    )
+    return None
+
+# Função para listar as recorrências do usuário: /recorrentes
+async def comando_recorrentes(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    dados = carregar_dados_usuario(update.effective_user.id)
+    await update.message.reply_text(formatar_recorrentes(dados), parse_mode='Markdown', reply_markup=criar_teclado_recorrentes(dados))
+    return None
+
+# Função para remover uma recorrência pelo botão da lista
+async def remover_recorrente(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    query = update.callback_query
+    await query.answer()
+    
+    user_id = update.effective_user.id
+    dados = carregar_dados_usuario(user_id)
+    recorrente_id = query.data[len('rem_recorrente_'):]
+    dados['recorrentes'] = [recorrente for recorrente in dados['recorrentes'] if recorrente['id'] != recorrente_id]
+    salvar_dados_usuario(user_id, dados)
+    atualizar_recorrentes_usuario(user_id, dados)
+    
+    await query.edit_message_text(formatar_recorrentes(dados), parse_mode='Markdown', reply_markup=criar_teclado_recorrentes(dados))
+    return None
+
+# Função para mostrar histórico
+async def mostrar_historico(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    query = update.callback_query
+    await query.answer()
+    
+    logger.info("Iniciando mostrar_historico")
+    
+    user_id = update.effective_user.id
+    dados = carregar_dados_usuario(user_id)
+    
+    # Obter as últimas 10 transações (ou menos, se houver menos)
+    transacoes = dados['transacoes'][-10:]
     transacoes.reverse()  # Mais recentes primeiro
     
     if not transacoes:
         logger.info("Nenhuma transação encontrada")
         await query.edit_message_text(
             f"{EMOJI['info']} Não há transações registradas ainda.",
-            reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton(f"{EMOJI['voltar']} Voltar", callback_data='voltar_menu')]])
+            reply_markup=criar_teclado_botao('voltar', 'Voltar', 'voltar_menu')
         )
         return
     
@@ -785,25 +2251,16 @@ async def mostrar_historico(update: Update, context: ContextTypes.DEFAULT_TYPE):
         tipo_emoji = EMOJI['entrada'] if t['tipo'] == 'entrada' else EMOJI['saida']
         valor_formatado = formatar_valor(t['valor'])
         
-        texto += f"{tipo_emoji} *{t['data'].split()[0]}* - {t['categoria']}\n"
+        texto += f"{tipo_emoji} *{t['data'].split()[0]}* - {nome_categoria(dados, t['categoria_id'])}\n"
         texto += f"    {valor_formatado} - {t['descricao']}\n\n"
     
     texto += f"{EMOJI['saldo']} *Saldo Atual*: {formatar_valor(dados['saldo_atual'])}"
     
-    # Botões para navegação
-    keyboard = [
-        [
-            InlineKeyboardButton(f"{EMOJI['grafico']} Ver Gráfico", callback_data='grafico_historico'),
-            InlineKeyboardButton(f"{EMOJI['exportar']} Exportar", callback_data='exportar_historico')
-        ],
-        [InlineKeyboardButton(f"{EMOJI['voltar']} Voltar", callback_data='voltar_menu')]
-    ]
-    
     logger.info("Enviando mensagem com histórico")
     await query.edit_message_text(
         texto,
         parse_mode='Markdown',
-        reply_markup=InlineKeyboardMarkup(keyboard)
+        reply_markup=criar_menu_historico()
     )
 
 # Função para exportar histórico
@@ -824,7 +2281,7 @@ async def exportar_historico(update: Update, context: ContextTypes.DEFAULT_TYPE)
         logger.info("Nenhuma transação para exportar")
         await query.edit_message_text(
             f"{EMOJI['info']} Não há transações para exportar.",
-            reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton(f"{EMOJI['voltar']} Voltar", callback_data='voltar_menu')]])
+            reply_markup=criar_teclado_botao('voltar', 'Voltar', 'voltar_menu')
         )
         return
     
@@ -837,7 +2294,7 @@ async def exportar_historico(update: Update, context: ContextTypes.DEFAULT_TYPE)
         
         for t in transacoes:
             valor_str = str(t['valor']).replace('.', ',')
-            linha = f"{t['tipo']},{t['data']},{t['categoria']},{valor_str},\"{t['descricao']}\"\n"
+            linha = f"{t['tipo']},{t['data']},{nome_categoria(dados, t['categoria_id'])},{valor_str},\"{t['descricao']}\"\n"
             output.write(linha.encode('utf-8'))
         
         output.seek(0)
@@ -856,14 +2313,14 @@ async def exportar_historico(update: Update, context: ContextTypes.DEFAULT_TYPE)
         # Atualizar mensagem
         await query.edit_message_text(
             f"{EMOJI['sucesso']} Histórico exportado com sucesso!",
-            reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton(f"{EMOJI['voltar']} Voltar", callback_data='voltar_menu')]])
+            reply_markup=criar_teclado_botao('voltar', 'Voltar', 'voltar_menu')
         )
         
     except Exception as e:
         logger.error(f"Erro ao exportar histórico: {str(e)}")
         await query.edit_message_text(
             f"{EMOJI['erro']} Ocorreu um erro ao exportar o histórico. Por favor, tente novamente.",
-            reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton(f"{EMOJI['voltar']} Voltar", callback_data='voltar_menu')]])
+            reply_markup=criar_teclado_botao('voltar', 'Voltar', 'voltar_menu')
         )
     
     return MENU_PRINCIPAL
@@ -883,7 +2340,7 @@ async def mostrar_grafico_historico(update: Update, context: ContextTypes.DEFAUL
         logger.info("Transações insuficientes para gerar gráfico")
         await query.edit_message_text(
             f"{EMOJI['info']} Não há transações suficientes para gerar um gráfico.",
-            reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton(f"{EMOJI['voltar']} Voltar", callback_data='voltar_menu')]])
+            reply_markup=criar_teclado_botao('voltar', 'Voltar', 'voltar_menu')
         )
         return
     
@@ -891,26 +2348,20 @@ async def mostrar_grafico_historico(update: Update, context: ContextTypes.DEFAUL
     
     try:
         # Criar DataFrame para análise
-        df = pd.DataFrame(dados['transacoes'])
+        df = criar_dataframe_transacoes(dados['transacoes'], mapa_nomes_categorias(dados), com_descricao=False)
         
         # Converter datas
         df['data'] = pd.to_datetime(df['data'], format='%d/%m/%Y %H:%M:%S')
         df['date_only'] = df['data'].dt.date
         
-        # Separar entradas e saídas
-        entradas = df[df['tipo'] == 'entrada'].copy()
+        # Separar as saídas (usadas no gráfico de categorias)
         saidas = df[df['tipo'] == 'saida'].copy()
         
-        # Agrupar por data
-        if not entradas.empty:
-            entradas_por_data = entradas.groupby('date_only')['valor'].sum()
-        else:
-            entradas_por_data = pd.Series()
-        
-        if not saidas.empty:
-            saidas_por_data = saidas.groupby('date_only')['valor'].sum()
-        else:
-            saidas_por_data = pd.Series()
+        # Agrupar por data (em semanas ou meses se o histórico for longo)
+        fluxo = df.groupby(['date_only', 'tipo'])['valor'].sum().unstack(fill_value=0)
+        fluxo = fluxo.reindex(columns=['entrada', 'saida'], fill_value=0)
+        fluxo, agrupamento = agrupar_fluxo(fluxo)
+        marcador = marcador_linha(len(fluxo))
         
         # Criar figura
         plt.figure(figsize=(10, 6))
@@ -919,13 +2370,13 @@ async def mostrar_grafico_historico(update: Update, context: ContextTypes.DEFAUL
         plt.style.use('ggplot')
         
         # Plotar gráfico
-        if not entradas_por_data.empty:
-            plt.plot(entradas_por_data.index, entradas_por_data.values, 'g-', linewidth=2.5, marker='o', markersize=6, label='Entradas')
+        if fluxo['entrada'].any():
+            plt.plot(fluxo.index, fluxo['entrada'].values, 'g-', linewidth=2.5, marker=marcador, markersize=6, label='Entradas')
         
-        if not saidas_por_data.empty:
-            plt.plot(saidas_por_data.index, saidas_por_data.values, 'r-', linewidth=2.5, marker='o', markersize=6, label='Saídas')
+        if fluxo['saida'].any():
+            plt.plot(fluxo.index, fluxo['saida'].values, 'r-', linewidth=2.5, marker=marcador, markersize=6, label='Saídas')
         
-        plt.title('Fluxo de Caixa - Últimos Dias', fontsize=16, fontweight='bold')
+        plt.title(f'Fluxo de Caixa {agrupamento}', fontsize=16, fontweight='bold')
         plt.xlabel('Data', fontsize=12)
         plt.ylabel('Valor (R$)', fontsize=12)
         plt.grid(True, alpha=0.3)
@@ -941,17 +2392,9 @@ async def mostrar_grafico_historico(update: Update, context: ContextTypes.DEFAUL
         plt.tight_layout()
         
         # Salvar em memória
-        buf = BytesIO()
-        plt.savefig(buf, format='png', dpi=100)
-        buf.seek(0)
+        buf = salvar_grafico('historico_fluxo_caixa')
         
-        logger.info("Enviando primeiro gráfico")
-        # Enviar primeiro gráfico
-        await context.bot.send_photo(
-            chat_id=update.effective_chat.id,
-            photo=buf,
-            caption=f"{EMOJI['grafico']} Gráfico de Fluxo de Caixa por Dia"
-        )
+        fotos = [(buf, f"{EMOJI['grafico']} Gráfico de Fluxo de Caixa {agrupamento}")]
         
         # Criar um gráfico adicional de categorias
         plt.figure(figsize=(10, 6))
@@ -968,30 +2411,24 @@ async def mostrar_grafico_historico(update: Update, context: ContextTypes.DEFAUL
             plt.title('Distribuição de Gastos por Categoria', fontsize=16, fontweight='bold')
             
             # Salvar em memória
-            buf2 = BytesIO()
-            plt.tight_layout()
-            plt.savefig(buf2, format='png', dpi=100)
-            buf2.seek(0)
+            buf2 = salvar_grafico('historico_categorias')
             
-            logger.info("Enviando segundo gráfico")
-            # Enviar segundo gráfico
-            await context.bot.send_photo(
-                chat_id=update.effective_chat.id,
-                photo=buf2,
-                caption=f"{EMOJI['grafico']} Distribuição de Gastos por Categoria"
-            )
+            fotos.append((buf2, f"{EMOJI['grafico']} Distribuição de Gastos por Categoria"))
+        
+        logger.info(f"Enviando {len(fotos)} gráficos")
+        await enviar_fotos(context, update.effective_chat.id, fotos)
         
         # Voltar ao menu
         await query.edit_message_text(
             f"{EMOJI['sucesso']} Gráficos gerados com sucesso!",
-            reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton(f"{EMOJI['voltar']} Voltar", callback_data='voltar_menu')]])
+            reply_markup=criar_teclado_botao('voltar', 'Voltar', 'voltar_menu')
         )
         
     except Exception as e:
         logger.error(f"Erro ao gerar gráficos: {str(e)}")
         await query.edit_message_text(
             f"{EMOJI['erro']} Ocorreu um erro ao gerar os gráficos. Por favor, tente novamente.",
-            reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton(f"{EMOJI['voltar']} Voltar", callback_data='voltar_menu')]])
+            reply_markup=criar_teclado_botao('voltar', 'Voltar', 'voltar_menu')
         )
     
     return MENU_PRINCIPAL
@@ -1001,15 +2438,12 @@ async def callback_relatorios(update: Update, context: ContextTypes.DEFAULT_TYPE
     query = update.callback_query
     await query.answer()
     
-    user_id = update.effective_user.id
-    dados = carregar_dados_usuario(user_id)
     opcao = query.data
     
     if opcao == 'voltar_menu':
         return await menu_principal(update, context)
     
     hoje = datetime.datetime.now()
-    transacoes = dados['transacoes']
     
     # Definir período com base na opção selecionada
     if opcao == 'relatorio_dia':
@@ -1030,6 +2464,16 @@ async def callback_relatorios(update: Update, context: ContextTypes.DEFAULT_TYPE
         data_inicio, data_fim = obter_datas_mes(hoje.year, hoje.month)
         titulo = f"Relatório do Mês de {calendar.month_name[hoje.month]} de {hoje.year}"
         
+    elif opcao in ('relatorio_comparativo', 'relatorio_12_meses'):
+        # Comparativos a partir dos totais mensais (sem percorrer as transações)
+        dados = carregar_dados_usuario(update.effective_user.id)
+        if opcao == 'relatorio_comparativo':
+            texto = montar_comparativo_mensal(dados, hoje.year, hoje.month)
+        else:
+            texto = montar_comparativo_12_meses(dados, hoje.year, hoje.month)
+        await query.edit_message_text(texto, parse_mode='Markdown', reply_markup=criar_menu_comparativos())
+        return RELATORIO
+        
     elif opcao == 'relatorio_personalizado':
         # Solicitar período personalizado
         await query.edit_message_text(
@@ -1037,13 +2481,13 @@ async def callback_relatorios(update: Update, context: ContextTypes.DEFAULT_TYPE
             f"Para gerar um relatório personalizado, envie as datas de início e fim no formato DD/MM/AAAA - DD/MM/AAAA\n\n"
             f"Exemplo: 01/05/2025 - 15/05/2025",
             parse_mode='Markdown',
-            reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton(f"{EMOJI['voltar']} Voltar", callback_data='voltar_menu')]])
+            reply_markup=criar_teclado_botao('voltar', 'Voltar', 'voltar_menu')
         )
         return ESCOLHER_PERIODO_RELATORIO
     
     if opcao != 'relatorio_personalizado':
-        # Gerar relatório baseado no período selecionado
-        await gerar_relatorio(update, context, data_inicio, data_fim, titulo)
+        # Gerar relatório baseado no período selecionado (períodos padrão ficam em cache)
+        await gerar_relatorio(update, context, data_inicio, data_fim, titulo, opcao=opcao)
     
     return RELATORIO
 
@@ -1082,25 +2526,153 @@ async def escolher_periodo_relatorio(update: Update, context: ContextTypes.DEFAU
         await update.message.reply_text(
             f"{EMOJI['erro']} Formato de data inválido. Por favor, use o formato DD/MM/AAAA - DD/MM/AAAA\n\n"
             f"Exemplo: 01/05/2025 - 15/05/2025",
-            reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton(f"{EMOJI['voltar']} Voltar", callback_data='voltar_menu')]])
+            reply_markup=criar_teclado_botao('voltar', 'Voltar', 'voltar_menu')
         )
         return ESCOLHER_PERIODO_RELATORIO
 
-# Função para gerar relatório
-async def gerar_relatorio(update: Update, context, data_inicio, data_fim, titulo, is_message=False):
+# Função para obter a impressão do que um relatório usa: revisão de cada dia do período, categorias e metas
+def impressao_relatorio(dados, data_inicio, data_fim):
+    revisoes = []
+    dia = data_inicio.date()
+    # O relatório do mês atual inclui a previsão, que lê os dias da janela de histórico antes do período
+    hoje = datetime.datetime.now()
+    primeiro_dia_mes, ultimo_dia_mes = obter_datas_mes(hoje.year, hoje.month)
+    if data_inicio == primeiro_dia_mes and data_fim.date() == ultimo_dia_mes.date():
+        dia = min(dia, hoje.date() - datetime.timedelta(days=DIAS_HISTORICO_PREVISAO))
+    while dia <= data_fim.date():
+        totais = dados['totais_diarios'].get(dia.isoformat())
+        revisoes.append(None if totais is None else totais.get('revisao', 0))
+        dia += datetime.timedelta(days=1)
+    metas = dados.get('metas', {})
+    return (dados.get('versao_categorias', 0), metas.get('economia_mensal', 0), metas.get('limite_gastos', 0), tuple(revisoes))
+
+# Função para descartar os relatórios em cache que mudaram com a gravação dos dados do usuário
+def revalidar_cache_relatorios(user_id, dados):
+    relatorios = _cache_relatorios.get(user_id)
+    if not relatorios:
+        return
+    for opcao, (data_inicio, data_fim, impressao, _) in list(relatorios.items()):
+        if impressao_relatorio(dados, data_inicio, data_fim) != impressao:
+            del relatorios[opcao]
+
+# Função para obter um relatório de período padrão do cache (None se não houver um válido)
+def obter_relatorio_em_cache(user_id, opcao, data_inicio, data_fim):
+    em_cache = _cache_relatorios.get(user_id, {}).get(opcao)
+    # As metas e a previsão de fim de mês dependem do dia, então o relatório só vale no dia em que foi gerado
+    if em_cache is not None and em_cache[0] == data_inicio and em_cache[1] == data_fim and \
+            em_cache[3]['dados'].get('gerado_em') == datetime.date.today():
+        _acessos_cache_relatorios['acerto'] += 1
+        _cache_relatorios.move_to_end(user_id)
+        return em_cache[3]
+    _acessos_cache_relatorios['falha'] += 1
+    return None
+
+# Função para guardar um relatório de período padrão no cache
+def guardar_relatorio_em_cache(user_id, opcao, dados, relatorio):
+    data_inicio, data_fim = relatorio['dados']['periodo']
+    _cache_relatorios.setdefault(user_id, {})[opcao] = (data_inicio, data_fim, impressao_relatorio(dados, data_inicio, data_fim), relatorio)
+    _cache_relatorios.move_to_end(user_id)
+    if len(_cache_relatorios) > LIMITE_CACHE_RELATORIOS:
+        _cache_relatorios.popitem(last=False)
+
+# Função para gerar relatório (opcao identifica os períodos padrão, que usam o cache)
+async def gerar_relatorio(update: Update, context, data_inicio, data_fim, titulo, is_message=False, opcao=None):
     user_id = update.effective_user.id
-    dados = carregar_dados_usuario(user_id)
     
-    # Converter strings de data para datetime
-    transacoes_filtradas = []
-    for t in dados['transacoes']:
-        try:
-            data_transacao = datetime.datetime.strptime(t['data'], "%d/%m/%Y %H:%M:%S")
-            if data_inicio <= data_transacao <= data_fim:
-                transacoes_filtradas.append(t)
-        except Exception:
-            # Ignorar transações com formato de data inválido
-            continue
+    relatorio = obter_relatorio_em_cache(user_id, opcao, data_inicio, data_fim) if opcao else None
+    if relatorio is None:
+        dados = carregar_dados_usuario(user_id)
+        relatorio = montar_relatorio(dados, data_inicio, data_fim, titulo)
+        if opcao:
+            guardar_relatorio_em_cache(user_id, opcao, dados, relatorio)
+    
+    # Armazenar dados para uso posterior
+    context.user_data['relatorio_atual'] = relatorio['dados']
+    
+    # Enviar relatório
+    if is_message:
+        await update.message.reply_text(
+            relatorio['texto'],
+            parse_mode='Markdown',
+            reply_markup=criar_menu_resultado_relatorio()
+        )
+    else:
+        query = update.callback_query
+        await query.edit_message_text(
+            relatorio['texto'],
+            parse_mode='Markdown',
+            reply_markup=criar_menu_resultado_relatorio()
+        )
+    
+    return RELATORIO
+
+# Previsão de fim de mês a partir dos totais diários dos últimos dias completos. As saídas seguem uma tendência
+# linear com ajuste por dia da semana; as entradas (salário, vendas fechadas no mesmo dia do mês) repetem a
+# média do que entrou nos mesmos dias do mês nos meses anteriores.
+DIAS_HISTORICO_PREVISAO = 90
+DIAS_MINIMOS_PREVISAO = 14  # com menos histórico que isso, não há previsão
+
+# Função para prever as entradas e saídas até o fim do mês (None se o histórico for curto demais).
+# Hoje conta pelo que já foi registrado; a previsão cobre só os dias seguintes.
+def prever_fim_do_mes(dados, hoje=None):
+    hoje = hoje or datetime.date.today()
+    dias_restantes = calendar.monthrange(hoje.year, hoje.month)[1] - hoje.day
+    
+    inicio = hoje - datetime.timedelta(days=DIAS_HISTORICO_PREVISAO)
+    entradas = np.zeros(DIAS_HISTORICO_PREVISAO)
+    saidas = np.zeros(DIAS_HISTORICO_PREVISAO)
+    totais_diarios = dados['totais_diarios']
+    for indice in range(DIAS_HISTORICO_PREVISAO):
+        totais = totais_diarios.get((inicio + datetime.timedelta(days=indice)).isoformat())
+        if totais is not None:
+            entradas[indice] = totais['entrada']
+            saidas[indice] = totais['saida']
+    
+    # Os dias antes do primeiro registro não entram no ajuste (o usuário ainda não usava o bot)
+    com_registro = np.flatnonzero((entradas != 0) | (saidas != 0))
+    if not len(com_registro) or DIAS_HISTORICO_PREVISAO - com_registro[0] < DIAS_MINIMOS_PREVISAO:
+        return None
+    primeiro = com_registro[0]
+    dias = np.arange(primeiro, DIAS_HISTORICO_PREVISAO)
+    datas = np.datetime64(inicio) + dias
+    
+    # Saídas: tendência linear mais a média dos resíduos em cada dia da semana
+    saidas = saidas[primeiro:]
+    dias_semana = (dias + inicio.weekday()) % 7
+    inclinacao, intercepto = np.polyfit(dias, saidas, 1)
+    residuos = saidas - (intercepto + inclinacao * dias)
+    ajuste_semanal = np.bincount(dias_semana, weights=residuos, minlength=7) / np.maximum(np.bincount(dias_semana, minlength=7), 1)
+    futuros = np.arange(DIAS_HISTORICO_PREVISAO + 1, DIAS_HISTORICO_PREVISAO + 1 + dias_restantes)
+    saidas_restantes = np.clip(intercepto + inclinacao * futuros + ajuste_semanal[(futuros + inicio.weekday()) % 7], 0, None).sum()
+    
+    # Entradas: o que entrou depois do dia de hoje nos meses anteriores, em média por mês
+    dias_do_mes = (datas - datas.astype('datetime64[M]')).astype(int) + 1
+    depois_de_hoje = dias_do_mes > hoje.day
+    meses = len(np.unique(datas[depois_de_hoje].astype('datetime64[M]')))
+    entradas_restantes = entradas[primeiro:][depois_de_hoje].sum() / meses if meses and dias_restantes else 0.0
+    
+    totais_mes = dados['totais_mensais'].get(hoje.strftime("%Y-%m"), {})
+    return {
+        'dia': hoje,
+        'entradas': totais_mes.get('entrada', 0) + float(entradas_restantes),
+        'saidas': totais_mes.get('saida', 0) + float(saidas_restantes),
+        'saldo': dados['saldo_atual'] + float(entradas_restantes - saidas_restantes),
+        'saidas_ate_agora': totais_mes.get('saida', 0)
+    }
+
+# Função para montar o texto da previsão de fim de mês
+def formatar_previsao(previsao, limite_gastos):
+    texto = f"{EMOJI['previsao']} *Previsão para o Fim do Mês*\n"
+    texto += f"• Saídas: *{formatar_valor(previsao['saidas'])}* (até agora {formatar_valor(previsao['saidas_ate_agora'])})\n"
+    texto += f"• Entradas: *{formatar_valor(previsao['entradas'])}*\n"
+    texto += f"• Saldo no fim do mês: *{formatar_valor(previsao['saldo'])}*\n"
+    if limite_gastos > 0 and previsao['saidas'] > limite_gastos:
+        texto += f"{EMOJI['alerta']} Neste ritmo, seus gastos devem passar do limite de {formatar_valor(limite_gastos)}\n"
+    return texto + "\n"
+
+# Função para montar o texto do relatório e os dados usados na exportação e no gráfico
+def montar_relatorio(dados, data_inicio, data_fim, titulo):
+    transacoes_filtradas = filtrar_transacoes_periodo(dados['transacoes'], data_inicio, data_fim)
     
     # Calcular totais
     total_entradas = sum(t['valor'] for t in transacoes_filtradas if t['tipo'] == 'entrada')
@@ -1111,11 +2683,13 @@ async def gerar_relatorio(update: Update, context, data_inicio, data_fim, titulo
     categorias_entrada = {}
     categorias_saida = {}
     
+    nomes_categorias = mapa_nomes_categorias(dados)
     for t in transacoes_filtradas:
+        categoria = nomes_categorias.get(t['categoria_id'], "Outro")
         if t['tipo'] == 'entrada':
-            categorias_entrada[t['categoria']] = categorias_entrada.get(t['categoria'], 0) + t['valor']
+            categorias_entrada[categoria] = categorias_entrada.get(categoria, 0) + t['valor']
         else:
-            categorias_saida[t['categoria']] = categorias_saida.get(t['categoria'], 0) + t['valor']
+            categorias_saida[categoria] = categorias_saida.get(categoria, 0) + t['valor']
     
     # Preparar texto do relatório
     texto = f"{EMOJI['relatorio']} *{titulo}*\n\n"
@@ -1150,6 +2724,13 @@ async def gerar_relatorio(update: Update, context, data_inicio, data_fim, titulo
             texto += f"• Gastos: *{formatar_valor(total_saidas)}*\n"
             texto += f"• Utilizado: *{porcentagem_gasto:.1f}%*\n\n"
     
+    # Previsão de fim de mês no relatório do mês atual
+    previsao = None
+    if data_inicio == primeiro_dia_mes and data_fim.date() == ultimo_dia_mes.date():
+        previsao = prever_fim_do_mes(dados, hoje.date())
+        if previsao is not None:
+            texto += formatar_previsao(previsao, limite_gastos)
+    
     if categorias_entrada:
         texto += f"{EMOJI['entrada']} *Entradas por Categoria*\n"
         for cat, valor in sorted(categorias_entrada.items(), key=lambda x: x[1], reverse=True):
@@ -1166,40 +2747,99 @@ async def gerar_relatorio(update: Update, context, data_inicio, data_fim, titulo
     
     texto += f"Total de transações no período: *{len(transacoes_filtradas)}*"
     
-    # Botões para navegação
-    keyboard = [
-        [
-            InlineKeyboardButton(f"{EMOJI['grafico']} Ver Gráfico", callback_data='grafico_relatorio'),
-            InlineKeyboardButton(f"{EMOJI['exportar']} Exportar CSV", callback_data='exportar_relatorio')
-        ],
-        [InlineKeyboardButton(f"{EMOJI['voltar']} Voltar", callback_data='voltar_menu')]
-    ]
-    
-    # Armazenar dados para uso posterior
-    context.user_data['relatorio_atual'] = {
-        'transacoes': transacoes_filtradas,
-        'periodo': (data_inicio, data_fim),
-        'titulo': titulo,
-        'total_entradas': total_entradas,
-        'total_saidas': total_saidas
+    return {
+        'texto': texto,
+        'dados': {
+            'transacoes': transacoes_filtradas,
+            'periodo': (data_inicio, data_fim),
+            'titulo': titulo,
+            'categorias': nomes_categorias,
+            'total_entradas': total_entradas,
+            'total_saidas': total_saidas,
+            'gerado_em': hoje.date()
+        }
     }
+
+# Função para obter o ano e o mês que ficam "meses" antes de um mês
+def mes_anterior(ano, mes, meses=1):
+    indice = ano * 12 + (mes - 1) - meses
+    return indice // 12, indice % 12 + 1
+
+# Função para obter os totais de um mês (mês sem transações tem totais zerados)
+def obter_totais_mes(dados, ano, mes):
+    return dados['totais_mensais'].get(f"{ano:04d}-{mes:02d}", {
+        'entrada': 0, 'saida': 0, 'quantidade': 0, 'categorias': {'entrada': {}, 'saida': {}}
+    })
+
+# Função para somar os totais de um mês por nome atual de categoria (categorias removidas contam na substituta)
+def totais_categorias_mes(totais, tipo, nomes_categorias):
+    por_nome = {}
+    for cat_id, valor in totais['categorias'][tipo].items():
+        nome = nomes_categorias.get(cat_id, "Outro")
+        por_nome[nome] = por_nome.get(nome, 0) + valor
+    return por_nome
+
+# Função para formatar a variação entre dois valores (diferença e percentual)
+def formatar_variacao(atual, anterior):
+    diferenca = atual - anterior
+    texto = f"{'+' if diferenca >= 0 else '-'}{formatar_valor(abs(diferenca))}"
+    if anterior:
+        texto += f" ({diferenca / abs(anterior) * 100:+.1f}%)"
+    return texto
+
+# Função para montar o comparativo do mês com o mês anterior e o mesmo mês do ano anterior
+def montar_comparativo_mensal(dados, ano, mes):
+    periodos = [(ano, mes), mes_anterior(ano, mes), mes_anterior(ano, mes, 12)]
+    atual, anterior, ano_anterior = [obter_totais_mes(dados, a, m) for a, m in periodos]
+    rotulos = [f"{m:02d}/{a}" for a, m in periodos]
     
-    # Enviar relatório
-    if is_message:
-        await update.message.reply_text(
-            texto,
-            parse_mode='Markdown',
-            reply_markup=InlineKeyboardMarkup(keyboard)
-        )
-    else:
-        query = update.callback_query
-        await query.edit_message_text(
-            texto,
-            parse_mode='Markdown',
-            reply_markup=InlineKeyboardMarkup(keyboard)
-        )
+    texto = f"{EMOJI['relatorio']} *Comparativo de {calendar.month_name[mes]} de {ano}*\n"
+    texto += f"Comparado com {rotulos[1]} (mês anterior) e {rotulos[2]} (ano anterior)\n\n"
     
-    return RELATORIO
+    texto += f"{EMOJI['saldo']} *Resumo Financeiro*\n"
+    for nome, chave in (("Entradas", 'entrada'), ("Saídas", 'saida'), ("Saldo", None)):
+        valores = [t['entrada'] - t['saida'] if chave is None else t[chave] for t in (atual, anterior, ano_anterior)]
+        texto += f"• {nome}: *{formatar_valor(valores[0])}*\n"
+        texto += f"  vs {rotulos[1]}: {formatar_variacao(valores[0], valores[1])}\n"
+        texto += f"  vs {rotulos[2]}: {formatar_variacao(valores[0], valores[2])}\n"
+    texto += "\n"
+    
+    nomes_categorias = mapa_nomes_categorias(dados)
+    for tipo, titulo in (('saida', "Saídas por Categoria"), ('entrada', "Entradas por Categoria")):
+        por_periodo = [totais_categorias_mes(t, tipo, nomes_categorias) for t in (atual, anterior, ano_anterior)]
+        nomes = set(por_periodo[0]) | set(por_periodo[1])
+        if not nomes:
+            continue
+        
+        texto += f"{EMOJI[tipo]} *{titulo}*\n"
+        for nome in sorted(nomes, key=lambda n: por_periodo[0].get(n, 0), reverse=True):
+            valores = [categorias.get(nome, 0) for categorias in por_periodo]
+            texto += f"• {nome}: *{formatar_valor(valores[0])}*\n"
+            texto += f"  mês: {formatar_variacao(valores[0], valores[1])} · ano: {formatar_variacao(valores[0], valores[2])}\n"
+        texto += "\n"
+    
+    texto += f"Transações no mês: *{atual['quantidade']}* (mês anterior: {anterior['quantidade']})"
+    return texto
+
+# Função para montar o comparativo dos últimos 12 meses (um total mensal por mês)
+def montar_comparativo_12_meses(dados, ano, mes):
+    meses = [mes_anterior(ano, mes, n) for n in range(11, -1, -1)]
+    totais = [obter_totais_mes(dados, a, m) for a, m in meses]
+    
+    texto = f"{EMOJI['relatorio']} *Últimos 12 Meses*\n\n"
+    for indice, ((a, m), total) in enumerate(zip(meses, totais)):
+        saldo = total['entrada'] - total['saida']
+        texto += f"*{m:02d}/{a}*: {EMOJI['entrada']} {formatar_valor(total['entrada'])} · " \
+                 f"{EMOJI['saida']} {formatar_valor(total['saida'])} · {EMOJI['saldo']} {formatar_valor(saldo)}\n"
+        if indice > 0 and totais[indice - 1]['saida']:
+            texto += f"  Saídas vs mês anterior: {formatar_variacao(total['saida'], totais[indice - 1]['saida'])}\n"
+    
+    total_entradas = sum(t['entrada'] for t in totais)
+    total_saidas = sum(t['saida'] for t in totais)
+    texto += f"\n• Média mensal de entradas: *{formatar_valor(total_entradas / 12)}*\n"
+    texto += f"• Média mensal de saídas: *{formatar_valor(total_saidas / 12)}*\n"
+    texto += f"• Saldo acumulado: *{formatar_valor(total_entradas - total_saidas)}*"
+    return texto
 
 # Função para exportar relatório como CSV
 async def exportar_relatorio(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -1209,7 +2849,7 @@ async def exportar_relatorio(update: Update, context: ContextTypes.DEFAULT_TYPE)
     if 'relatorio_atual' not in context.user_data:
         await query.edit_message_text(
             f"{EMOJI['erro']} Não há relatório para exportar. Por favor, gere um relatório primeiro.",
-            reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton(f"{EMOJI['voltar']} Voltar", callback_data='voltar_menu')]])
+            reply_markup=criar_teclado_botao('voltar', 'Voltar', 'voltar_menu')
         )
         return MENU_PRINCIPAL
     
@@ -1220,7 +2860,7 @@ async def exportar_relatorio(update: Update, context: ContextTypes.DEFAULT_TYPE)
     if not transacoes:
         await query.edit_message_text(
             f"{EMOJI['info']} Não há transações para exportar neste período.",
-            reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton(f"{EMOJI['voltar']} Voltar", callback_data='voltar_relatorios')]])
+            reply_markup=criar_teclado_botao('voltar', 'Voltar', 'voltar_relatorios')
         )
         return RELATORIO
     
@@ -1228,9 +2868,11 @@ async def exportar_relatorio(update: Update, context: ContextTypes.DEFAULT_TYPE)
     output = BytesIO()
     output.write("Tipo,Data,Categoria,Valor,Descrição\n".encode('utf-8'))
     
+    nomes_categorias = relatorio['categorias']
     for t in transacoes:
         valor_str = str(t['valor']).replace('.', ',')
-        linha = f"{t['tipo']},{t['data']},{t['categoria']},{valor_str},\"{t['descricao']}\"\n"
+        categoria = nomes_categorias.get(t['categoria_id'], "Outro")
+        linha = f"{t['tipo']},{t['data']},{categoria},{valor_str},\"{t['descricao']}\"\n"
         output.write(linha.encode('utf-8'))
     
     output.seek(0)
@@ -1262,7 +2904,7 @@ async def grafico_relatorio(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if 'relatorio_atual' not in context.user_data:
         await query.edit_message_text(
             f"{EMOJI['erro']} Não há relatório para visualizar. Por favor, gere um relatório primeiro.",
-            reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton(f"{EMOJI['voltar']} Voltar", callback_data='voltar_menu')]])
+            reply_markup=criar_teclado_botao('voltar', 'Voltar', 'voltar_menu')
         )
         return MENU_PRINCIPAL
     
@@ -1273,12 +2915,12 @@ async def grafico_relatorio(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if not transacoes:
         await query.edit_message_text(
             f"{EMOJI['info']} Não há transações para visualizar neste período.",
-            reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton(f"{EMOJI['voltar']} Voltar", callback_data='voltar_relatorios')]])
+            reply_markup=criar_teclado_botao('voltar', 'Voltar', 'voltar_relatorios')
         )
         return RELATORIO
     
     # Criar DataFrame para análise
-    df = pd.DataFrame(transacoes)
+    df = criar_dataframe_transacoes(transacoes, relatorio['categorias'])
     
     # Converter datas
     df['data'] = pd.to_datetime(df['data'], format='%d/%m/%Y %H:%M:%S')
@@ -1312,10 +2954,7 @@ async def grafico_relatorio(update: Update, context: ContextTypes.DEFAULT_TYPE):
     plt.gca().spines['bottom'].set_visible(False)
     
     # Salvar em memória
-    buf1 = BytesIO()
-    plt.tight_layout()
-    plt.savefig(buf1, format='png', dpi=100)
-    buf1.seek(0)
+    buf1 = salvar_grafico('relatorio_entradas_saidas')
     
     # 2. Gráfico de pizza para categorias de saída
     if saidas_total > 0:
@@ -1360,10 +2999,7 @@ async def grafico_relatorio(update: Update, context: ContextTypes.DEFAULT_TYPE):
         plt.title('Distribuição de Gastos por Categoria', fontsize=16, fontweight='bold')
         
         # Salvar em memória
-        buf2 = BytesIO()
-        plt.tight_layout()
-        plt.savefig(buf2, format='png', dpi=100)
-        buf2.seek(0)
+        buf2 = salvar_grafico('relatorio_categorias')
     else:
         buf2 = None
     
@@ -1371,24 +3007,22 @@ async def grafico_relatorio(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if len(df['date_only'].unique()) > 1:
         plt.figure(figsize=(10, 6))
         
-        # Agrupar por data
+        # Agrupar por data (em semanas ou meses se o período for longo)
         fluxo_diario = df.groupby(['date_only', 'tipo'])['valor'].sum().unstack().fillna(0)
+        fluxo_diario = fluxo_diario.reindex(columns=['entrada', 'saida'], fill_value=0)
+        fluxo_diario, agrupamento = agrupar_fluxo(fluxo_diario)
         
-        # Calcular saldo diário acumulado
-        if 'entrada' not in fluxo_diario.columns:
-            fluxo_diario['entrada'] = 0
-        if 'saida' not in fluxo_diario.columns:
-            fluxo_diario['saida'] = 0
-            
+        # Calcular saldo acumulado (no fim de cada dia, semana ou mês)
         fluxo_diario['saldo'] = fluxo_diario['entrada'] - fluxo_diario['saida']
         fluxo_diario['saldo_acumulado'] = fluxo_diario['saldo'].cumsum()
         
         # Plotar linhas
-        plt.plot(fluxo_diario.index, fluxo_diario['entrada'], 'g-', linewidth=2.5, marker='o', label='Entradas')
-        plt.plot(fluxo_diario.index, fluxo_diario['saida'], 'r-', linewidth=2.5, marker='o', label='Saídas')
-        plt.plot(fluxo_diario.index, fluxo_diario['saldo_acumulado'], 'b-', linewidth=2.5, marker='s', label='Saldo Acumulado')
+        marcador = marcador_linha(len(fluxo_diario))
+        plt.plot(fluxo_diario.index, fluxo_diario['entrada'], 'g-', linewidth=2.5, marker=marcador, label='Entradas')
+        plt.plot(fluxo_diario.index, fluxo_diario['saida'], 'r-', linewidth=2.5, marker=marcador, label='Saídas')
+        plt.plot(fluxo_diario.index, fluxo_diario['saldo_acumulado'], 'b-', linewidth=2.5, marker=marcador_linha(len(fluxo_diario), 's'), label='Saldo Acumulado')
         
-        plt.title('Fluxo de Caixa Diário', fontsize=16, fontweight='bold')
+        plt.title(f'Fluxo de Caixa {agrupamento}', fontsize=16, fontweight='bold')
         plt.xlabel('Data', fontsize=12)
         plt.ylabel('Valor (R$)', fontsize=12)
         plt.grid(True, alpha=0.3)
@@ -1398,10 +3032,7 @@ async def grafico_relatorio(update: Update, context: ContextTypes.DEFAULT_TYPE):
         plt.gcf().autofmt_xdate()
         
         # Salvar em memória
-        buf3 = BytesIO()
-        plt.tight_layout()
-        plt.savefig(buf3, format='png', dpi=100)
-        buf3.seek(0)
+        buf3 = salvar_grafico('relatorio_diario')
     else:
         buf3 = None
         
@@ -1410,6 +3041,7 @@ async def grafico_relatorio(update: Update, context: ContextTypes.DEFAULT_TYPE):
     
     # Agrupar por categoria e tipo
     categorias = df.groupby(['categoria', 'tipo'])['valor'].sum().unstack().fillna(0)
+    categorias = categorias.reindex(columns=['entrada', 'saida'], fill_value=0)
     
     # Ordenar por valor total
     categorias['total'] = categorias['entrada'] - categorias['saida']
@@ -1430,37 +3062,15 @@ async def grafico_relatorio(update: Update, context: ContextTypes.DEFAULT_TYPE):
     plt.grid(axis='x', alpha=0.3)
     
     # Salvar em memória
-    buf4 = BytesIO()
-    plt.tight_layout()
-    plt.savefig(buf4, format='png', dpi=100)
-    buf4.seek(0)
-    
-    # Enviar os gráficos
-    await context.bot.send_photo(
-        chat_id=update.effective_chat.id,
-        photo=buf1,
-        caption=f"{EMOJI['grafico']} Entradas vs Saídas - {titulo}"
-    )
-    
-    if buf2:
-        await context.bot.send_photo(
-            chat_id=update.effective_chat.id,
-            photo=buf2,
-            caption=f"{EMOJI['grafico']} Distribuição de Gastos por Categoria"
-        )
+    buf4 = salvar_grafico('relatorio_top_categorias')
     
-    if buf3:
-        await context.bot.send_photo(
-            chat_id=update.effective_chat.id,
-            photo=buf3,
-            caption=f"{EMOJI['grafico']} Fluxo de Caixa Diário"
-        )
-        
-    await context.bot.send_photo(
-        chat_id=update.effective_chat.id,
-        photo=buf4,
-        caption=f"{EMOJI['grafico']} Top 10 Categorias por Movimentação"
-    )
+    # Enviar os gráficos em um único álbum
+    await enviar_fotos(context, update.effective_chat.id, [
+        (buf1, f"{EMOJI['grafico']} Entradas vs Saídas - {titulo}"),
+        (buf2, f"{EMOJI['grafico']} Distribuição de Gastos por Categoria"),
+        (buf3, f"{EMOJI['grafico']} Fluxo de Caixa Diário"),
+        (buf4, f"{EMOJI['grafico']} Top 10 Categorias por Movimentação")
+    ])
     
     # Atualizar mensagem
     await query.edit_message_text(
@@ -1478,22 +3088,10 @@ async def voltar_relatorios(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
     await query.answer()
     
-    keyboard = [
-        [
-            InlineKeyboardButton(f"{EMOJI['calendario']} Relatório do Dia", callback_data='relatorio_dia'),
-            InlineKeyboardButton(f"{EMOJI['calendario']} Relatório da Semana", callback_data='relatorio_semana')
-        ],
-        [
-            InlineKeyboardButton(f"{EMOJI['calendario']} Relatório do Mês", callback_data='relatorio_mes'),
-            InlineKeyboardButton(f"{EMOJI['lupa']} Relatório Personalizado", callback_data='relatorio_personalizado')
-        ],
-        [InlineKeyboardButton(f"{EMOJI['voltar']} Voltar", callback_data='voltar_menu')]
-    ]
-    
     await query.edit_message_text(
         f"{EMOJI['relatorio']} *Relatórios Financeiros*\n\nEscolha o tipo de relatório que deseja visualizar:",
         parse_mode='Markdown',
-        reply_markup=InlineKeyboardMarkup(keyboard)
+        reply_markup=criar_menu_relatorios()
     )
     
     return RELATORIO
@@ -1512,49 +3110,29 @@ async def preparar_fechamento_caixa(update: Update, context: ContextTypes.DEFAUL
     data_fim = hoje.replace(hour=23, minute=59, second=59, microsecond=999999)
     
     # Filtrar transações do dia
-    transacoes_dia = []
-    for t in dados['transacoes']:
-        try:
-            data_transacao = datetime.datetime.strptime(t['data'], "%d/%m/%Y %H:%M:%S")
-            if data_inicio <= data_transacao <= data_fim:
-                transacoes_dia.append(t)
-        except Exception as e:
-            logger.error(f"Erro ao processar data da transação: {str(e)}")
-            continue
+    transacoes_dia = filtrar_transacoes_periodo(dados['transacoes'], data_inicio, data_fim)
     
     logger.info(f"Encontradas {len(transacoes_dia)} transações no dia")
     
-    # Calcular totais
-    total_entradas = sum(t['valor'] for t in transacoes_dia if t['tipo'] == 'entrada')
-    total_saidas = sum(t['valor'] for t in transacoes_dia if t['tipo'] == 'saida')
-    saldo_dia = total_entradas - total_saidas
-    
     # Agrupar por categorias
     categorias_entrada = {}
     categorias_saida = {}
     
+    nomes_categorias = mapa_nomes_categorias(dados)
     for t in transacoes_dia:
+        categoria = nomes_categorias.get(t['categoria_id'], "Outro")
         if t['tipo'] == 'entrada':
-            categorias_entrada[t['categoria']] = categorias_entrada.get(t['categoria'], 0) + t['valor']
+            categorias_entrada[categoria] = categorias_entrada.get(categoria, 0) + t['valor']
         else:
-            categorias_saida[t['categoria']] = categorias_saida.get(t['categoria'], 0) + t['valor']
-    
-    # Armazenar dados para confirmação
-    context.user_data['fechamento'] = {
-        'data': obter_data_hoje(),
-        'saldo_inicial': dados['saldo_atual'] - saldo_dia,
-        'saldo_final': dados['saldo_atual'],
-        'total_entradas': total_entradas,
-        'total_saidas': total_saidas
-    }
+            categorias_saida[categoria] = categorias_saida.get(categoria, 0) + t['valor']
+    
+    # Armazenar dados para confirmação (os totais vêm dos totais diários)
+    fechamento = calcular_fechamento(user_id, dados, hoje)
+    context.user_data['fechamento'] = fechamento
     
     # Preparar texto de fechamento
     texto = f"{EMOJI['fechamento']} *Fechamento de Caixa*\n\n"
-    texto += f"{EMOJI['calendario']} Data: *{obter_data_hoje()}*\n\n"
-    texto += f"{EMOJI['saldo']} Saldo Inicial: *{formatar_valor(dados['saldo_atual'] - saldo_dia)}*\n"
-    texto += f"{EMOJI['entrada']} Total de Entradas: *{formatar_valor(total_entradas)}*\n"
-    texto += f"{EMOJI['saida']} Total de Saídas: *{formatar_valor(total_saidas)}*\n"
-    texto += f"{EMOJI['saldo']} Saldo Final: *{formatar_valor(dados['saldo_atual'])}*\n\n"
+    texto += formatar_resumo_fechamento(fechamento)
     
     if categorias_entrada:
         texto += f"{EMOJI['entrada']} *Entradas por Categoria*\n"
@@ -1600,7 +3178,7 @@ async def confirmar_fechamento_caixa(update: Update, context: ContextTypes.DEFAU
         logger.error(f"Callback inválido: {query.data}")
         await query.edit_message_text(
             f"{EMOJI['erro']} Erro ao processar o fechamento de caixa. Por favor, tente novamente.",
-            reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton(f"{EMOJI['voltar']} Voltar ao Menu", callback_data='voltar_menu')]])
+            reply_markup=criar_teclado_botao('voltar', 'Voltar ao Menu', 'voltar_menu')
         )
         return MENU_PRINCIPAL
     
@@ -1625,11 +3203,7 @@ async def confirmar_fechamento_caixa(update: Update, context: ContextTypes.DEFAU
         
         # Gerar relatório do fechamento
         texto = f"{EMOJI['sucesso']} *Fechamento de Caixa Realizado*\n\n"
-        texto += f"{EMOJI['calendario']} Data: *{fechamento['data']}*\n\n"
-        texto += f"{EMOJI['saldo']} Saldo Inicial: *{formatar_valor(fechamento['saldo_inicial'])}*\n"
-        texto += f"{EMOJI['entrada']} Total de Entradas: *{formatar_valor(fechamento['total_entradas'])}*\n"
-        texto += f"{EMOJI['saida']} Total de Saídas: *{formatar_valor(fechamento['total_saidas'])}*\n"
-        texto += f"{EMOJI['saldo']} Saldo Final: *{formatar_valor(fechamento['saldo_final'])}*\n\n"
+        texto += formatar_resumo_fechamento(fechamento)
         texto += "O fechamento de caixa foi registrado com sucesso!"
         
         # Criar um arquivo de comprovante
@@ -1651,7 +3225,7 @@ async def confirmar_fechamento_caixa(update: Update, context: ContextTypes.DEFAU
             f"O fechamento de caixa para *{fechamento['data']}* foi registrado com sucesso!\n\n"
             f"Saldo atual: *{formatar_valor(fechamento['saldo_final'])}*",
             parse_mode='Markdown',
-            reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton(f"{EMOJI['voltar']} Voltar ao Menu", callback_data='voltar_menu')]])
+            reply_markup=criar_teclado_botao('voltar', 'Voltar ao Menu', 'voltar_menu')
         )
         
         # Limpar dados temporários
@@ -1661,7 +3235,7 @@ async def confirmar_fechamento_caixa(update: Update, context: ContextTypes.DEFAU
         logger.error("Dados de fechamento não encontrados em context.user_data")
         await query.edit_message_text(
             f"{EMOJI['erro']} Erro ao processar o fechamento de caixa. Por favor, tente novamente.",
-            reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton(f"{EMOJI['voltar']} Voltar ao Menu", callback_data='voltar_menu')]])
+            reply_markup=criar_teclado_botao('voltar', 'Voltar ao Menu', 'voltar_menu')
         )
     
     return MENU_PRINCIPAL
@@ -1681,7 +3255,7 @@ async def callback_configuracoes(update: Update, context: ContextTypes.DEFAULT_T
             f"{EMOJI['adicionar']} *Adicionar Categoria de Entrada*\n\n"
             f"Digite o nome da nova categoria de entrada:",
             parse_mode='Markdown',
-            reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton(f"{EMOJI['voltar']} Voltar", callback_data='voltar_config')]])
+            reply_markup=criar_teclado_botao('voltar', 'Voltar', 'voltar_config')
         )
         context.user_data['add_categoria_tipo'] = 'entrada'
         return ADICIONAR_CATEGORIA
@@ -1691,7 +3265,7 @@ async def callback_configuracoes(update: Update, context: ContextTypes.DEFAULT_T
             f"{EMOJI['adicionar']} *Adicionar Categoria de Saída*\n\n"
             f"Digite o nome da nova categoria de saída:",
             parse_mode='Markdown',
-            reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton(f"{EMOJI['voltar']} Voltar", callback_data='voltar_config')]])
+            reply_markup=criar_teclado_botao('voltar', 'Voltar', 'voltar_config')
         )
         context.user_data['add_categoria_tipo'] = 'saida'
         return ADICIONAR_CATEGORIA
@@ -1699,52 +3273,24 @@ async def callback_configuracoes(update: Update, context: ContextTypes.DEFAULT_T
     elif opcao == 'editar_cat_entrada':
         user_id = update.effective_user.id
         dados = carregar_dados_usuario(user_id)
-        categorias = dados['categorias_entrada']
-        
-        keyboard = []
-        row = []
-        for i, cat in enumerate(categorias):
-            if cat != "Outro":  # Não permitir editar a categoria "Outro"
-                row.append(InlineKeyboardButton(f"{EMOJI['editar']} {cat}", callback_data=f"edit_cat_entrada_{cat}"))
-                
-                # Dois botões por linha
-                if len(row) == 2 or i == len(categorias) - 1:
-                    keyboard.append(row)
-                    row = []
-                    
-        keyboard.append([InlineKeyboardButton(f"{EMOJI['voltar']} Voltar", callback_data='voltar_config')])
         
         await query.edit_message_text(
             f"{EMOJI['editar']} *Editar Categoria de Entrada*\n\n"
             f"Selecione a categoria que deseja editar:",
             parse_mode='Markdown',
-            reply_markup=InlineKeyboardMarkup(keyboard)
+            reply_markup=criar_teclado_categorias(user_id, dados, 'entrada', 'editar')
         )
         return EDITAR_CATEGORIA
     
     elif opcao == 'editar_cat_saida':
         user_id = update.effective_user.id
         dados = carregar_dados_usuario(user_id)
-        categorias = dados['categorias_saida']
-        
-        keyboard = []
-        row = []
-        for i, cat in enumerate(categorias):
-            if cat != "Outro":  # Não permitir editar a categoria "Outro"
-                row.append(InlineKeyboardButton(f"{EMOJI['editar']} {cat}", callback_data=f"edit_cat_saida_{cat}"))
-                
-                # Dois botões por linha
-                if len(row) == 2 or i == len(categorias) - 1:
-                    keyboard.append(row)
-                    row = []
-                    
-        keyboard.append([InlineKeyboardButton(f"{EMOJI['voltar']} Voltar", callback_data='voltar_config')])
         
         await query.edit_message_text(
             f"{EMOJI['editar']} *Editar Categoria de Saída*\n\n"
             f"Selecione a categoria que deseja editar:",
             parse_mode='Markdown',
-            reply_markup=InlineKeyboardMarkup(keyboard)
+            reply_markup=criar_teclado_categorias(user_id, dados, 'saida', 'editar')
         )
         return EDITAR_CATEGORIA
     
@@ -1756,28 +3302,15 @@ async def callback_configuracoes(update: Update, context: ContextTypes.DEFAULT_T
         if len(categorias) <= 1:
             await query.edit_message_text(
                 f"{EMOJI['alerta']} Não é possível remover mais categorias de entrada. Deve haver pelo menos uma categoria.",
-                reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton(f"{EMOJI['voltar']} Voltar", callback_data='voltar_config')]])
+                reply_markup=criar_teclado_botao('voltar', 'Voltar', 'voltar_config')
             )
             return CONFIGURACOES
         
-        keyboard = []
-        row = []
-        for i, cat in enumerate(categorias):
-            if cat != "Outro":  # Não permitir remover a categoria "Outro"
-                row.append(InlineKeyboardButton(f"{EMOJI['remover']} {cat}", callback_data=f"rem_cat_entrada_{cat}"))
-                
-                # Dois botões por linha
-                if len(row) == 2 or i == len(categorias) - 1:
-                    keyboard.append(row)
-                    row = []
-                    
-        keyboard.append([InlineKeyboardButton(f"{EMOJI['voltar']} Voltar", callback_data='voltar_config')])
-        
         await query.edit_message_text(
             f"{EMOJI['remover']} *Remover Categoria de Entrada*\n\n"
             f"Selecione a categoria que deseja remover:",
             parse_mode='Markdown',
-            reply_markup=InlineKeyboardMarkup(keyboard)
+            reply_markup=criar_teclado_categorias(user_id, dados, 'entrada', 'remover')
         )
         return REMOVER_CATEGORIA
     
@@ -1789,28 +3322,15 @@ async def callback_configuracoes(update: Update, context: ContextTypes.DEFAULT_T
         if len(categorias) <= 1:
             await query.edit_message_text(
                 f"{EMOJI['alerta']} Não é possível remover mais categorias de saída. Deve haver pelo menos uma categoria.",
-                reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton(f"{EMOJI['voltar']} Voltar", callback_data='voltar_config')]])
+                reply_markup=criar_teclado_botao('voltar', 'Voltar', 'voltar_config')
             )
             return CONFIGURACOES
         
-        keyboard = []
-        row = []
-        for i, cat in enumerate(categorias):
-            if cat != "Outro":  # Não permitir remover a categoria "Outro"
-                row.append(InlineKeyboardButton(f"{EMOJI['remover']} {cat}", callback_data=f"rem_cat_saida_{cat}"))
-                
-                # Dois botões por linha
-                if len(row) == 2 or i == len(categorias) - 1:
-                    keyboard.append(row)
-                    row = []
-                    
-        keyboard.append([InlineKeyboardButton(f"{EMOJI['voltar']} Voltar", callback_data='voltar_config')])
-        
         await query.edit_message_text(
             f"{EMOJI['remover']} *Remover Categoria de Saída*\n\n"
             f"Selecione a categoria que deseja remover:",
             parse_mode='Markdown',
-            reply_markup=InlineKeyboardMarkup(keyboard)
+            reply_markup=criar_teclado_categorias(user_id, dados, 'saida', 'remover')
         )
         return REMOVER_CATEGORIA
     
@@ -1818,6 +3338,24 @@ async def callback_configuracoes(update: Update, context: ContextTypes.DEFAULT_T
         await exportar_todos_dados(update, context)
         return CONFIGURACOES
     
+    elif opcao == 'regras_categoria':
+        return await mostrar_regras(update, context)
+    
+    elif opcao == 'orcamentos':
+        return await mostrar_orcamentos(update, context)
+    
+    elif opcao == 'importar_extrato':
+        await query.edit_message_text(
+            f"{EMOJI['importar']} *Importar Extrato*\n\n"
+            f"Envie o arquivo do extrato bancário como documento:\n\n"
+            f"• *OFX*: exportado pelo internet banking\n"
+            f"• *CSV*: com colunas de data, descrição e valor (ou crédito/débito)\n\n"
+            f"Transações que já estão registradas são ignoradas. Você verá uma prévia antes de confirmar.",
+            parse_mode='Markdown',
+            reply_markup=criar_teclado_botao('voltar', 'Voltar', 'voltar_config')
+        )
+        return IMPORTAR_EXTRATO
+    
     elif opcao == 'config_notificacoes':
         # Configurar notificações
         user_id = update.effective_user.id
@@ -1828,27 +3366,15 @@ async def callback_configuracoes(update: Update, context: ContextTypes.DEFAULT_T
             'lembrete_diario': False
         })
         
-        keyboard = [
-            [InlineKeyboardButton(
-                f"{'✅' if notificacoes.get('alerta_limite', True) else '❌'} Alertas de Limite",
-                callback_data='toggle_alerta_limite'
-            )],
-            [InlineKeyboardButton(
-                f"{'✅' if notificacoes.get('lembrete_diario', False) else '❌'} Lembretes Diários",
-                callback_data='toggle_lembrete_diario'
-            )],
-            [InlineKeyboardButton(f"{EMOJI['voltar']} Voltar", callback_data='voltar_config')]
-        ]
-        
         await query.edit_message_text(
             f"{EMOJI['alerta']} *Configurações de Notificações*\n\n"
             f"Personalize como deseja receber notificações:",
             parse_mode='Markdown',
-            reply_markup=InlineKeyboardMarkup(keyboard)
+            reply_markup=teclado_notificacoes(notificacoes)
         )
         return CONFIGURACOES
     
-    elif opcao == 'toggle_alerta_limite' or opcao == 'toggle_lembrete_diario':
+    elif opcao in ('toggle_alerta_limite', 'toggle_alerta_meta_economia', 'toggle_lembrete_diario', 'toggle_fechamento_automatico', 'toggle_resumo_fechamento'):
         user_id = update.effective_user.id
         dados = carregar_dados_usuario(user_id)
         
@@ -1860,62 +3386,62 @@ async def callback_configuracoes(update: Update, context: ContextTypes.DEFAULT_T
         
         if opcao == 'toggle_alerta_limite':
             dados['notificacoes']['alerta_limite'] = not dados['notificacoes'].get('alerta_limite', True)
-        else:
+        elif opcao == 'toggle_alerta_meta_economia':
+            dados['notificacoes']['alerta_meta_economia'] = not dados['notificacoes'].get('alerta_meta_economia', True)
+        elif opcao == 'toggle_lembrete_diario':
             dados['notificacoes']['lembrete_diario'] = not dados['notificacoes'].get('lembrete_diario', False)
+        elif opcao == 'toggle_fechamento_automatico':
+            dados['notificacoes']['fechamento_automatico'] = not dados['notificacoes'].get('fechamento_automatico', False)
+        else:
+            dados['notificacoes']['resumo_fechamento'] = not dados['notificacoes'].get('resumo_fechamento', True)
         
         salvar_dados_usuario(user_id, dados)
+        atualizar_lembrete_usuario(user_id, dados['notificacoes'])
+        atualizar_fechamento_automatico_usuario(user_id, dados['notificacoes'])
         
         # Atualizar menu de notificações
         notificacoes = dados['notificacoes']
         
-        keyboard = [
-            [InlineKeyboardButton(
-                f"{'✅' if notificacoes.get('alerta_limite', True) else '❌'} Alertas de Limite",
-                callback_data='toggle_alerta_limite'
-            )],
-            [InlineKeyboardButton(
-                f"{'✅' if notificacoes.get('lembrete_diario', False) else '❌'} Lembretes Diários",
-                callback_data='toggle_lembrete_diario'
-            )],
-            [InlineKeyboardButton(f"{EMOJI['voltar']} Voltar", callback_data='voltar_config')]
-        ]
-        
         await query.edit_message_text(
             f"{EMOJI['alerta']} *Configurações de Notificações*\n\n"
             f"Configurações atualizadas! Personalize como deseja receber notificações:",
             parse_mode='Markdown',
-            reply_markup=InlineKeyboardMarkup(keyboard)
+            reply_markup=teclado_notificacoes(notificacoes)
+        )
+        return CONFIGURACOES
+    
+    elif opcao == 'escolher_horario_lembrete':
+        await query.edit_message_text(
+            f"{EMOJI['hora']} *Horário do Lembrete Diário*\n\n"
+            f"Escolha o horário em que deseja receber o lembrete:",
+            parse_mode='Markdown',
+            reply_markup=criar_menu_horarios_lembrete()
+        )
+        return CONFIGURACOES
+    
+    elif opcao.startswith('horario_lembrete_'):
+        user_id = update.effective_user.id
+        dados = carregar_dados_usuario(user_id)
+        
+        dados['notificacoes']['horario_lembrete'] = f"{opcao[len('horario_lembrete_'):]}:00"
+        dados['notificacoes']['lembrete_diario'] = True
+        salvar_dados_usuario(user_id, dados)
+        atualizar_lembrete_usuario(user_id, dados['notificacoes'])
+        
+        await query.edit_message_text(
+            f"{EMOJI['alerta']} *Configurações de Notificações*\n\n"
+            f"Lembrete diário definido para as *{dados['notificacoes']['horario_lembrete']}*.",
+            parse_mode='Markdown',
+            reply_markup=teclado_notificacoes(dados['notificacoes'])
         )
         return CONFIGURACOES
     
     elif opcao == 'voltar_config':
-        keyboard = [
-            [
-                InlineKeyboardButton(f"{EMOJI['adicionar']} Categoria Entrada", callback_data='add_cat_entrada'),
-                InlineKeyboardButton(f"{EMOJI['adicionar']} Categoria Saída", callback_data='add_cat_saida')
-            ],
-            [
-                InlineKeyboardButton(f"{EMOJI['editar']} Editar Cat. Entrada", callback_data='editar_cat_entrada'),
-                InlineKeyboardButton(f"{EMOJI['editar']} Editar Cat. Saída", callback_data='editar_cat_saida')
-            ],
-            [
-                InlineKeyboardButton(f"{EMOJI['remover']} Remover Cat. Entrada", callback_data='remover_cat_entrada'),
-                InlineKeyboardButton(f"{EMOJI['remover']} Remover Cat. Saída", callback_data='remover_cat_saida')
-            ],
-            [
-                InlineKeyboardButton(f"{EMOJI['exportar']} Exportar Dados", callback_data='exportar_dados'),
-                InlineKeyboardButton(f"{EMOJI['alerta']} Notificações", callback_data='config_notificacoes')
-            ],
-            [
-                InlineKeyboardButton(f"{EMOJI['erro']} Apagar Dados", callback_data='apagar_dados')
-            ],
-            [InlineKeyboardButton(f"{EMOJI['voltar']} Voltar ao Menu Principal", callback_data='voltar_menu')]
-        ]
         await query.edit_message_text(
             f"{EMOJI['config']} *Configurações*\n\n"
             f"Personalize seu assistente financeiro:",
             parse_mode='Markdown',
-            reply_markup=InlineKeyboardMarkup(keyboard)
+            reply_markup=criar_menu_configuracoes()
         )
         return CONFIGURACOES
     
@@ -1950,12 +3476,12 @@ async def adicionar_categoria(update: Update, context: ContextTypes.DEFAULT_TYPE
             return await callback_configuracoes(update, context)
         return ADICIONAR_CATEGORIA
     
-    nome_categoria = update.message.text.strip()
+    nova_categoria = update.message.text.strip()
     
-    if not nome_categoria or len(nome_categoria) < 2:
+    if not nova_categoria or len(nova_categoria) < 2:
         await update.message.reply_text(
             f"{EMOJI['erro']} Nome de categoria inválido. O nome deve ter pelo menos 2 caracteres.",
-            reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton(f"{EMOJI['voltar']} Voltar", callback_data='voltar_config')]])
+            reply_markup=criar_teclado_botao('voltar', 'Voltar', 'voltar_config')
         )
         return ADICIONAR_CATEGORIA
     
@@ -1963,22 +3489,19 @@ async def adicionar_categoria(update: Update, context: ContextTypes.DEFAULT_TYPE
     dados = carregar_dados_usuario(user_id)
     
     tipo = context.user_data.get('add_categoria_tipo', 'entrada')
-    campo = f"categorias_{tipo}"
     
     # Verificar se a categoria já existe
-    if nome_categoria in dados[campo]:
+    if buscar_categoria(dados, tipo, nova_categoria) is not None:
         await update.message.reply_text(
-            f"{EMOJI['alerta']} A categoria '{nome_categoria}' já existe para {tipo}s.",
-            reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton(f"{EMOJI['voltar']} Voltar", callback_data='voltar_config')]])
+            f"{EMOJI['alerta']} A categoria '{nova_categoria}' já existe para {tipo}s.",
+            reply_markup=criar_teclado_botao('voltar', 'Voltar', 'voltar_config')
         )
         return ADICIONAR_CATEGORIA
     
     # Adicionar nova categoria
-    dados[campo].append(nome_categoria)
+    criar_categoria(dados, nova_categoria, tipo)
     salvar_dados_usuario(user_id, dados)
     
-    # Atualizar os dados em context
-    context.user_data['dados'] = dados
     
     # Confirmar para o usuário
     keyboard = [
@@ -1988,7 +3511,7 @@ async def adicionar_categoria(update: Update, context: ContextTypes.DEFAULT_TYPE
     ]
     
     await update.message.reply_text(
-        f"{EMOJI['sucesso']} Categoria '*{nome_categoria}*' adicionada com sucesso às categorias de {tipo}!",
+        f"{EMOJI['sucesso']} Categoria '*{nova_categoria}*' adicionada com sucesso às categorias de {tipo}!",
         parse_mode='Markdown',
         reply_markup=InlineKeyboardMarkup(keyboard)
     )
@@ -2007,38 +3530,32 @@ async def exportar_todos_dados(update: Update, context: ContextTypes.DEFAULT_TYP
     if not dados['transacoes']:
         await query.edit_message_text(
             f"{EMOJI['info']} Não há transações para exportar.",
-            reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton(f"{EMOJI['voltar']} Voltar", callback_data='voltar_config')]])
+            reply_markup=criar_teclado_botao('voltar', 'Voltar', 'voltar_config')
         )
         return
     
-    # Criar DataFrame para transações
-    df = pd.DataFrame(dados['transacoes'])
+    # Criar DataFrame para transações (no livro binário as datas vêm como datetime)
+    df = criar_dataframe_transacoes(dados['transacoes'], mapa_nomes_categorias(dados))
+    if isinstance(dados['transacoes'], LivroTransacoes):
+        df['data'] = df['data'].dt.strftime("%d/%m/%Y %H:%M:%S")
     
     # Criar CSV em memória
     output = BytesIO()
     df.to_csv(output, index=False, encoding='utf-8')
     output.seek(0)
     
-    # Enviar arquivo CSV
+    # Arquivos a enviar: (conteúdo, nome do arquivo, legenda)
     data_atual = datetime.datetime.now().strftime("%Y%m%d_%H%M%S")
-    await context.bot.send_document(
-        chat_id=update.effective_chat.id,
-        document=output,
-        filename=f"financas_{data_atual}.csv",
-        caption=f"{EMOJI['exportar']} Exportação de {len(dados['transacoes'])} transações (CSV)"
-    )
+    documentos = [
+        (output, f"financas_{data_atual}.csv", f"{EMOJI['exportar']} Exportação de {len(dados['transacoes'])} transações (CSV)")
+    ]
     
     # Exportar como JSON também
     output_json = BytesIO()
-    output_json.write(json.dumps(dados, ensure_ascii=False, indent=2, default=str).encode('utf-8'))
+    output_json.write(json.dumps({**dados, 'transacoes': list(dados['transacoes'])}, ensure_ascii=False, indent=2, default=str).encode('utf-8'))
     output_json.seek(0)
     
-    await context.bot.send_document(
-        chat_id=update.effective_chat.id,
-        document=output_json,
-        filename=f"financas_{data_atual}.json",
-        caption=f"{EMOJI['exportar']} Exportação completa em formato JSON"
-    )
+    documentos.append((output_json, f"financas_{data_atual}.json", f"{EMOJI['exportar']} Exportação completa em formato JSON"))
     
     # Criar relatórios detalhados
     try:
@@ -2049,12 +3566,7 @@ async def exportar_todos_dados(update: Update, context: ContextTypes.DEFAULT_TYP
             entradas_df.to_csv(output_entradas, index=False, encoding='utf-8')
             output_entradas.seek(0)
             
-            await context.bot.send_document(
-                chat_id=update.effective_chat.id,
-                document=output_entradas,
-                filename=f"entradas_{data_atual}.csv",
-                caption=f"{EMOJI['entrada']} Relatório detalhado de entradas"
-            )
+            documentos.append((output_entradas, f"entradas_{data_atual}.csv", f"{EMOJI['entrada']} Relatório detalhado de entradas"))
         
         # Relatório de saídas por categoria
         saidas_df = df[df['tipo'] == 'saida'].copy()
@@ -2063,12 +3575,7 @@ async def exportar_todos_dados(update: Update, context: ContextTypes.DEFAULT_TYP
             saidas_df.to_csv(output_saidas, index=False, encoding='utf-8')
             output_saidas.seek(0)
             
-            await context.bot.send_document(
-                chat_id=update.effective_chat.id,
-                document=output_saidas,
-                filename=f"saidas_{data_atual}.csv",
-                caption=f"{EMOJI['saida']} Relatório detalhado de saídas"
-            )
+            documentos.append((output_saidas, f"saidas_{data_atual}.csv", f"{EMOJI['saida']} Relatório detalhado de saídas"))
             
         # Relatório de fechamentos
         if 'fechamentos' in dados and dados['fechamentos']:
@@ -2077,12 +3584,7 @@ async def exportar_todos_dados(update: Update, context: ContextTypes.DEFAULT_TYP
             fechamentos_df.to_csv(output_fechamentos, index=False, encoding='utf-8')
             output_fechamentos.seek(0)
             
-            await context.bot.send_document(
-                chat_id=update.effective_chat.id,
-                document=output_fechamentos,
-                filename=f"fechamentos_{data_atual}.csv",
-                caption=f"{EMOJI['fechamento']} Histórico de fechamentos de caixa"
-            )
+            documentos.append((output_fechamentos, f"fechamentos_{data_atual}.csv", f"{EMOJI['fechamento']} Histórico de fechamentos de caixa"))
             
         # Relatório de metas
         if 'metas' in dados:
@@ -2091,16 +3593,14 @@ async def exportar_todos_dados(update: Update, context: ContextTypes.DEFAULT_TYP
             metas_df.to_csv(output_metas, index=False, encoding='utf-8')
             output_metas.seek(0)
             
-            await context.bot.send_document(
-                chat_id=update.effective_chat.id,
-                document=output_metas,
-                filename=f"metas_{data_atual}.csv",
-                caption=f"{EMOJI['grafico']} Metas financeiras"
-            )
+            documentos.append((output_metas, f"metas_{data_atual}.csv", f"{EMOJI['grafico']} Metas financeiras"))
             
     except Exception as e:
         logger.error(f"Erro ao exportar relatórios detalhados: {e}")
     
+    # Enviar todos os arquivos em um único álbum
+    await enviar_documentos(context, update.effective_chat.id, documentos)
+    
     # Atualizar mensagem
     await query.edit_message_text(
         f"{EMOJI['sucesso']} *Dados exportados com sucesso!*\n\n"
@@ -2111,8 +3611,851 @@ async def exportar_todos_dados(update: Update, context: ContextTypes.DEFAULT_TYP
         f"• Metas financeiras\n\n"
         f"Os arquivos foram enviados acima.",
         parse_mode='Markdown',
-        reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton(f"{EMOJI['voltar']} Voltar", callback_data='voltar_config')]])
+        reply_markup=criar_teclado_botao('voltar', 'Voltar', 'voltar_config')
+    )
+
+# Regras de categorização automática: cada regra liga um padrão da descrição (palavra, prefixo ou regex),
+# opcionalmente restrito a uma faixa de valores, a uma categoria do usuário
+TIPOS_REGRA = ('palavra', 'prefixo', 'regex')
+LIMITE_REGRAS_APRENDIDAS = 500
+# As regex dos usuários rodam no loop de eventos compartilhado: padrões curtos, sem quantificadores aninhados
+# (ex: "(a+)+"), alternativas repetidas, referências ou lookarounds, testados contra um trecho limitado da descrição
+TAMANHO_MAXIMO_REGEX = 100
+MAX_QUANTIFICADORES_REGEX = 2  # quantificadores ilimitados (*, +, {n,}) por padrão
+TAMANHO_MAXIMO_TEXTO_REGEX = 200
+MIN_OCORRENCIAS_APRENDIZADO = 2
+MIN_PROPORCAO_APRENDIZADO = 0.6
+
+# Função para normalizar uma descrição para as regras (apenas letras e números, sem acentos, minúsculas)
+def normalizar_descricao(texto):
+    return ' '.join(re.findall(r'[a-z0-9]+', normalizar_texto(texto)))
+
+# Função para validar uma regex de regra; levanta ValueError com o motivo se ela puder travar o bot
+def validar_regex_regra(padrao):
+    if len(padrao) > TAMANHO_MAXIMO_REGEX:
+        raise ValueError(f"A expressão regular pode ter no máximo {TAMANHO_MAXIMO_REGEX} caracteres.")
+    try:
+        itens = analisador_regex.parse(padrao)
+    except re.error as e:
+        raise ValueError(f"Expressão regular inválida: {escape_markdown(str(e))}")
+    
+    repeticoes = (analisador_regex.MAX_REPEAT, analisador_regex.MIN_REPEAT, getattr(analisador_regex, 'POSSESSIVE_REPEAT', None))
+    proibidos = (analisador_regex.GROUPREF, analisador_regex.GROUPREF_EXISTS, analisador_regex.ASSERT, analisador_regex.ASSERT_NOT)
+    ilimitados = 0
+    
+    # Percorre a árvore do padrão; dentro_de_repeticao indica um grupo que já está sob um quantificador
+    def verificar(itens, dentro_de_repeticao):
+        nonlocal ilimitados
+        for operacao, argumento in itens:
+            if operacao in proibidos:
+                raise ValueError("Referências a grupos e lookarounds não são permitidos nas regras.")
+            if operacao in repeticoes:
+                minimo, maximo, subpadrao = argumento
+                if dentro_de_repeticao:
+                    raise ValueError("Quantificadores aninhados (ex: `(a+)+`) não são permitidos nas regras.")
+                if maximo == analisador_regex.MAXREPEAT:
+                    ilimitados += 1
+                verificar(subpadrao, True)
+            elif operacao == analisador_regex.SUBPATTERN:
+                verificar(argumento[-1], dentro_de_repeticao)
+            elif operacao == getattr(analisador_regex, 'ATOMIC_GROUP', None):
+                verificar(argumento, dentro_de_repeticao)
+            elif operacao == analisador_regex.BRANCH:
+                if dentro_de_repeticao:
+                    raise ValueError("Alternativas repetidas (ex: `(ab|a)+`) não são permitidas nas regras.")
+                for alternativa in argumento[1]:
+                    verificar(alternativa, dentro_de_repeticao)
+    
+    verificar(itens, False)
+    if ilimitados > MAX_QUANTIFICADORES_REGEX:
+        raise ValueError(f"Use no máximo {MAX_QUANTIFICADORES_REGEX} quantificadores `*`, `+` ou `{{n,}}` por expressão.")
+
+# Classificador compilado a partir das regras do usuário: as palavras viram um dicionário consultado com as
+# sequências de palavras da descrição, os prefixos um dicionário por tamanho e as regras são testadas por prioridade
+class ClassificadorCategorias:
+    def __init__(self, dados):
+        self.palavras = {}
+        self.prefixos = {}
+        self.regexes = []
+        
+        # Regras criadas pelo usuário têm prioridade sobre as aprendidas
+        regras = sorted(dados['regras_categorizacao'], key=lambda regra: regra.get('aprendida', False))
+        for prioridade, regra in enumerate(regras):
+            cat_id = resolver_categoria(dados, regra['categoria_id'])
+            categoria = dados['categorias'].get(cat_id)
+            if categoria is None:
+                continue
+            
+            entrada = (prioridade, cat_id, categoria['tipo'], regra.get('valor_min'), regra.get('valor_max'))
+            if regra['tipo_regra'] == 'palavra':
+                self.palavras.setdefault(normalizar_descricao(regra['padrao']), []).append(entrada)
+            elif regra['tipo_regra'] == 'prefixo':
+                self.prefixos.setdefault(normalizar_descricao(regra['padrao']), []).append(entrada)
+            else:
+                # Regras antigas que não passam na validação atual são ignoradas
+                try:
+                    validar_regex_regra(regra['padrao'])
+                    self.regexes.append((re.compile(regra['padrao'], re.IGNORECASE), entrada))
+                except (ValueError, re.error):
+                    continue
+        
+        self.palavras.pop('', None)
+        self.prefixos.pop('', None)
+        # Palavras com mais de um termo são buscadas como sequências de até max_termos palavras da descrição
+        self.max_termos = max((chave.count(' ') + 1 for chave in self.palavras), default=0)
+        self.tamanhos_prefixo = sorted({len(p) for p in self.prefixos})
+    
+    # Retorna o ID da categoria para a transação (ou None se nenhuma regra se aplica)
+    def classificar(self, descricao, valor, tipo):
+        texto = normalizar_descricao(descricao)
+        candidatos = []
+        
+        # Todas as sequências, inclusive as sobrepostas: "uber eats" (aprendida) não esconde "uber" (do usuário)
+        if self.max_termos:
+            termos = texto.split()
+            for inicio in range(len(termos)):
+                chave = termos[inicio]
+                candidatos.extend(self.palavras.get(chave, ()))
+                for fim in range(inicio + 1, min(inicio + self.max_termos, len(termos))):
+                    chave += ' ' + termos[fim]
+                    candidatos.extend(self.palavras.get(chave, ()))
+        for tamanho in self.tamanhos_prefixo:
+            if tamanho > len(texto):
+                break
+            if texto[tamanho:tamanho + 1] in ('', ' '):
+                candidatos.extend(self.prefixos.get(texto[:tamanho], ()))
+        for padrao, entrada in self.regexes:
+            if padrao.search(descricao[:TAMANHO_MAXIMO_TEXTO_REGEX]):
+                candidatos.append(entrada)
+        
+        melhor = None
+        for prioridade, cat_id, tipo_categoria, valor_min, valor_max in candidatos:
+            if tipo_categoria != tipo:
+                continue
+            if (valor_min is not None and valor < valor_min) or (valor_max is not None and valor > valor_max):
+                continue
+            if melhor is None or prioridade < melhor[0]:
+                melhor = (prioridade, cat_id)
+        return melhor[1] if melhor else None
+
+# Cache dos classificadores compilados (invalidado pela versão das regras, como os teclados de categorias)
+_cache_classificadores = OrderedDict()
+
+# Função para marcar que as regras (ou as categorias) do usuário mudaram
+def incrementar_versao_regras(dados):
+    dados['versao_regras'] = dados.get('versao_regras', 0) + 1
+
+# Função para obter o classificador compilado de um usuário
+def obter_classificador(user_id, dados):
+    versao = (dados.get('versao_regras', 0), dados.get('versao_categorias', 0))
+    em_cache = _cache_classificadores.get(user_id)
+    if em_cache is not None and em_cache[0] == versao:
+        _cache_classificadores.move_to_end(user_id)
+        return em_cache[1]
+    
+    classificador = ClassificadorCategorias(dados)
+    _cache_classificadores[user_id] = (versao, classificador)
+    if len(_cache_classificadores) > LIMITE_CACHE_TECLADOS:
+        _cache_classificadores.popitem(last=False)
+    return classificador
+
+# Função para adicionar uma regra de categorização
+def adicionar_regra_categorizacao(dados, tipo_regra, padrao, categoria_id, valor_min=None, valor_max=None, aprendida=False):
+    regra = {
+        'id': str(dados['proximo_id_regra']),
+        'tipo_regra': tipo_regra,
+        'padrao': padrao,
+        'categoria_id': categoria_id,
+        'valor_min': valor_min,
+        'valor_max': valor_max,
+        'aprendida': aprendida
+    }
+    dados['proximo_id_regra'] += 1
+    dados['regras_categorizacao'].append(regra)
+    incrementar_versao_regras(dados)
+    return regra
+
+# Função para obter a chave aprendida de uma descrição: as duas primeiras palavras seguidas,
+# ignorando números (datas, códigos) no início
+def chave_aprendizado(descricao):
+    palavras = []
+    for palavra in normalizar_descricao(descricao).split():
+        if any(c.isdigit() for c in palavra):
+            if palavras:
+                break
+            continue
+        palavras.append(palavra)
+        if len(palavras) == 2:
+            break
+    return ' '.join(palavras)
+
+# Função para aprender (ou corrigir) uma regra a partir da categoria escolhida pelo usuário
+def aprender_regra(dados, descricao, categoria_id, valor=0, classificador=None):
+    chave = chave_aprendizado(descricao)
+    if not chave:
+        return False
+    
+    for regra in dados['regras_categorizacao']:
+        if regra.get('aprendida') and regra['padrao'] == chave:
+            if regra['categoria_id'] == categoria_id:
+                return False
+            regra['categoria_id'] = categoria_id
+            incrementar_versao_regras(dados)
+            return True
+    
+    # As regras atuais já chegam à mesma categoria: nada a aprender
+    tipo = dados['categorias'][categoria_id]['tipo']
+    if classificador is not None and classificador.classificar(descricao, valor, tipo) == categoria_id:
+        return False
+    
+    aprendidas = [regra for regra in dados['regras_categorizacao'] if regra.get('aprendida')]
+    if len(aprendidas) >= LIMITE_REGRAS_APRENDIDAS:
+        dados['regras_categorizacao'].remove(aprendidas[0])
+    
+    adicionar_regra_categorizacao(dados, 'palavra', chave, categoria_id, aprendida=True)
+    return True
+
+# Função para aprender regras a partir do histórico (a categoria mais escolhida para cada descrição)
+def aprender_regras_do_historico(dados):
+    categorias_outro = {buscar_categoria(dados, tipo, "Outro") for tipo in ('entrada', 'saida')}
+    contagem = {}
+    for transacao in dados['transacoes']:
+        cat_id = resolver_categoria(dados, transacao['categoria_id'])
+        categoria = dados['categorias'].get(cat_id)
+        if cat_id in categorias_outro or categoria is None or categoria.get('sistema'):
+            continue
+        chave = chave_aprendizado(transacao.get('descricao', ''))
+        if chave:
+            contagem.setdefault(chave, Multiconjunto())[cat_id] += 1
+    
+    aprendidas = 0
+    for chave, categorias in contagem.items():
+        cat_id, ocorrencias = categorias.most_common(1)[0]
+        if ocorrencias >= MIN_OCORRENCIAS_APRENDIZADO and ocorrencias / sum(categorias.values()) >= MIN_PROPORCAO_APRENDIZADO:
+            if aprender_regra(dados, chave, cat_id):
+                aprendidas += 1
+    return aprendidas
+
+# Função para descrever uma regra para o usuário
+def descrever_regra(dados, regra):
+    texto = f"{regra['tipo_regra']} '{regra['padrao']}' → {nome_categoria(dados, regra['categoria_id'])}"
+    if regra.get('valor_min') is not None or regra.get('valor_max') is not None:
+        minimo = formatar_valor(regra['valor_min']) if regra.get('valor_min') is not None else "..."
+        maximo = formatar_valor(regra['valor_max']) if regra.get('valor_max') is not None else "..."
+        texto += f" ({minimo} a {maximo})"
+    if regra.get('aprendida'):
+        texto += f" {EMOJI['aprender']}"
+    return texto
+
+# Limites da importação de extratos
+TAMANHO_MAXIMO_EXTRATO = 20 * 1024 * 1024  # limite de download de arquivos da Bot API
+LINHAS_PREVIA_IMPORTACAO = 10
+
+# Nomes de colunas aceitos nos extratos CSV (sem acentos, em minúsculas)
+COLUNAS_EXTRATO = {
+    'data': ('data', 'date', 'data lancamento', 'data do lancamento', 'data movimento', 'dt'),
+    'descricao': ('descricao', 'historico', 'description', 'memo', 'lancamento', 'titulo', 'estabelecimento', 'detalhes'),
+    'valor': ('valor', 'amount', 'value', 'quantia', 'valor (r$)', 'valor r$'),
+    'credito': ('credito', 'entrada', 'credit', 'credito (r$)'),
+    'debito': ('debito', 'saida', 'debit', 'debito (r$)')
+}
+FORMATOS_DATA_EXTRATO = ("%d/%m/%Y", "%Y-%m-%d", "%d/%m/%y", "%d-%m-%Y", "%d.%m.%Y", "%Y%m%d")
+
+# Função para normalizar um texto (sem acentos, minúsculo, sem espaços extras)
+def normalizar_texto(texto):
+    texto = unicodedata.normalize('NFKD', texto).encode('ascii', 'ignore').decode('ascii')
+    return ' '.join(texto.lower().split())
+
+# Função para converter um valor de extrato ("1.234,56", "-12.50", "R$ (45,00)") em float
+def converter_valor_extrato(texto):
+    texto = texto.strip().replace('R$', '').replace(' ', '')
+    negativo = texto.startswith('-') or texto.endswith('-') or (texto.startswith('(') and texto.endswith(')'))
+    texto = texto.strip('+-()')
+    
+    if ',' in texto and '.' in texto:
+        # O último separador é o decimal
+        if texto.rfind(',') > texto.rfind('.'):
+            texto = texto.replace('.', '').replace(',', '.')
+        else:
+            texto = texto.replace(',', '')
+    else:
+        texto = texto.replace(',', '.')
+    
+    valor = float(texto)
+    return -valor if negativo else valor
+
+# Função para converter a data de um extrato (vários formatos) em datetime
+def converter_data_extrato(texto):
+    texto = texto.strip().split(' ')[0].split('T')[0]
+    for formato in FORMATOS_DATA_EXTRATO:
+        try:
+            return datetime.datetime.strptime(texto, formato)
+        except ValueError:
+            continue
+    raise ValueError(f"Data inválida: {texto}")
+
+# Gerador das linhas de um extrato CSV: (data, descrição, valor, id externo) ou None para linhas inválidas
+def ler_extrato_csv(arquivo_texto):
+    amostra = arquivo_texto.read(4096)
+    arquivo_texto.seek(0)
+    try:
+        dialeto = csv.Sniffer().sniff(amostra, delimiters=';,\t|')
+    except csv.Error:
+        dialeto = csv.excel
+    
+    leitor = csv.reader(arquivo_texto, dialeto)
+    cabecalho = [normalizar_texto(coluna) for coluna in next(leitor, [])]
+    colunas = {}
+    for campo, nomes in COLUNAS_EXTRATO.items():
+        for indice, coluna in enumerate(cabecalho):
+            if coluna in nomes:
+                colunas[campo] = indice
+                break
+    
+    if 'data' not in colunas or not ('valor' in colunas or 'credito' in colunas or 'debito' in colunas):
+        raise ValueError("O CSV precisa ter colunas de data e valor (ou crédito/débito)")
+    
+    for linha in leitor:
+        if not any(campo.strip() for campo in linha):
+            continue
+        try:
+            data = converter_data_extrato(linha[colunas['data']])
+            if 'valor' in colunas:
+                valor = converter_valor_extrato(linha[colunas['valor']])
+            else:
+                credito = linha[colunas['credito']].strip() if 'credito' in colunas else ''
+                debito = linha[colunas['debito']].strip() if 'debito' in colunas else ''
+                valor = converter_valor_extrato(credito) if credito else -abs(converter_valor_extrato(debito))
+            descricao = linha[colunas['descricao']].strip() if 'descricao' in colunas else ''
+            yield data, descricao, valor, None
+        except (ValueError, IndexError):
+            yield None
+
+# Gerador das transações de um extrato OFX (aceita tanto o formato SGML quanto o XML)
+def ler_extrato_ofx(arquivo_texto):
+    campos = None
+    for linha in arquivo_texto:
+        for fechamento, tag, valor in re.findall(r'<(/?)([A-Za-z0-9.]+)>([^<]*)', linha):
+            tag = tag.upper()
+            if tag == 'STMTTRN':
+                if not fechamento:
+                    campos = {}
+                    continue
+                if campos is not None:
+                    try:
+                        yield (
+                            converter_data_extrato(campos['DTPOSTED'][:8]),
+                            campos.get('MEMO') or campos.get('NAME', ''),
+                            converter_valor_extrato(campos['TRNAMT']),
+                            campos.get('FITID')
+                        )
+                    except (KeyError, ValueError):
+                        yield None
+                campos = None
+            elif campos is not None and not fechamento and valor.strip():
+                campos[tag] = valor.strip()
+
+# Função para a "impressão digital" de uma transação usada na deduplicação (dia, tipo e valor em centavos)
+def impressao_transacao(data_str, tipo, valor):
+    return (chave_dia(data_str), tipo, round(valor * 100))
+
+# Função para processar um extrato (executada fora do loop de eventos para não bloquear outros usuários)
+def processar_extrato(conteudo, nome_arquivo, dados, classificador):
+    try:
+        conteudo.decode('utf-8')
+        codificacao = 'utf-8-sig'
+    except UnicodeDecodeError:
+        codificacao = 'cp1252'
+    arquivo_texto = io.TextIOWrapper(io.BytesIO(conteudo), encoding=codificacao, newline='')
+    
+    inicio = conteudo[:512].lstrip().upper()
+    eh_ofx = nome_arquivo.lower().endswith('.ofx') or inicio.startswith(b'OFXHEADER') or b'<OFX>' in inicio
+    linhas = ler_extrato_ofx(arquivo_texto) if eh_ofx else ler_extrato_csv(arquivo_texto)
+    
+    # Transações existentes (multiconjunto: duas compras iguais no mesmo dia continuam sendo duas)
+    existentes = Multiconjunto(impressao_transacao(t['data'], t['tipo'], t['valor']) for t in dados['transacoes'])
+    ids_externos = {t['id_externo'] for t in dados['transacoes'] if t.get('id_externo')}
+    categorias_outro = {tipo: buscar_categoria(dados, tipo, "Outro") for tipo in ('entrada', 'saida')}
+    
+    novas = []
+    duplicadas = 0
+    invalidas = 0
+    for linha in linhas:
+        if linha is None:
+            invalidas += 1
+            continue
+        
+        data, descricao, valor, id_externo = linha
+        if valor == 0:
+            invalidas += 1
+            continue
+        
+        tipo = 'entrada' if valor > 0 else 'saida'
+        valor = round(abs(valor), 2)
+        data_str = data.strftime("%d/%m/%Y %H:%M:%S")
+        
+        impressao = impressao_transacao(data_str, tipo, valor)
+        if (id_externo and id_externo in ids_externos) or existentes[impressao] > 0:
+            existentes[impressao] -= 1
+            duplicadas += 1
+            continue
+        
+        transacao = {
+            'tipo': tipo,
+            'categoria_id': classificador.classificar(descricao, valor, tipo) or categorias_outro[tipo],
+            'valor': valor,
+            'descricao': descricao[:200],
+            'data': data_str,
+            'id': str(uuid.uuid4()),
+            'importada': True
+        }
+        if id_externo:
+            transacao['id_externo'] = id_externo
+            ids_externos.add(id_externo)
+        novas.append(transacao)
+    
+    return {'transacoes': novas, 'duplicadas': duplicadas, 'invalidas': invalidas}
+
+# Função para receber o arquivo de extrato e mostrar a prévia da importação
+async def receber_extrato(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if update.callback_query:
+        return await callback_configuracoes(update, context)
+    
+    documento = update.message.document
+    nome_arquivo = documento.file_name or "extrato"
+    
+    if not nome_arquivo.lower().endswith(('.csv', '.ofx', '.txt')):
+        await update.message.reply_text(
+            f"{EMOJI['erro']} Formato não suportado. Envie um arquivo *.csv* ou *.ofx*.",
+            parse_mode='Markdown',
+            reply_markup=criar_teclado_botao('voltar', 'Voltar', 'voltar_config')
+        )
+        return IMPORTAR_EXTRATO
+    
+    if documento.file_size and documento.file_size > TAMANHO_MAXIMO_EXTRATO:
+        await update.message.reply_text(
+            f"{EMOJI['erro']} O arquivo é muito grande (máximo de 20 MB).",
+            reply_markup=criar_teclado_botao('voltar', 'Voltar', 'voltar_config')
+        )
+        return IMPORTAR_EXTRATO
+    
+    mensagem = await update.message.reply_text(f"{EMOJI['hora']} Processando o extrato...")
+    
+    user_id = update.effective_user.id
+    dados = carregar_dados_usuario(user_id)
+    
+    arquivo = await documento.get_file()
+    conteudo = bytes(await arquivo.download_as_bytearray())
+    
+    try:
+        resultado = await asyncio.get_running_loop().run_in_executor(
+            None, processar_extrato, conteudo, nome_arquivo, dados, obter_classificador(user_id, dados)
+        )
+    except ValueError as e:
+        await mensagem.edit_text(
+            f"{EMOJI['erro']} Não foi possível ler o extrato: {e}",
+            reply_markup=criar_teclado_botao('voltar', 'Voltar', 'voltar_config')
+        )
+        return IMPORTAR_EXTRATO
+    
+    transacoes = resultado['transacoes']
+    logger.info(f"Extrato de {user_id}: {len(transacoes)} novas, {resultado['duplicadas']} duplicadas, {resultado['invalidas']} inválidas")
+    
+    if not transacoes:
+        await mensagem.edit_text(
+            f"{EMOJI['info']} Nenhuma transação nova encontrada no extrato.\n\n"
+            f"• Já registradas: {resultado['duplicadas']}\n"
+            f"• Linhas ignoradas: {resultado['invalidas']}",
+            reply_markup=criar_teclado_botao('voltar', 'Voltar', 'voltar_config')
+        )
+        return CONFIGURACOES
+    
+    context.user_data['importacao'] = transacoes
+    
+    total_entradas = sum(t['valor'] for t in transacoes if t['tipo'] == 'entrada')
+    total_saidas = sum(t['valor'] for t in transacoes if t['tipo'] == 'saida')
+    primeira_data = min(transacoes, key=lambda t: chave_dia(t['data']))['data'][:10]
+    ultima_data = max(transacoes, key=lambda t: chave_dia(t['data']))['data'][:10]
+    
+    texto = f"{EMOJI['importar']} *Prévia da Importação*\n\n"
+    texto += f"{EMOJI['calendario']} Período: *{primeira_data}* a *{ultima_data}*\n"
+    texto += f"{EMOJI['transacao']} Transações novas: *{len(transacoes)}*\n"
+    texto += f"{EMOJI['entrada']} Entradas: *{formatar_valor(total_entradas)}*\n"
+    texto += f"{EMOJI['saida']} Saídas: *{formatar_valor(total_saidas)}*\n"
+    texto += f"{EMOJI['info']} Já registradas (ignoradas): *{resultado['duplicadas']}*\n"
+    if resultado['invalidas']:
+        texto += f"{EMOJI['alerta']} Linhas inválidas (ignoradas): *{resultado['invalidas']}*\n"
+    
+    categorizadas = sum(1 for t in transacoes if nome_categoria(dados, t['categoria_id']) != "Outro")
+    texto += f"{EMOJI['regra']} Categorizadas pelas regras: *{categorizadas}*\n"
+    
+    texto += "\n*Primeiras transações:*\n"
+    for t in transacoes[:LINHAS_PREVIA_IMPORTACAO]:
+        emoji = EMOJI['entrada'] if t['tipo'] == 'entrada' else EMOJI['saida']
+        descricao = escape_markdown(t['descricao'][:40] or "Sem descrição")
+        categoria = escape_markdown(nome_categoria(dados, t['categoria_id']))
+        texto += f"{emoji} {t['data'][:10]} - {descricao} ({categoria}): *{formatar_valor(t['valor'])}*\n"
+    if len(transacoes) > LINHAS_PREVIA_IMPORTACAO:
+        texto += f"... e mais {len(transacoes) - LINHAS_PREVIA_IMPORTACAO}\n"
+    
+    texto += "\nDeseja importar essas transações?"
+    
+    await mensagem.edit_text(
+        texto,
+        parse_mode='Markdown',
+        reply_markup=InlineKeyboardMarkup([
+            [InlineKeyboardButton(f"{EMOJI['confirmar']} Importar {len(transacoes)} transações", callback_data='confirmar_importacao')],
+            [InlineKeyboardButton(f"{EMOJI['cancelar']} Cancelar", callback_data='cancelar_importacao')]
+        ])
+    )
+    return CONFIRMAR_IMPORTACAO
+
+# Função para confirmar (ou cancelar) a importação do extrato
+async def confirmar_importacao(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    query = update.callback_query
+    await query.answer()
+    
+    transacoes = context.user_data.pop('importacao', None)
+    
+    if query.data != 'confirmar_importacao' or not transacoes:
+        await query.edit_message_text(
+            f"{EMOJI['cancelar']} Importação cancelada.",
+            reply_markup=criar_teclado_botao('voltar', 'Voltar', 'voltar_config')
+        )
+        return CONFIGURACOES
+    
+    user_id = update.effective_user.id
+    dados = carregar_dados_usuario(user_id)
+    
+    # Uma única escrita para todo o lote
+    registrar_transacoes(dados, transacoes)
+    salvar_dados_usuario(user_id, dados)
+    mensagem_alerta = verificar_limite_gastos(dados, transacoes)
+    
+    await query.edit_message_text(
+        f"{EMOJI['sucesso']} *Extrato importado com sucesso!*\n\n"
+        f"• {len(transacoes)} transações adicionadas\n"
+        f"{EMOJI['saldo']} Saldo atual: *{formatar_valor(dados['saldo_atual'])}*{mensagem_alerta}",
+        parse_mode='Markdown',
+        reply_markup=criar_teclado_botao('voltar', 'Voltar ao Menu', 'voltar_menu')
+    )
+    return MENU_PRINCIPAL
+
+LIMITE_REGRAS_EXIBIDAS = 30
+
+# Função para mostrar as regras de categorização do usuário
+async def mostrar_regras(update: Update, context: ContextTypes.DEFAULT_TYPE, aviso=""):
+    query = update.callback_query
+    user_id = update.effective_user.id
+    dados = carregar_dados_usuario(user_id)
+    regras = dados['regras_categorizacao']
+    
+    texto = f"{EMOJI['regra']} *Regras de Categoria*\n\n"
+    if aviso:
+        texto += f"{aviso}\n\n"
+    texto += "As regras escolhem a categoria pela descrição (ex: extratos importados).\n\n"
+    
+    if regras:
+        for indice, regra in enumerate(regras[:LIMITE_REGRAS_EXIBIDAS], start=1):
+            texto += f"{indice}. {escape_markdown(descrever_regra(dados, regra))}\n"
+        if len(regras) > LIMITE_REGRAS_EXIBIDAS:
+            texto += f"... e mais {len(regras) - LIMITE_REGRAS_EXIBIDAS} regras\n"
+        texto += f"\n{EMOJI['aprender']} = regra aprendida com suas escolhas"
+    else:
+        texto += "Nenhuma regra cadastrada."
+    
+    keyboard = [
+        [
+            InlineKeyboardButton(f"{EMOJI['adicionar']} Adicionar Regra", callback_data='adicionar_regra'),
+            InlineKeyboardButton(f"{EMOJI['remover']} Remover Regra", callback_data='remover_regras')
+        ],
+        [InlineKeyboardButton(f"{EMOJI['aprender']} Aprender com o Histórico", callback_data='aprender_regras')],
+        [InlineKeyboardButton(f"{EMOJI['voltar']} Voltar", callback_data='voltar_config')]
+    ]
+    
+    await query.edit_message_text(texto, parse_mode='Markdown', reply_markup=InlineKeyboardMarkup(keyboard))
+    return REGRAS_CATEGORIZACAO
+
+# Callback da tela de regras de categorização
+async def callback_regras(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    query = update.callback_query
+    await query.answer()
+    
+    opcao = query.data
+    user_id = update.effective_user.id
+    
+    if opcao == 'voltar_config':
+        return await callback_configuracoes(update, context)
+    
+    elif opcao == 'regras_categoria':
+        return await mostrar_regras(update, context)
+    
+    elif opcao == 'adicionar_regra':
+        await query.edit_message_text(
+            f"{EMOJI['adicionar']} *Adicionar Regra*\n\n"
+            f"Envie a regra no formato:\n"
+            f"`tipo: padrão = Categoria`\n\n"
+            f"Tipos: *palavra* (em qualquer parte da descrição), *prefixo* (início da descrição) ou *regex*.\n"
+            f"Opcionalmente, restrinja pelo valor com `| mínimo-máximo`.\n"
+            f"Expressões regulares têm até {TAMANHO_MAXIMO_REGEX} caracteres, sem quantificadores aninhados, referências ou lookarounds.\n\n"
+            f"Exemplos:\n"
+            f"`palavra: uber = Transporte`\n"
+            f"`prefixo: pix recebido = Venda`\n"
+            f"`regex: ifood|rappi = Alimentação | 0-100`\n\n"
+            f"Se a categoria existir em entradas e saídas, use `Outro (entrada)` ou `Outro (saida)`.",
+            parse_mode='Markdown',
+            reply_markup=criar_teclado_botao('voltar', 'Voltar', 'regras_categoria')
+        )
+        return ADICIONAR_REGRA
+    
+    elif opcao == 'aprender_regras':
+        dados = carregar_dados_usuario(user_id)
+        aprendidas = aprender_regras_do_historico(dados)
+        if aprendidas:
+            salvar_dados_usuario(user_id, dados)
+        return await mostrar_regras(update, context, aviso=f"{EMOJI['aprender']} {aprendidas} regras aprendidas com o histórico.")
+    
+    elif opcao == 'remover_regras':
+        dados = carregar_dados_usuario(user_id)
+        keyboard = [
+            [InlineKeyboardButton(f"{EMOJI['remover']} {descrever_regra(dados, regra)}"[:60], callback_data=f"rem_regra_{regra['id']}")]
+            for regra in dados['regras_categorizacao'][:LIMITE_REGRAS_EXIBIDAS]
+        ]
+        keyboard.append([InlineKeyboardButton(f"{EMOJI['voltar']} Voltar", callback_data='regras_categoria')])
+        await query.edit_message_text(
+            f"{EMOJI['remover']} *Remover Regra*\n\nSelecione a regra que deseja remover:",
+            parse_mode='Markdown',
+            reply_markup=InlineKeyboardMarkup(keyboard)
+        )
+        return REGRAS_CATEGORIZACAO
+    
+    elif opcao.startswith('rem_regra_'):
+        regra_id = opcao[len('rem_regra_'):]
+        dados = carregar_dados_usuario(user_id)
+        dados['regras_categorizacao'] = [regra for regra in dados['regras_categorizacao'] if regra['id'] != regra_id]
+        incrementar_versao_regras(dados)
+        salvar_dados_usuario(user_id, dados)
+        return await mostrar_regras(update, context, aviso=f"{EMOJI['sucesso']} Regra removida.")
+    
+    return REGRAS_CATEGORIZACAO
+
+# Função para interpretar o texto de uma nova regra ("tipo: padrão = Categoria | min-max")
+def interpretar_regra(dados, texto):
+    correspondencia = re.match(r'^\s*(\w+)\s*:\s*(.+?)\s*=\s*([^|]+?)\s*(?:\|\s*(.*))?$', texto)
+    if not correspondencia:
+        raise ValueError("Formato inválido. Use `tipo: padrão = Categoria`.")
+    
+    tipo_regra, padrao, nome, faixa = correspondencia.groups()
+    tipo_regra = normalizar_texto(tipo_regra)
+    if tipo_regra not in TIPOS_REGRA:
+        raise ValueError("Tipo inválido. Use palavra, prefixo ou regex.")
+    
+    if tipo_regra == 'regex':
+        validar_regex_regra(padrao)
+    elif not normalizar_descricao(padrao):
+        raise ValueError("O padrão precisa conter letras ou números.")
+    
+    # Categoria, com o tipo opcional entre parênteses
+    tipo_categoria = re.search(r'\((entrada|saida|saída)\)\s*$', nome, re.IGNORECASE)
+    tipos = ('entrada', 'saida')
+    if tipo_categoria:
+        tipos = (normalizar_texto(tipo_categoria.group(1)),)
+        nome = nome[:tipo_categoria.start()].strip()
+    encontradas = [
+        cat_id for tipo in tipos for cat_id in dados[f"categorias_{tipo}"]
+        if normalizar_texto(dados['categorias'][cat_id]['nome']) == normalizar_texto(nome)
+    ]
+    # As mensagens de erro vão com parse_mode='Markdown': o texto digitado pelo usuário precisa ser escapado
+    if not encontradas:
+        raise ValueError(f"Categoria '{escape_markdown(nome)}' não encontrada.")
+    if len(encontradas) > 1:
+        nome = escape_markdown(nome)
+        raise ValueError(f"A categoria '{nome}' existe em entradas e saídas. Use '{nome} (entrada)' ou '{nome} (saida)'.")
+    
+    valor_min = valor_max = None
+    if faixa:
+        minimo, _, maximo = faixa.partition('-')
+        try:
+            valor_min = converter_valor_digitado(minimo) if minimo.strip() else None
+            valor_max = converter_valor_digitado(maximo) if maximo.strip() else None
+        except ValueError:
+            raise ValueError(f"Faixa de valores inválida: {escape_markdown(faixa)}. Use `mínimo-máximo` (ex: `0-100`).")
+    
+    return tipo_regra, padrao, encontradas[0], valor_min, valor_max
+
+# Função para adicionar uma regra a partir do texto enviado pelo usuário
+async def adicionar_regra(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if update.callback_query:
+        return await callback_regras(update, context)
+    
+    user_id = update.effective_user.id
+    dados = carregar_dados_usuario(user_id)
+    
+    try:
+        tipo_regra, padrao, cat_id, valor_min, valor_max = interpretar_regra(dados, update.message.text)
+    except ValueError as e:
+        await update.message.reply_text(
+            f"{EMOJI['erro']} {e}",
+            parse_mode='Markdown',
+            reply_markup=criar_teclado_botao('voltar', 'Voltar', 'regras_categoria')
+        )
+        return ADICIONAR_REGRA
+    
+    regra = adicionar_regra_categorizacao(dados, tipo_regra, padrao, cat_id, valor_min, valor_max)
+    salvar_dados_usuario(user_id, dados)
+    
+    await update.message.reply_text(
+        f"{EMOJI['sucesso']} Regra adicionada:\n{escape_markdown(descrever_regra(dados, regra))}",
+        parse_mode='Markdown',
+        reply_markup=criar_teclado_botao('regra', 'Ver Regras', 'regras_categoria')
+    )
+    return REGRAS_CATEGORIZACAO
+
+# Função para acompanhar a meta de economia do mês atual a cada gravação dos dados. O mês em que a meta
+# foi atingida fica em metas['economia_atingida']: o usuário é avisado quando a economia chega à meta
+# e, se depois cair abaixo dela (ex: uma saída grande), quando a meta deixa de estar garantida.
+def acompanhar_meta_economia(user_id, dados):
+    metas = dados.get('metas', {})
+    meta = metas.get('economia_mensal', 0)
+    if meta <= 0:
+        return
+    
+    chave = datetime.datetime.now().strftime("%Y-%m")
+    economia = economia_mes(dados, chave)
+    atingida = metas.get('economia_atingida') == chave
+    
+    if economia >= meta and not atingida:
+        metas['economia_atingida'] = chave
+        texto = f"{EMOJI['sucesso']} *Meta de economia atingida!*\n\n" \
+                f"Você já economizou *{formatar_valor(economia)}* este mês (meta: {formatar_valor(meta)})."
+    elif economia < meta and atingida:
+        del metas['economia_atingida']
+        texto = f"{EMOJI['alerta']} *Meta de economia fora de alcance*\n\n" \
+                f"Sua economia do mês caiu para *{formatar_valor(economia)}*. " \
+                f"Faltam {formatar_valor(meta - economia)} para a meta de {formatar_valor(meta)}."
+    else:
+        return
+    
+    if dados.get('notificacoes', {}).get('alerta_meta_economia', True):
+        _fila_notificacoes.append((user_id, texto))
+
+# Função para montar o texto de consumo dos orçamentos no mês atual (todas as categorias de saída)
+def formatar_orcamentos(dados):
+    chave = datetime.datetime.now().strftime("%Y-%m")
+    orcamentos = dados['orcamentos']
+    gastos = gastos_categorias_mes(dados, chave)
+    
+    texto = f"{EMOJI['orcamento']} *Orçamentos de {chave[5:]}/{chave[:4]}*\n\n"
+    sem_orcamento = ""
+    for cat_id in dados['categorias_saida']:
+        nome = escape_markdown(nome_categoria(dados, cat_id))
+        gasto = gastos.get(cat_id, 0)
+        if cat_id not in orcamentos:
+            if gasto > 0:
+                sem_orcamento += f"• {nome}: {formatar_valor(gasto)}\n"
+            continue
+        
+        porcentagem = gasto / orcamentos[cat_id] * 100
+        cheios = min(int(porcentagem // 10), 10)
+        emoji = EMOJI['alerta'] if porcentagem >= 100 else EMOJI['orcamento'] if porcentagem >= LIMIARES_ORCAMENTO[0] else EMOJI['sucesso']
+        texto += (
+            f"{emoji} *{nome}*: {formatar_valor(gasto)} de {formatar_valor(orcamentos[cat_id])}\n"
+            f"`{'█' * cheios}{'░' * (10 - cheios)}` {porcentagem:.0f}%\n"
+        )
+    
+    if not orcamentos:
+        texto += "Nenhum orçamento definido.\n"
+    if sem_orcamento:
+        texto += f"\n*Sem orçamento:*\n{sem_orcamento}"
+    
+    texto += (
+        f"\nVocê é avisado ao atingir {' e '.join(f'{limiar}%' for limiar in LIMIARES_ORCAMENTO)} do orçamento. "
+        f"Toque em uma categoria para definir ou alterar o orçamento mensal dela."
+    )
+    return texto
+
+# Função para mostrar os orçamentos por categoria
+async def mostrar_orcamentos(update: Update, context: ContextTypes.DEFAULT_TYPE, aviso=""):
+    query = update.callback_query
+    user_id = update.effective_user.id
+    dados = carregar_dados_usuario(user_id)
+    
+    texto = formatar_orcamentos(dados)
+    if aviso:
+        texto = f"{aviso}\n\n{texto}"
+    
+    await query.edit_message_text(texto, parse_mode='Markdown', reply_markup=criar_teclado_categorias(user_id, dados, 'saida', 'orcamento'))
+    return ORCAMENTOS
+
+# Callback da tela de orçamentos
+async def callback_orcamentos(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    query = update.callback_query
+    await query.answer()
+    
+    opcao = query.data
+    
+    if opcao == 'voltar_config':
+        return await callback_configuracoes(update, context)
+    
+    elif opcao == 'orcamentos':
+        return await mostrar_orcamentos(update, context)
+    
+    elif opcao.startswith('orc_cat_'):
+        cat_id = opcao[len('orc_cat_'):]
+        dados = carregar_dados_usuario(update.effective_user.id)
+        context.user_data['orcamento_categoria'] = cat_id
+        
+        atual = dados['orcamentos'].get(cat_id)
+        await query.edit_message_text(
+            f"{EMOJI['orcamento']} *Orçamento: {escape_markdown(nome_categoria(dados, cat_id))}*\n\n"
+            f"Orçamento atual: *{formatar_valor(atual) if atual else 'nenhum'}*\n\n"
+            f"Digite o valor máximo mensal para esta categoria (0 remove o orçamento):",
+            parse_mode='Markdown',
+            reply_markup=criar_teclado_botao('voltar', 'Voltar', 'orcamentos')
+        )
+    
+    return ORCAMENTOS
+
+# Função para definir o orçamento mensal de uma categoria (valor digitado)
+async def definir_orcamento(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    cat_id = context.user_data.get('orcamento_categoria')
+    if cat_id is None:
+        await update.message.reply_text(
+            f"{EMOJI['info']} Escolha uma categoria para definir o orçamento.",
+            reply_markup=criar_teclado_botao('orcamento', 'Ver Orçamentos', 'orcamentos')
+        )
+        return ORCAMENTOS
+    
+    try:
+        valor = converter_valor_digitado(update.message.text)
+    except ValueError:
+        await update.message.reply_text(
+            f"{EMOJI['erro']} Valor inválido. Por favor, digite apenas números (ex: 800.00):",
+            reply_markup=criar_teclado_botao('voltar', 'Cancelar', 'orcamentos')
+        )
+        return ORCAMENTOS
+    
+    user_id = update.effective_user.id
+    dados = carregar_dados_usuario(user_id)
+    # O botão pode ser de antes de a categoria ser removida: o orçamento vai para a substituta
+    cat_id = resolver_categoria(dados, cat_id)
+    nome = escape_markdown(nome_categoria(dados, cat_id))
+    
+    if valor > 0:
+        dados['orcamentos'][cat_id] = valor
+        mensagem = f"Orçamento de *{nome}* definido: *{formatar_valor(valor)}* por mês."
+    else:
+        dados['orcamentos'].pop(cat_id, None)
+        mensagem = f"Orçamento de *{nome}* removido."
+    salvar_dados_usuario(user_id, dados)
+    del context.user_data['orcamento_categoria']
+    
+    await update.message.reply_text(
+        f"{EMOJI['sucesso']} {mensagem}",
+        parse_mode='Markdown',
+        reply_markup=criar_teclado_botao('orcamento', 'Ver Orçamentos', 'orcamentos')
     )
+    return ORCAMENTOS
 
 # Função para remover categoria
 async def remover_categoria(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -2125,27 +4468,23 @@ async def remover_categoria(update: Update, context: ContextTypes.DEFAULT_TYPE):
     # Extrair informações da callback_data
     partes = query.data.split('_')
     tipo = partes[2]  # entrada ou saida
-    categoria = '_'.join(partes[3:])  # nome da categoria (pode conter underscores)
+    cat_id = partes[3]  # ID da categoria
     
     user_id = update.effective_user.id
     dados = carregar_dados_usuario(user_id)
     
-    # Verificar se a categoria está em uso
-    categoria_em_uso = False
-    for transacao in dados['transacoes']:
-        if transacao['categoria'] == categoria:
-            categoria_em_uso = True
-            break
+    # Verificar se a categoria está em uso (contador mantido a cada transação)
+    categoria = dados['categorias'].get(cat_id, {'nome': cat_id, 'uso': 0})
     
-    if categoria_em_uso:
+    if categoria['uso'] > 0:
         keyboard = [
-            [InlineKeyboardButton(f"{EMOJI['confirmar']} Sim, trocar para 'Outro'", callback_data=f'confirm_rem_{tipo}_{categoria}')],
+            [InlineKeyboardButton(f"{EMOJI['confirmar']} Sim, trocar para 'Outro'", callback_data=f'confirm_rem_{tipo}_{cat_id}')],
             [InlineKeyboardButton(f"{EMOJI['cancelar']} Não, cancelar", callback_data='voltar_config')]
         ]
         
         await query.edit_message_text(
             f"{EMOJI['alerta']} *Atenção*\n\n"
-            f"A categoria '{categoria}' está sendo usada em {sum(1 for t in dados['transacoes'] if t['categoria'] == categoria)} transações.\n\n"
+            f"A categoria '{categoria['nome']}' está sendo usada em {categoria['uso']} transações.\n\n"
             f"Deseja realmente removê-la? Todas as transações desta categoria serão alteradas para 'Outro'.",
             parse_mode='Markdown',
             reply_markup=InlineKeyboardMarkup(keyboard)
@@ -2153,38 +4492,47 @@ async def remover_categoria(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return REMOVER_CATEGORIA
     
     # Se não estiver em uso, remover diretamente
-    await remover_categoria_confirmado(update, context, tipo, categoria)
+    await remover_categoria_confirmado(update, context, tipo, cat_id)
     
     return CONFIGURACOES
 
 # Função para confirmar remoção de categoria em uso
-async def remover_categoria_confirmado(update: Update, context, tipo=None, categoria=None):
+async def remover_categoria_confirmado(update: Update, context, tipo=None, cat_id=None):
     query = update.callback_query
     
     # Se for chamado por confirmação de callback
-    if tipo is None and categoria is None:
+    if tipo is None and cat_id is None:
         partes = query.data.split('_')
         tipo = partes[2]  # entrada ou saida
-        categoria = '_'.join(partes[3:])  # nome da categoria (pode conter underscores)
+        cat_id = partes[3]  # ID da categoria
     
     user_id = update.effective_user.id
     dados = carregar_dados_usuario(user_id)
     
-    # Atualizar categorias nas transações
-    count_alteracoes = 0
-    for transacao in dados['transacoes']:
-        if transacao['categoria'] == categoria:
-            transacao['categoria'] = 'Outro'
-            count_alteracoes += 1
-    
     # Remover a categoria
     campo = f"categorias_{tipo}"
-    if categoria in dados[campo]:
-        dados[campo].remove(categoria)
+    if cat_id in dados[campo]:
+        categoria = dados['categorias'][cat_id]
+        
+        # As transações continuam apontando para o ID removido, que passa a
+        # redirecionar para "Outro" (sem reescrever as transações)
+        outro_id = buscar_categoria(dados, tipo, 'Outro')
+        if outro_id is None or outro_id == cat_id:
+            outro_id = criar_categoria(dados, 'Outro', tipo)
+        
+        count_alteracoes = categoria['uso']
+        dados['categorias'][outro_id]['uso'] += count_alteracoes
+        categoria['uso'] = 0
+        categoria['removida'] = True
+        categoria['substituta'] = outro_id
+        
+        dados[campo].remove(cat_id)
+        dados['orcamentos'].pop(cat_id, None)
+        incrementar_versao_categorias(dados)
         salvar_dados_usuario(user_id, dados)
         
         mensagem_sucesso = (
-            f"{EMOJI['sucesso']} Categoria '*{categoria}*' removida com sucesso das categorias de {tipo}!"
+            f"{EMOJI['sucesso']} Categoria '*{categoria['nome']}*' removida com sucesso das categorias de {tipo}!"
         )
         
         if count_alteracoes > 0:
@@ -2201,8 +4549,8 @@ async def remover_categoria_confirmado(update: Update, context, tipo=None, categ
         )
     else:
         await query.edit_message_text(
-            f"{EMOJI['erro']} Erro: Categoria '{categoria}' não encontrada.",
-            reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton(f"{EMOJI['voltar']} Voltar", callback_data='voltar_config')]])
+            f"{EMOJI['erro']} Erro: Categoria não encontrada.",
+            reply_markup=criar_teclado_botao('voltar', 'Voltar', 'voltar_config')
         )
     
     return CONFIGURACOES
@@ -2211,7 +4559,7 @@ async def remover_categoria_confirmado(update: Update, context, tipo=None, categ
 async def mensagem_desconhecida(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await update.message.reply_text(
         f"{EMOJI['info']} Desculpe, não entendi esse comando. Por favor, use o menu ou digite /start para começar.",
-        reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton(f"{EMOJI['voltar']} Menu Principal", callback_data='voltar_menu')]])
+        reply_markup=criar_teclado_botao('voltar', 'Menu Principal', 'voltar_menu')
     )
     return MENU_PRINCIPAL
 
@@ -2226,10 +4574,14 @@ async def editar_categoria(update: Update, context: ContextTypes.DEFAULT_TYPE):
     # Extrair informações da callback_data
     partes = query.data.split('_')
     tipo = partes[2]  # entrada ou saida
-    categoria_antiga = '_'.join(partes[3:])  # nome da categoria (pode conter underscores)
+    cat_id = partes[3]  # ID da categoria
+    
+    dados = carregar_dados_usuario(update.effective_user.id)
+    categoria_antiga = nome_categoria(dados, cat_id)
     
     context.user_data['edit_categoria'] = {
         'tipo': tipo,
+        'categoria_id': cat_id,
         'categoria_antiga': categoria_antiga
     }
     
@@ -2237,7 +4589,7 @@ async def editar_categoria(update: Update, context: ContextTypes.DEFAULT_TYPE):
         f"{EMOJI['editar']} *Editar Categoria*\n\n"
         f"Digite o novo nome para a categoria '*{categoria_antiga}*':",
         parse_mode='Markdown',
-        reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton(f"{EMOJI['voltar']} Voltar", callback_data='voltar_config')]])
+        reply_markup=criar_teclado_botao('voltar', 'Voltar', 'voltar_config')
     )
     
     return EDITAR_CATEGORIA
@@ -2256,7 +4608,7 @@ async def processar_edicao_categoria(update: Update, context: ContextTypes.DEFAU
     if not nova_categoria or len(nova_categoria) < 2:
         await update.message.reply_text(
             f"{EMOJI['erro']} Nome de categoria inválido. O nome deve ter pelo menos 2 caracteres.",
-            reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton(f"{EMOJI['voltar']} Voltar", callback_data='voltar_config')]])
+            reply_markup=criar_teclado_botao('voltar', 'Voltar', 'voltar_config')
         )
         return EDITAR_CATEGORIA
     
@@ -2265,41 +4617,35 @@ async def processar_edicao_categoria(update: Update, context: ContextTypes.DEFAU
     
     edit_info = context.user_data.get('edit_categoria', {})
     tipo = edit_info.get('tipo')
+    cat_id = edit_info.get('categoria_id')
     categoria_antiga = edit_info.get('categoria_antiga')
     
-    if not tipo or not categoria_antiga:
+    if not tipo or not cat_id:
         await update.message.reply_text(
             f"{EMOJI['erro']} Erro ao processar a edição. Por favor, tente novamente.",
-            reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton(f"{EMOJI['voltar']} Voltar", callback_data='voltar_config')]])
+            reply_markup=criar_teclado_botao('voltar', 'Voltar', 'voltar_config')
         )
         return CONFIGURACOES
     
-    campo = f"categorias_{tipo}"
-    
     # Verificar se a nova categoria já existe
-    if nova_categoria in dados[campo]:
+    if buscar_categoria(dados, tipo, nova_categoria) is not None:
         await update.message.reply_text(
             f"{EMOJI['alerta']} A categoria '*{nova_categoria}*' já existe para {tipo}s.",
             parse_mode='Markdown',
-            reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton(f"{EMOJI['voltar']} Voltar", callback_data='voltar_config')]])
+            reply_markup=criar_teclado_botao('voltar', 'Voltar', 'voltar_config')
         )
         return EDITAR_CATEGORIA
     
-    # Contar quantas transações serão afetadas
-    transacoes_afetadas = sum(1 for t in dados['transacoes'] if t['categoria'] == categoria_antiga)
-    
-    # Atualizar a categoria em todas as transações
-    for transacao in dados['transacoes']:
-        if transacao['categoria'] == categoria_antiga:
-            transacao['categoria'] = nova_categoria
-    
-    # Atualizar a lista de categorias
-    try:
-        idx = dados[campo].index(categoria_antiga)
-        dados[campo][idx] = nova_categoria
-    except ValueError:
+    # Renomear a categoria (as transações referenciam o ID, então basta atualizar o registro)
+    if cat_id in dados[f"categorias_{tipo}"]:
+        categoria = dados['categorias'][cat_id]
+        transacoes_afetadas = categoria['uso']
+        categoria['nome'] = nova_categoria
+        incrementar_versao_categorias(dados)
+    else:
         # Se a categoria não for encontrada, adicionar a nova
-        dados[campo].append(nova_categoria)
+        transacoes_afetadas = 0
+        criar_categoria(dados, nova_categoria, tipo)
     
     # Salvar as alterações
     salvar_dados_usuario(user_id, dados)
@@ -2341,75 +4687,54 @@ async def gerar_grafico_analise(update: Update, context: ContextTypes.DEFAULT_TY
     if not dados['transacoes'] or len(dados['transacoes']) < 5:
         await query.edit_message_text(
             f"{EMOJI['info']} Você precisa ter pelo menos 5 transações para gerar análises detalhadas.",
-            reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton(f"{EMOJI['voltar']} Voltar", callback_data='voltar_menu')]])
+            reply_markup=criar_teclado_botao('voltar', 'Voltar', 'voltar_menu')
         )
         return MENU_PRINCIPAL
     
-    # Criar DataFrame para análise
-    df = pd.DataFrame(dados['transacoes'])
-    df['data'] = pd.to_datetime(df['data'], format='%d/%m/%Y %H:%M:%S')
-    df['mes'] = df['data'].dt.month
-    df['ano'] = df['data'].dt.year
-    
     # Análise por mês
     try:
-        # Agrupar por mês e tipo
-        analise_mensal = df.groupby(['ano', 'mes', 'tipo'])['valor'].sum().unstack(fill_value=0).reset_index()
+        # Totais de cada mês com movimento, a partir dos totais mensais
+        meses = sorted(dados['totais_mensais'])
+        entradas = np.array([dados['totais_mensais'][mes]['entrada'] for mes in meses])
+        saidas = np.array([dados['totais_mensais'][mes]['saida'] for mes in meses])
         
         # Criar rótulos para o eixo x
-        analise_mensal['mes_ano'] = analise_mensal.apply(lambda row: f"{row['mes']}/{row['ano']}", axis=1)
+        rotulos = [f"{int(mes[5:])}/{mes[:4]}" for mes in meses]
         
         # Criar gráfico de barras para análise mensal
         plt.figure(figsize=(12, 6))
         
-        # Se não houver colunas de entrada ou saída, adicionar como zeros
-        if 'entrada' not in analise_mensal.columns:
-            analise_mensal['entrada'] = 0
-        if 'saida' not in analise_mensal.columns:
-            analise_mensal['saida'] = 0
-        
-        # Calcular o saldo mensal
-        analise_mensal['saldo'] = analise_mensal['entrada'] - analise_mensal['saida']
-        
         # Criar gráfico de barras agrupadas
         bar_width = 0.25
-        indices = np.arange(len(analise_mensal))
+        indices = np.arange(len(meses))
         
-        plt.bar(indices - bar_width, analise_mensal['entrada'], bar_width, label='Entradas', color='green', alpha=0.7)
-        plt.bar(indices, analise_mensal['saida'], bar_width, label='Saídas', color='red', alpha=0.7)
-        plt.bar(indices + bar_width, analise_mensal['saldo'], bar_width, label='Saldo', color='blue', alpha=0.7)
+        plt.bar(indices - bar_width, entradas, bar_width, label='Entradas', color='green', alpha=0.7)
+        plt.bar(indices, saidas, bar_width, label='Saídas', color='red', alpha=0.7)
+        plt.bar(indices + bar_width, entradas - saidas, bar_width, label='Saldo', color='blue', alpha=0.7)
         
-        # Adicionar rótulos e título
+        # Adicionar rótulos e título (com históricos longos, só parte dos meses recebe rótulo)
+        passo = -(-len(meses) // ROTULOS_MAXIMOS_EIXO)
         plt.xlabel('Mês/Ano', fontsize=12)
         plt.ylabel('Valor (R$)', fontsize=12)
         plt.title('Análise Financeira Mensal', fontsize=16, fontweight='bold')
-        plt.xticks(indices, analise_mensal['mes_ano'], rotation=45)
+        plt.xticks(indices[::passo], rotulos[::passo], rotation=45)
         plt.legend()
         plt.grid(axis='y', alpha=0.3)
         plt.tight_layout()
         
         # Salvar em memória
-        buf1 = BytesIO()
-        plt.savefig(buf1, format='png', dpi=100)
-        buf1.seek(0)
-        
-        # Enviar primeiro gráfico
-        await context.bot.send_photo(
-            chat_id=update.effective_chat.id,
-            photo=buf1,
-            caption=f"{EMOJI['grafico']} Análise Financeira Mensal"
-        )
+        buf1 = salvar_grafico('analise_mensal')
         
         # Gráfico de tendência de saldo
         plt.figure(figsize=(12, 6))
         
-        # Ordenar por data e criar uma coluna de saldo acumulado
-        df_ordenado = df.sort_values('data')
-        df_ordenado['valor_ajustado'] = df_ordenado.apply(lambda row: row['valor'] if row['tipo'] == 'entrada' else -row['valor'], axis=1)
-        df_ordenado['saldo_acumulado'] = df_ordenado['valor_ajustado'].cumsum()
+        # Saldo no fim de cada dia com movimento, a partir do índice de saldos, reduzido preservando a forma da curva
+        dias, saldos = curva_saldos(obter_indice_saldos(user_id, dados))
+        datas = np.array(dias, dtype='datetime64[D]')
+        mantidos = reduzir_serie_lttb(datas.astype(np.int64), saldos)
         
         # Plotar a tendência do saldo
-        plt.plot(df_ordenado['data'], df_ordenado['saldo_acumulado'], 'b-', linewidth=2.5, marker='o', markersize=4)
+        plt.plot(datas[mantidos], np.asarray(saldos)[mantidos], 'b-', linewidth=2.5, marker=marcador_linha(len(mantidos)), markersize=4)
         
         plt.xlabel('Data', fontsize=12)
         plt.ylabel('Saldo Acumulado (R$)', fontsize=12)
@@ -2427,28 +4752,25 @@ async def gerar_grafico_analise(update: Update, context: ContextTypes.DEFAULT_TY
         plt.tight_layout()
         
         # Salvar em memória
-        buf2 = BytesIO()
-        plt.savefig(buf2, format='png', dpi=100)
-        buf2.seek(0)
+        buf2 = salvar_grafico('analise_saldo')
         
-        # Enviar segundo gráfico
-        await context.bot.send_photo(
-            chat_id=update.effective_chat.id,
-            photo=buf2,
-            caption=f"{EMOJI['grafico']} Evolução do Saldo ao Longo do Tempo"
-        )
+        # Enviar os dois gráficos em um único álbum
+        await enviar_fotos(context, update.effective_chat.id, [
+            (buf1, f"{EMOJI['grafico']} Análise Financeira Mensal"),
+            (buf2, f"{EMOJI['grafico']} Evolução do Saldo ao Longo do Tempo")
+        ])
         
         # Atualizar mensagem
         await query.edit_message_text(
             f"{EMOJI['sucesso']} Análise financeira gerada com sucesso!",
-            reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton(f"{EMOJI['voltar']} Voltar ao Menu", callback_data='voltar_menu')]])
+            reply_markup=criar_teclado_botao('voltar', 'Voltar ao Menu', 'voltar_menu')
         )
         
     except Exception as e:
         logger.error(f"Erro ao gerar análise: {e}")
         await query.edit_message_text(
             f"{EMOJI['erro']} Ocorreu um erro ao gerar a análise financeira. Por favor, tente novamente.",
-            reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton(f"{EMOJI['voltar']} Voltar", callback_data='voltar_menu')]])
+            reply_markup=criar_teclado_botao('voltar', 'Voltar', 'voltar_menu')
         )
     
     return MENU_PRINCIPAL
@@ -2464,50 +4786,1037 @@ async def confirmar_apagar_dados(update: Update, context: ContextTypes.DEFAULT_T
         user_id = update.effective_user.id
         
         # Criar estrutura inicial dos dados
-        dados_iniciais = {
-            "transacoes": [],
-            "categorias_entrada": ["Venda", "Investimento", "Salário", "Outro"],
-            "categorias_saida": ["Mercadoria", "Pagamento", "Compra", "Alimentação", "Transporte", "Outro"],
-            "saldo_atual": 0,
-            "data_ultimo_fechamento": None,
-            "metas": {
-                "economia_mensal": 0,
-                "limite_gastos": 0,
-            },
-            "notificacoes": {
-                "alerta_limite": True,
-                "lembrete_diario": False
-            }
-        }
+        dados_iniciais = criar_dados_iniciais()
         
         # Salvar dados iniciais
         salvar_dados_usuario(user_id, dados_iniciais)
-        
-        # Atualizar dados em context
-        context.user_data['dados'] = dados_iniciais
+        invalidar_teclados_categorias(user_id)
+        invalidar_indice_saldos(user_id)
+        remover_livro_transacoes(user_id)
+        atualizar_recorrentes_usuario(user_id, dados_iniciais)
+        atualizar_lembrete_usuario(user_id, dados_iniciais['notificacoes'])
+        atualizar_fechamento_automatico_usuario(user_id, dados_iniciais['notificacoes'])
         
         await query.edit_message_text(
             f"{EMOJI['sucesso']} *Dados apagados com sucesso!*\n\n"
             f"Todos os seus dados foram resetados para o estado inicial.\n\n"
             f"Seu saldo atual é: *{formatar_valor(0)}*",
             parse_mode='Markdown',
-            reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton(f"{EMOJI['voltar']} Voltar ao Menu", callback_data='voltar_menu')]])
+            reply_markup=criar_teclado_botao('voltar', 'Voltar ao Menu', 'voltar_menu')
         )
         
         return MENU_PRINCIPAL
     
     return CONFIRMAR_APAGAR_DADOS
 
-# Função principal
-def main():
-    # Obter o token do bot (substitua pelo seu token real)
-    TOKEN = "7965686857:AAHyp28GLe1p5xklh-pcS-QZCByE45T90J8"
+# Partição de usuários atendida por este processo no modo com vários workers: (índice, total).
+# None quando um único processo atende todos os usuários.
+_particao = None
+
+# Função para obter a partição (worker) de um usuário; crc32 é estável entre processos e execuções
+def particao_usuario(user_id, total):
+    return zlib.crc32(str(user_id).encode()) % total
+
+# Função para verificar se um usuário é atendido por este processo
+def pertence_a_particao(user_id):
+    return _particao is None or particao_usuario(user_id, _particao[1]) == _particao[0]
+
+# Função para obter o nome de um arquivo de índice deste processo
+# (cada worker tem os seus; mudando o número de workers, os índices são remontados)
+def nome_arquivo_particao(nome):
+    if _particao is None:
+        return nome
+    base, extensao = os.path.splitext(nome)
+    return f"{base}_{_particao[0]}de{_particao[1]}{extensao}"
+
+# Índice em memória dos lembretes diários: minuto do dia -> usuários que devem ser lembrados.
+# Fica salvo em um arquivo pequeno para não precisar varrer DATA_DIR a cada inicialização.
+ARQUIVO_INDICE_LEMBRETES = "indice_lembretes.json"
+LEMBRETES_POR_SEGUNDO = 20  # abaixo do limite global de envios, deixando folga para as respostas
+MAX_MINUTOS_ATRASO_LEMBRETE = 5  # lembretes atrasados mais que isso (ex: bot fora do ar) são descartados
+
+_lembretes_por_minuto = {}
+_minuto_lembrete_usuario = {}
+_fila_notificacoes = deque()  # (user_id, texto) a enviar respeitando a taxa de envio
+_ultimo_minuto_verificado = None
+
+# Função para converter "HH:MM" em minuto do dia
+def minuto_do_dia(horario):
+    hora, minuto = map(int, horario.split(':'))
+    return hora * 60 + minuto
+
+# Função para incluir, mover ou remover (horario=None) um usuário do índice de lembretes
+def registrar_lembrete(user_id, horario):
+    minuto_anterior = _minuto_lembrete_usuario.pop(user_id, None)
+    if minuto_anterior is not None:
+        _lembretes_por_minuto[minuto_anterior].discard(user_id)
+    
+    if horario:
+        minuto = minuto_do_dia(horario)
+        _minuto_lembrete_usuario[user_id] = minuto
+        _lembretes_por_minuto.setdefault(minuto, set()).add(user_id)
+
+# Função para salvar o índice de lembretes
+def salvar_indice_lembretes():
+    indice = {
+        str(user_id): f"{minuto // 60:02d}:{minuto % 60:02d}"
+        for user_id, minuto in _minuto_lembrete_usuario.items()
+    }
+    with open(f"{DATA_DIR}/{nome_arquivo_particao(ARQUIVO_INDICE_LEMBRETES)}", 'w', encoding='utf-8') as f:
+        json.dump(indice, f)
+
+# Função para listar os IDs dos usuários com dados salvos (apenas os da partição deste processo)
+def listar_usuarios():
+    for nome in os.listdir(DATA_DIR):
+        if nome.startswith('dados_') and nome.endswith('.json'):
+            user_id = int(nome[len('dados_'):-len('.json')])
+            if pertence_a_particao(user_id):
+                yield user_id
+
+# Função para carregar o índice de lembretes (na primeira execução, monta varrendo DATA_DIR)
+def carregar_indice_lembretes():
+    try:
+        with open(f"{DATA_DIR}/{nome_arquivo_particao(ARQUIVO_INDICE_LEMBRETES)}", 'r', encoding='utf-8') as f:
+            for user_id, horario in json.load(f).items():
+                registrar_lembrete(int(user_id), horario)
+    except (FileNotFoundError, json.JSONDecodeError):
+        logger.info("Índice de lembretes não encontrado, montando a partir dos dados dos usuários")
+        for user_id in listar_usuarios():
+            notificacoes = carregar_dados_usuario(user_id)['notificacoes']
+            if notificacoes.get('lembrete_diario', False):
+                registrar_lembrete(user_id, notificacoes.get('horario_lembrete', HORARIO_LEMBRETE_PADRAO))
+        salvar_indice_lembretes()
+    
+    logger.info(f"{len(_minuto_lembrete_usuario)} usuários com lembrete diário ativo")
+
+# Função para atualizar o índice de lembretes após uma mudança nas preferências do usuário
+def atualizar_lembrete_usuario(user_id, notificacoes):
+    horario = notificacoes.get('horario_lembrete', HORARIO_LEMBRETE_PADRAO) if notificacoes.get('lembrete_diario', False) else None
+    if _minuto_lembrete_usuario.get(user_id) != (minuto_do_dia(horario) if horario else None):
+        registrar_lembrete(user_id, horario)
+        salvar_indice_lembretes()
+
+# Job executado a cada minuto: coloca na fila apenas os usuários com lembrete nos minutos que passaram
+async def verificar_lembretes(context: ContextTypes.DEFAULT_TYPE):
+    global _ultimo_minuto_verificado
+    
+    agora = datetime.datetime.now()
+    minuto_atual = agora.hour * 60 + agora.minute
+    
+    minuto = _ultimo_minuto_verificado
+    if minuto is None or (minuto_atual - minuto) % 1440 > MAX_MINUTOS_ATRASO_LEMBRETE:
+        minuto = (minuto_atual - 1) % 1440
+    
+    while minuto != minuto_atual:
+        minuto = (minuto + 1) % 1440
+        _fila_notificacoes.extend((user_id, TEXTO_LEMBRETE) for user_id in _lembretes_por_minuto.get(minuto, ()))
+    
+    _ultimo_minuto_verificado = minuto_atual
+
+# Texto do lembrete diário
+TEXTO_LEMBRETE = (
+    f"{EMOJI['hora']} *Lembrete Diário*\n\n"
+    f"Não esqueça de registrar as entradas e saídas de hoje!\n\n"
+    f"Use /start para abrir o menu."
+)
+
+# Função para enviar uma notificação agendada (lembrete, resumo de fechamento) a um usuário
+async def enviar_notificacao(bot, user_id, texto):
+    try:
+        await bot.send_message(chat_id=user_id, text=texto, parse_mode='Markdown')
+    except Forbidden:
+        # O usuário bloqueou o bot: parar de enviar notificações agendadas
+        logger.info(f"Usuário {user_id} bloqueou o bot, removendo notificações agendadas")
+        registrar_lembrete(user_id, None)
+        salvar_indice_lembretes()
+        if user_id in _usuarios_fechamento_automatico:
+            _usuarios_fechamento_automatico.discard(user_id)
+            salvar_indice_fechamento_automatico()
+    except TelegramError as e:
+        logger.warning(f"Erro ao enviar notificação para {user_id}: {e}")
+
+# Job executado a cada segundo: esvazia a fila de notificações respeitando a taxa de envio
+async def enviar_notificacoes_pendentes(context: ContextTypes.DEFAULT_TYPE):
+    lote = [_fila_notificacoes.popleft() for _ in range(min(LEMBRETES_POR_SEGUNDO, len(_fila_notificacoes)))]
+    if lote:
+        await asyncio.gather(*(enviar_notificacao(context.bot, user_id, texto) for user_id, texto in lote))
+
+# Usuários com fechamento de caixa automático (também salvo em arquivo, como o índice de lembretes)
+ARQUIVO_INDICE_FECHAMENTO = "indice_fechamento_automatico.json"
+HORARIO_FECHAMENTO_AUTOMATICO = datetime.time(0, 5)  # fecha o dia anterior logo após a meia-noite
+USUARIOS_POR_LOTE_FECHAMENTO = 500  # usuários entre uma gravação e outra do arquivo de progresso
+
+_usuarios_fechamento_automatico = set()
+
+# Função para salvar o índice de usuários com fechamento automático
+def salvar_indice_fechamento_automatico():
+    with open(f"{DATA_DIR}/{nome_arquivo_particao(ARQUIVO_INDICE_FECHAMENTO)}", 'w', encoding='utf-8') as f:
+        json.dump(sorted(_usuarios_fechamento_automatico), f)
+
+# Função para carregar o índice de fechamento automático (na primeira execução, monta varrendo DATA_DIR)
+def carregar_indice_fechamento_automatico():
+    try:
+        with open(f"{DATA_DIR}/{nome_arquivo_particao(ARQUIVO_INDICE_FECHAMENTO)}", 'r', encoding='utf-8') as f:
+            _usuarios_fechamento_automatico.update(json.load(f))
+    except (FileNotFoundError, json.JSONDecodeError):
+        for user_id in listar_usuarios():
+            if carregar_dados_usuario(user_id)['notificacoes'].get('fechamento_automatico', False):
+                _usuarios_fechamento_automatico.add(user_id)
+        salvar_indice_fechamento_automatico()
     
-    # Criar o aplicativo
-    application = Application.builder().token(TOKEN).build()
+    logger.info(f"{len(_usuarios_fechamento_automatico)} usuários com fechamento automático ativo")
+
+# Função para atualizar o índice após uma mudança nas preferências do usuário
+def atualizar_fechamento_automatico_usuario(user_id, notificacoes):
+    ativo = notificacoes.get('fechamento_automatico', False)
+    if ativo != (user_id in _usuarios_fechamento_automatico):
+        if ativo:
+            _usuarios_fechamento_automatico.add(user_id)
+        else:
+            _usuarios_fechamento_automatico.discard(user_id)
+        salvar_indice_fechamento_automatico()
+
+# Função para verificar se o dia já foi fechado (manualmente ou em uma execução anterior interrompida)
+def fechamento_registrado(dados, dia):
+    data_fechamento = dia.strftime("%d/%m/%Y")
+    return any(f['data'] == data_fechamento for f in dados.get('fechamentos', [])[-5:])
+
+# Função para fechar o caixa do dia de um usuário. Roda no loop de eventos, o mesmo que atende os handlers do
+# usuário, para que uma gravação não sobrescreva a outra. Retorna o fechamento se o usuário deve receber o resumo.
+def fechar_caixa_automatico(user_id, dia):
+    dados = carregar_dados_usuario(user_id)
+    if fechamento_registrado(dados, dia):
+        return None
+    
+    fechamento = calcular_fechamento(user_id, dados, dia)
+    fechamento['automatico'] = True
+    dados.setdefault('fechamentos', []).append(fechamento)
+    ultimo = dados.get('data_ultimo_fechamento')
+    if not ultimo or analisar_data_br(ultimo) < dia:
+        dados['data_ultimo_fechamento'] = fechamento['data']
+    salvar_dados_usuario(user_id, dados)
+    return fechamento if dados['notificacoes'].get('resumo_fechamento', True) else None
+
+# Job noturno: fecha o caixa do dia anterior para todos os usuários que optaram pelo fechamento automático.
+# O progresso é salvo a cada lote, então uma execução interrompida continua de onde parou.
+async def executar_fechamento_automatico(context: ContextTypes.DEFAULT_TYPE):
+    dia_iso = (datetime.date.today() - datetime.timedelta(days=1)).isoformat()
+    dia = datetime.datetime.strptime(dia_iso, "%Y-%m-%d")
+    arquivo_progresso = f"{DATA_DIR}/{nome_arquivo_particao(f'fechamento_automatico_{dia_iso}.json')}"
+    
+    try:
+        with open(arquivo_progresso, 'r', encoding='utf-8') as f:
+            progresso = json.load(f)
+    except (FileNotFoundError, json.JSONDecodeError):
+        progresso = {'concluido': False, 'processados': []}
+    
+    if progresso['concluido']:
+        return
+    
+    processados = set(progresso['processados'])
+    pendentes = sorted(_usuarios_fechamento_automatico - processados)
+    lotes = [pendentes[i:i + USUARIOS_POR_LOTE_FECHAMENTO] for i in range(0, len(pendentes), USUARIOS_POR_LOTE_FECHAMENTO)]
+    
+    logger.info(f"Fechamento automático de {dia_iso}: {len(pendentes)} usuários pendentes em {len(lotes)} lotes")
+    inicio = datetime.datetime.now()
+    
+    for lote in lotes:
+        for user_id in lote:
+            try:
+                fechamento = fechar_caixa_automatico(user_id, dia)
+            except Exception as e:
+                logger.error(f"Erro no fechamento automático do usuário {user_id}: {e}")
+                fechamento = None
+            if fechamento:
+                texto = f"{EMOJI['fechamento']} *Fechamento de Caixa Automático*\n\n" + formatar_resumo_fechamento(fechamento)
+                _fila_notificacoes.append((user_id, texto))
+            await asyncio.sleep(0)  # deixa os handlers rodarem entre um usuário e outro
+        
+        # Registrar o progresso: lotes concluídos não são refeitos
+        processados.update(lote)
+        with open(arquivo_progresso, 'w', encoding='utf-8') as f:
+            json.dump({'concluido': False, 'processados': sorted(processados)}, f)
+    
+    with open(arquivo_progresso, 'w', encoding='utf-8') as f:
+        json.dump({'concluido': True, 'processados': sorted(processados)}, f)
+
+    # Remover arquivos de progresso de dias anteriores (de qualquer partição)
+    prefixo = "fechamento_automatico_"
+    for arquivo in os.listdir(DATA_DIR):
+        if arquivo.startswith(prefixo) and arquivo[len(prefixo):len(prefixo) + 10] < dia_iso:
+            try:
+                os.remove(f"{DATA_DIR}/{arquivo}")
+            except FileNotFoundError:
+                pass  # outro worker já removeu
+
+    logger.info(f"Fechamento automático de {dia_iso} concluído em {(datetime.datetime.now() - inicio).total_seconds():.1f}s")
+
+# Lançamentos recorrentes: um heap com o próximo vencimento de cada usuário (o menor entre as recorrências dele),
+# então o job periódico só olha o topo. Um usuário reagendado deixa a entrada antiga no heap, que é
+# descartada quando chega ao topo. O índice fica salvo em arquivo, como o dos lembretes.
+ARQUIVO_INDICE_RECORRENTES = "indice_recorrentes.json"
+HORARIO_RECORRENTES = datetime.time(8, 0)  # horário em que as recorrências do dia são lançadas
+INTERVALO_NOVA_TENTATIVA_RECORRENTES = 3600  # segundos até tentar de novo um usuário cujo lançamento falhou
+INTERVALO_RECORRENTES = 5  # segundos entre as execuções do job
+USUARIOS_POR_EXECUCAO_RECORRENTES = 50  # os demais vencidos ficam para a próxima execução (não travar o loop às 8h)
+
+_heap_recorrentes = []  # (timestamp do vencimento, user_id)
+_vencimento_recorrentes_usuario = {}  # user_id -> timestamp do próximo vencimento
+
+# Função para obter a próxima data de uma recorrência depois de uma data
+def proxima_data_recorrente(recorrente, depois_de):
+    if recorrente['frequencia'] == 'semanal':
+        return depois_de + datetime.timedelta(days=(recorrente['dia'] - depois_de.weekday() - 1) % 7 + 1)
+    
+    # Mensal: o dia é limitado ao último dia dos meses mais curtos
+    ano, mes = depois_de.year, depois_de.month
+    while True:
+        data = datetime.date(ano, mes, min(recorrente['dia'], calendar.monthrange(ano, mes)[1]))
+        if data > depois_de:
+            return data
+        ano, mes = mes_anterior(ano, mes, -1)
+
+# Função para obter o timestamp do próximo vencimento entre as recorrências de um usuário (None se não houver)
+def vencimento_recorrentes(dados):
+    if not dados.get('recorrentes'):
+        return None
+    proxima = min(datetime.date.fromisoformat(recorrente['proxima']) for recorrente in dados['recorrentes'])
+    return datetime.datetime.combine(proxima, HORARIO_RECORRENTES).timestamp()
+
+# Função para incluir, mover ou remover (vencimento=None) um usuário do heap de recorrências
+def registrar_vencimento_recorrentes(user_id, vencimento):
+    if vencimento is None:
+        _vencimento_recorrentes_usuario.pop(user_id, None)
+        return
+    _vencimento_recorrentes_usuario[user_id] = vencimento
+    heapq.heappush(_heap_recorrentes, (vencimento, user_id))
+
+# Função para salvar o índice de recorrências
+def salvar_indice_recorrentes():
+    with open(f"{DATA_DIR}/{nome_arquivo_particao(ARQUIVO_INDICE_RECORRENTES)}", 'w', encoding='utf-8') as f:
+        json.dump({str(user_id): vencimento for user_id, vencimento in _vencimento_recorrentes_usuario.items()}, f)
+
+# Função para carregar o índice de recorrências (na primeira execução, monta varrendo DATA_DIR)
+def carregar_indice_recorrentes():
+    try:
+        with open(f"{DATA_DIR}/{nome_arquivo_particao(ARQUIVO_INDICE_RECORRENTES)}", 'r', encoding='utf-8') as f:
+            for user_id, vencimento in json.load(f).items():
+                registrar_vencimento_recorrentes(int(user_id), vencimento)
+    except (FileNotFoundError, json.JSONDecodeError):
+        logger.info("Índice de recorrências não encontrado, montando a partir dos dados dos usuários")
+        for user_id in listar_usuarios():
+            registrar_vencimento_recorrentes(user_id, vencimento_recorrentes(carregar_dados_usuario(user_id)))
+        salvar_indice_recorrentes()
+    
+    logger.info(f"{len(_vencimento_recorrentes_usuario)} usuários com lançamentos recorrentes")
+
+# Função para atualizar o heap após uma mudança nas recorrências do usuário
+def atualizar_recorrentes_usuario(user_id, dados):
+    vencimento = vencimento_recorrentes(dados)
+    if _vencimento_recorrentes_usuario.get(user_id) != vencimento:
+        registrar_vencimento_recorrentes(user_id, vencimento)
+        salvar_indice_recorrentes()
+
+# Função para registrar as ocorrências vencidas até "agora" (inclusive as perdidas com o bot fora do ar).
+# Usa o mesmo registro de transações do menu, que atualiza saldo, categorias e totais.
+def lancar_recorrentes_vencidas(dados, agora):
+    transacoes = []
+    for recorrente in dados['recorrentes']:
+        proxima = datetime.date.fromisoformat(recorrente['proxima'])
+        while datetime.datetime.combine(proxima, HORARIO_RECORRENTES) <= agora:
+            transacoes.append({
+                'tipo': recorrente['tipo'],
+                'categoria_id': recorrente['categoria_id'],
+                'valor': recorrente['valor'],
+                'descricao': recorrente['descricao'],
+                'data': datetime.datetime.combine(proxima, HORARIO_RECORRENTES).strftime("%d/%m/%Y %H:%M:%S"),
+                'id': str(uuid.uuid4()),
+                'recorrente_id': recorrente['id']
+            })
+            proxima = proxima_data_recorrente(recorrente, proxima)
+        recorrente['proxima'] = proxima.isoformat()
+    
+    if transacoes:
+        registrar_transacoes(dados, transacoes)
+    return transacoes
+
+# Job executado a cada INTERVALO_RECORRENTES: lança as recorrências de até USUARIOS_POR_EXECUCAO_RECORRENTES
+# usuários cujo vencimento já passou. Cada usuário é carregado, lançado e gravado sem await no meio,
+# então um handler do mesmo usuário não grava uma cópia anterior por cima.
+async def processar_recorrentes(context: ContextTypes.DEFAULT_TYPE):
+    agora = datetime.datetime.now()
+    limite = agora.timestamp()
+    processados = 0
+    
+    while _heap_recorrentes and _heap_recorrentes[0][0] <= limite and processados < USUARIOS_POR_EXECUCAO_RECORRENTES:
+        vencimento, user_id = heapq.heappop(_heap_recorrentes)
+        if _vencimento_recorrentes_usuario.get(user_id) != vencimento:
+            continue  # entrada antiga: o usuário foi reagendado ou não tem mais recorrências
+        processados += 1
+        
+        try:
+            dados = carregar_dados_usuario(user_id)
+            transacoes = lancar_recorrentes_vencidas(dados, agora)
+            if transacoes:
+                mensagem_alerta = verificar_limite_gastos(dados, transacoes)
+                salvar_dados_usuario(user_id, dados)
+                
+                texto = f"{EMOJI['recorrente']} *Lançamentos Recorrentes*\n\n"
+                for transacao in transacoes:
+                    texto += (
+                        f"{EMOJI[transacao['tipo']]} {escape_markdown(transacao['descricao'])}: "
+                        f"*{formatar_valor(transacao['valor'])}* ({transacao['data'][:10]})\n"
+                    )
+                texto += f"\n{EMOJI['saldo']} Seu saldo atual é: *{formatar_valor(dados['saldo_atual'])}*{mensagem_alerta}"
+                _fila_notificacoes.append((user_id, texto))
+            registrar_vencimento_recorrentes(user_id, vencimento_recorrentes(dados))
+        except Exception as e:
+            logger.error(f"Erro nos lançamentos recorrentes do usuário {user_id}: {e}")
+            registrar_vencimento_recorrentes(user_id, limite + INTERVALO_NOVA_TENTATIVA_RECORRENTES)
+        await asyncio.sleep(0)  # deixa os handlers rodarem entre um usuário e outro
+    
+    if processados:
+        salvar_indice_recorrentes()
+
+# Limites de envio para a Bot API (valores recomendados pelo Telegram)
+LIMITE_ENVIOS_GLOBAL_POR_SEGUNDO = 30
+LIMITE_ENVIOS_POR_CHAT = 3  # rajada máxima por chat privado, reposta a 1 mensagem por segundo
+MAX_TENTATIVAS_ENVIO = 3  # novas tentativas após flood-wait (429) ou falha de rede
+
+# Limitador de requisições à Bot API: limites global, por grupo e por chat privado,
+# novas tentativas respeitando o retry_after do Telegram e backoff para falhas de rede
+class LimitadorEnvios(AIORateLimiter):
+    def __init__(self, max_tentativas=MAX_TENTATIVAS_ENVIO):
+        super().__init__(
+            overall_max_rate=LIMITE_ENVIOS_GLOBAL_POR_SEGUNDO,
+            overall_time_period=1,
+            max_retries=max_tentativas
+        )
+        self._max_tentativas = max_tentativas
+        self._limitadores_chat = {}
+    
+    # Função para obter o limitador de um chat privado (descartando os que estão ociosos)
+    def _limitador_chat(self, chat_id):
+        if len(self._limitadores_chat) > 1024:
+            for chave in [c for c, limitador in self._limitadores_chat.items() if limitador.has_capacity(LIMITE_ENVIOS_POR_CHAT)]:
+                del self._limitadores_chat[chave]
+        
+        if chat_id not in self._limitadores_chat:
+            self._limitadores_chat[chat_id] = AsyncLimiter(LIMITE_ENVIOS_POR_CHAT, LIMITE_ENVIOS_POR_CHAT)
+        return self._limitadores_chat[chat_id]
+    
+    async def process_request(self, callback, args, kwargs, endpoint, data, rate_limit_args):
+        chat_id = data.get("chat_id")
+        limitar_chat = endpoint.startswith("send") and isinstance(chat_id, int) and chat_id > 0
+        
+        for tentativa in range(self._max_tentativas + 1):
+            CHAMADAS_API.labels(endpoint).inc()
+            try:
+                if limitar_chat:
+                    async with self._limitador_chat(chat_id):
+                        return await super().process_request(callback, args, kwargs, endpoint, data, rate_limit_args)
+                return await super().process_request(callback, args, kwargs, endpoint, data, rate_limit_args)
+            except TelegramError as e:
+                ERROS_API.labels(endpoint, type(e).__name__).inc()
+                # Só falhas de transporte são repetidas. BadRequest herda de NetworkError no PTB, mas a mesma
+                # requisição vai falhar de novo ("message is not modified", erro de Markdown)
+                if not isinstance(e, NetworkError) or isinstance(e, (BadRequest, Forbidden, InvalidToken)):
+                    raise
+                # Um timeout em um envio pode ter sido entregue: não repetir para não duplicar mensagens
+                if tentativa == self._max_tentativas or (isinstance(e, TimedOut) and endpoint.startswith("send")):
+                    raise
+                espera = 0.5 * (2 ** tentativa) + random.uniform(0, 0.5)
+                logger.warning(f"Falha de rede em {endpoint} ({e}). Nova tentativa em {espera:.1f}s")
+                await asyncio.sleep(espera)
+
+# Persistência do estado das conversas e do user_data entre reinícios
+ARQUIVO_PERSISTENCIA = "conversas.sqlite3"
+INTERVALO_PERSISTENCIA = 15  # segundos; as alterações feitas nesse intervalo são gravadas juntas
+# Chaves do user_data que não são gravadas: uma importação pendente e o último relatório (usado para exportar
+# e gerar o gráfico) podem ter milhares de transações. Depois de um reinício, o usuário gera o relatório de novo.
+# Os dados do usuário não ficam no user_data: cada handler os carrega do arquivo, para nunca gravar uma cópia antiga.
+CHAVES_SESSAO_NAO_PERSISTIDAS = frozenset({'importacao', 'relatorio_atual'})
+
+# user_data que deixa de fora as chaves não persistidas na cópia que o PTB faz para a persistência
+class DadosSessao(dict):
+    def __deepcopy__(self, memo):
+        return {
+            chave: copy.deepcopy(valor, memo)
+            for chave, valor in self.items()
+            if chave not in CHAVES_SESSAO_NAO_PERSISTIDAS
+        }
+
+# Persistência em SQLite: uma linha por conversa e uma por chave do user_data,
+# regravando apenas as chaves que mudaram desde a última gravação
+class PersistenciaConversas(BasePersistence):
+    def __init__(self, arquivo=None, update_interval=INTERVALO_PERSISTENCIA):
+        super().__init__(
+            store_data=PersistenceInput(bot_data=False, chat_data=False, user_data=True, callback_data=False),
+            update_interval=update_interval
+        )
+        # O arquivo é compartilhado pelos workers; cada um lê e grava apenas os usuários da sua partição
+        self._conexao = sqlite3.connect(arquivo or f"{DATA_DIR}/{ARQUIVO_PERSISTENCIA}", timeout=30)
+        self._conexao.execute("PRAGMA journal_mode=WAL")
+        self._conexao.execute("PRAGMA synchronous=NORMAL")
+        self._conexao.execute(
+            "CREATE TABLE IF NOT EXISTS conversas (nome TEXT, chave TEXT, estado TEXT, PRIMARY KEY (nome, chave))"
+        )
+        self._conexao.execute(
+            "CREATE TABLE IF NOT EXISTS sessoes (user_id INTEGER, chave TEXT, valor BLOB, PRIMARY KEY (user_id, chave))"
+        )
+        self._conexao.commit()
+        self._resumos = {}  # user_id -> {chave: hash do valor gravado}
+        self._commit_agendado = False
+    
+    # Função para agrupar as escritas de uma rodada de atualização em uma única transação
+    def _agendar_commit(self):
+        if not self._commit_agendado:
+            self._commit_agendado = True
+            asyncio.get_running_loop().call_soon(self._commit)
+    
+    def _commit(self):
+        # O flush pode já ter gravado tudo (e fechado a conexão)
+        if self._commit_agendado:
+            self._commit_agendado = False
+            self._conexao.commit()
+    
+    async def get_user_data(self):
+        sessoes = {}
+        for user_id, chave, valor in self._conexao.execute("SELECT user_id, chave, valor FROM sessoes"):
+            if not pertence_a_particao(user_id):
+                continue
+            # O resumo é guardado mesmo se o valor não puder ser lido, para a linha ser apagada na próxima gravação
+            self._resumos.setdefault(user_id, {})[chave] = hashlib.blake2b(valor, digest_size=16).digest()
+            try:
+                sessoes.setdefault(user_id, DadosSessao())[chave] = pickle.loads(valor)
+            except Exception as e:
+                logger.warning(f"Não foi possível restaurar '{chave}' do usuário {user_id}: {e}")
+        return sessoes
+    
+    async def update_user_data(self, user_id, data):
+        resumos = self._resumos.setdefault(user_id, {})
+        alterou = False
+        
+        for chave, valor in data.items():
+            if chave in CHAVES_SESSAO_NAO_PERSISTIDAS:
+                continue
+            try:
+                serializado = pickle.dumps(valor, pickle.HIGHEST_PROTOCOL)
+            except (pickle.PicklingError, TypeError, AttributeError) as e:
+                logger.warning(f"'{chave}' do usuário {user_id} não pode ser persistido: {e}")
+                continue
+            resumo = hashlib.blake2b(serializado, digest_size=16).digest()
+            if resumos.get(chave) != resumo:
+                self._conexao.execute(
+                    "INSERT OR REPLACE INTO sessoes (user_id, chave, valor) VALUES (?, ?, ?)",
+                    (user_id, chave, serializado)
+                )
+                resumos[chave] = resumo
+                alterou = True
+        
+        for chave in [c for c in resumos if c not in data or c in CHAVES_SESSAO_NAO_PERSISTIDAS]:
+            self._conexao.execute("DELETE FROM sessoes WHERE user_id = ? AND chave = ?", (user_id, chave))
+            del resumos[chave]
+            alterou = True
+        
+        if alterou:
+            self._agendar_commit()
+    
+    async def drop_user_data(self, user_id):
+        self._conexao.execute("DELETE FROM sessoes WHERE user_id = ?", (user_id,))
+        self._resumos.pop(user_id, None)
+        self._agendar_commit()
+    
+    async def get_conversations(self, name):
+        conversas = {}
+        for chave, estado in self._conexao.execute("SELECT chave, estado FROM conversas WHERE nome = ?", (name,)):
+            chave = tuple(json.loads(chave))
+            # A chave da conversa é (chat_id, user_id)
+            if pertence_a_particao(chave[-1]):
+                conversas[chave] = json.loads(estado)
+        return conversas
+    
+    async def update_conversation(self, name, key, new_state):
+        if new_state is None:
+            self._conexao.execute("DELETE FROM conversas WHERE nome = ? AND chave = ?", (name, json.dumps(key)))
+        else:
+            self._conexao.execute(
+                "INSERT OR REPLACE INTO conversas (nome, chave, estado) VALUES (?, ?, ?)",
+                (name, json.dumps(key), json.dumps(new_state))
+            )
+        self._agendar_commit()
+    
+    async def flush(self):
+        self._commit_agendado = False
+        self._conexao.commit()
+        self._conexao.close()
+    
+    # Dados que este bot não persiste
+    async def get_chat_data(self):
+        return {}
+    
+    async def get_bot_data(self):
+        return {}
+    
+    async def get_callback_data(self):
+        return None
+    
+    async def update_chat_data(self, chat_id, data):
+        pass
+    
+    async def update_bot_data(self, data):
+        pass
+    
+    async def update_callback_data(self, data):
+        pass
+    
+    async def drop_chat_data(self, chat_id):
+        pass
+    
+    async def refresh_user_data(self, user_id, user_data):
+        pass
+    
+    async def refresh_chat_data(self, chat_id, chat_data):
+        pass
+    
+    async def refresh_bot_data(self, bot_data):
+        pass
+
+# Administradores que podem usar /perfil (IDs separados por vírgula)
+ADMIN_IDS = {int(x) for x in os.environ.get("ADMIN_IDS", "").split(",") if x.strip()}
+ATUALIZACOES_PERFIL_PADRAO = 20
+LINHAS_RELATORIO_PERFIL = 40
+
+# Perfilamento em andamento (None quando desativado: os handlers só fazem essa verificação)
+_perfilamento = None
+
+# Função para medir a latência e as exceções de um handler
+def medir_handler(callback):
+    nome = callback.__name__
+    
+    @wraps(callback)
+    async def executar(update, context):
+        with LATENCIA_HANDLER.labels(nome).time(), ERROS_HANDLER.labels(nome).count_exceptions():
+            if _perfilamento is not None and (
+                _perfilamento['user_id'] is None or
+                (update.effective_user and update.effective_user.id == _perfilamento['user_id'])
+            ):
+                return await executar_com_perfil(callback, nome, update, context)
+            return await callback(update, context)
+    return executar
+
+# Função para conduzir uma corrotina ligando o cProfile só enquanto ela própria executa: nos awaits o loop
+# roda outras atualizações e tarefas, que assim ficam fora do perfil
+@coroutine
+def executar_passos_com_perfil(corrotina, perfil):
+    valor, excecao = None, None
+    while True:
+        perfil.enable()
+        try:
+            if excecao is None:
+                sinal = corrotina.send(valor)
+            else:
+                sinal = corrotina.throw(excecao)
+        except StopIteration as fim:
+            return fim.value
+        finally:
+            perfil.disable()
+        try:
+            valor, excecao = (yield sinal), None
+        except BaseException as e:
+            valor, excecao = None, e
+
+# Função para executar um handler com o cProfile ativo; ao fim das N atualizações envia o relatório
+async def executar_com_perfil(callback, nome, update, context):
+    global _perfilamento
+    perfilamento = _perfilamento
+    try:
+        return await executar_passos_com_perfil(callback(update, context), perfilamento['perfil'])
+    finally:
+        perfilamento['handlers'][nome] = perfilamento['handlers'].get(nome, 0) + 1
+        perfilamento['restantes'] -= 1
+        if perfilamento['restantes'] <= 0 and _perfilamento is perfilamento:
+            _perfilamento = None
+            await enviar_relatorio_perfil(context.bot, perfilamento)
+
+# Função para gerar o relatório (funções por tempo acumulado e locais de alocação) e enviar ao administrador
+async def enviar_relatorio_perfil(bot, perfilamento):
+    # O tracemalloc deixa todas as alocações mais lentas: para logo após o snapshot, antes de montar o relatório
+    memoria_atual, memoria_pico = tracemalloc.get_traced_memory()
+    snapshot = tracemalloc.take_snapshot()
+    if perfilamento['parar_tracemalloc']:
+        tracemalloc.stop()
+    alocacoes = snapshot.filter_traces([
+        tracemalloc.Filter(False, tracemalloc.__file__),
+        tracemalloc.Filter(False, "<frozen importlib._bootstrap>")
+    ]).statistics('lineno')[:LINHAS_RELATORIO_PERFIL]
+    del snapshot
+    
+    saida = StringIO()
+    alvo = perfilamento['user_id'] or "todos"
+    saida.write(f"Perfil de {sum(perfilamento['handlers'].values())} atualizações (usuário: {alvo})\n")
+    saida.write(f"Início: {perfilamento['inicio']} | Fim: {obter_data_atual_formatada()}\n\n")
+    
+    saida.write("Handlers executados:\n")
+    for nome, quantidade in sorted(perfilamento['handlers'].items(), key=lambda x: x[1], reverse=True):
+        saida.write(f"  {nome}: {quantidade}\n")
+    
+    saida.write(f"\n=== Funções por tempo acumulado (top {LINHAS_RELATORIO_PERFIL}) ===\n")
+    saida.write("Apenas os trechos executados pelos handlers acima; o tempo esperando em awaits não entra.\n")
+    if perfilamento['handlers']:
+        pstats.Stats(perfilamento['perfil'], stream=saida).sort_stats('cumulative').print_stats(LINHAS_RELATORIO_PERFIL)
+    
+    saida.write(f"\n=== Alocações de memória (top {LINHAS_RELATORIO_PERFIL}) ===\n")
+    saida.write("Processo inteiro: inclui as alocações de todas as atualizações e tarefas do período.\n")
+    saida.write(f"Memória rastreada: atual {memoria_atual / 1024:.1f} KB, pico {memoria_pico / 1024:.1f} KB\n")
+    for estatistica in alocacoes:
+        saida.write(f"  {estatistica}\n")
+    
+    arquivo = BytesIO(saida.getvalue().encode('utf-8'))
+    await bot.send_document(
+        chat_id=perfilamento['chat_id'],
+        document=arquivo,
+        filename=f"perfil_{datetime.datetime.now().strftime('%Y%m%d_%H%M%S')}.txt",
+        caption=f"{EMOJI['lupa']} Perfil das últimas {sum(perfilamento['handlers'].values())} atualizações"
+    )
+
+# Comando /perfil (apenas administradores): ativa o cProfile e o tracemalloc nas próximas N atualizações.
+# Uso: /perfil [quantidade] [user_id] | /perfil parar
+async def comando_perfil(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    global _perfilamento
+    if update.effective_user.id not in ADMIN_IDS:
+        return
+    
+    args = context.args or []
+    
+    if args and args[0] == 'parar':
+        if _perfilamento is None:
+            await update.message.reply_text(f"{EMOJI['info']} Nenhum perfilamento em andamento.")
+            return
+        perfilamento, _perfilamento = _perfilamento, None
+        await enviar_relatorio_perfil(context.bot, perfilamento)
+        return
+    
+    try:
+        quantidade = int(args[0]) if args else ATUALIZACOES_PERFIL_PADRAO
+        user_id = int(args[1]) if len(args) > 1 else None
+        if quantidade <= 0:
+            raise ValueError
+    except ValueError:
+        await update.message.reply_text(
+            f"{EMOJI['erro']} Uso: /perfil [quantidade] [user_id] ou /perfil parar"
+        )
+        return
+    
+    if _perfilamento is not None:
+        await update.message.reply_text(
+            f"{EMOJI['alerta']} Já existe um perfilamento em andamento ({_perfilamento['restantes']} atualizações restantes). "
+            f"Use /perfil parar para encerrá-lo."
+        )
+        return
+    
+    parar_tracemalloc = not tracemalloc.is_tracing()
+    if parar_tracemalloc:
+        tracemalloc.start()
+    
+    _perfilamento = {
+        'parar_tracemalloc': parar_tracemalloc,
+        'chat_id': update.effective_chat.id,
+        'user_id': user_id,
+        'restantes': quantidade,
+        'perfil': cProfile.Profile(),
+        'handlers': {},
+        'inicio': obter_data_atual_formatada()
+    }
+    
+    alvo = f"do usuário {user_id}" if user_id else "de todos os usuários"
+    await update.message.reply_text(
+        f"{EMOJI['lupa']} Perfilamento ativado para as próximas {quantidade} atualizações {alvo}. "
+        f"O relatório será enviado aqui."
+    )
+
+# Função para instrumentar todos os handlers (inclusive os estados do ConversationHandler)
+def instrumentar_handlers(handlers):
+    for handler in handlers:
+        if isinstance(handler, ConversationHandler):
+            instrumentar_handlers(handler.entry_points)
+            instrumentar_handlers(handler.fallbacks)
+            for handlers_estado in handler.states.values():
+                instrumentar_handlers(handlers_estado)
+        else:
+            handler.callback = medir_handler(handler.callback)
+
+# Função para expor as métricas em http://127.0.0.1:<porta>/metrics
+def iniciar_servidor_metricas(porta):
+    try:
+        start_http_server(porta, addr='127.0.0.1')
+        logger.info(f"Métricas disponíveis em http://127.0.0.1:{porta}/metrics")
+    except OSError as e:
+        logger.warning(f"Não foi possível iniciar o servidor de métricas na porta {porta}: {e}")
+
+# Modo com vários workers: um despachante recebe as atualizações por webhook e as distribui
+# entre processos conforme o hash do user_id. Cada worker atende sempre os mesmos usuários,
+# com seus próprios caches, índices e limites de envio.
+PORTA_WEBHOOK_PADRAO = 8443
+CAMINHO_WEBHOOK = "/webhook"
+TAMANHO_MAXIMO_ATUALIZACAO = 1024 * 1024
+INTERVALO_SUPERVISAO_WORKERS = 1  # segundos entre verificações de workers que caíram
+ESPERA_PARADA_WORKER = 30  # segundos para um worker terminar as atualizações pendentes ao encerrar
+
+# Função para obter o usuário de uma atualização (JSON da Bot API) sem montar o objeto Update
+def usuario_da_atualizacao(atualizacao):
+    for valor in atualizacao.values():
+        if isinstance(valor, dict):
+            remetente = valor.get('from') or valor.get('user') or valor.get('chat') or {}
+            if 'id' in remetente:
+                return remetente['id']
+    return 0
+
+# Função para obter o socket local pelo qual o despachante entrega as atualizações a um worker
+def caminho_socket_worker(indice):
+    return os.path.abspath(f"{DATA_DIR}/worker_{indice}.sock")
+
+# Função executada em cada processo worker: atende as atualizações da sua partição de usuários
+def executar_worker(indice, total, token, api_url, limitar_envios, porta_metricas):
+    global _particao, LIMITE_ENVIOS_GLOBAL_POR_SEGUNDO, LEMBRETES_POR_SEGUNDO
+    
+    # O encerramento é coordenado pelo despachante (o Ctrl+C chega a todo o grupo de processos)
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    
+    _particao = (indice, total)
+    # Os limites de envio são divididos entre os workers
+    LIMITE_ENVIOS_GLOBAL_POR_SEGUNDO = LIMITE_ENVIOS_GLOBAL_POR_SEGUNDO / total
+    LEMBRETES_POR_SEGUNDO = max(1, LEMBRETES_POR_SEGUNDO // total)
+    
+    if porta_metricas:
+        iniciar_servidor_metricas(porta_metricas + 1 + indice)
+    
+    application = construir_aplicacao(token, api_url=api_url, limitar_envios=limitar_envios)
+    asyncio.run(atender_worker(application, caminho_socket_worker(indice)))
+
+# Função para receber as atualizações do despachante (uma por linha, em JSON) e processá-las
+async def atender_worker(application, caminho_socket):
+    parar = asyncio.Event()
+    asyncio.get_running_loop().add_signal_handler(signal.SIGTERM, parar.set)
+    despachante = multiprocessing.parent_process()
+    
+    async def receber(reader, writer):
+        try:
+            while linha := await reader.readline():
+                await application.update_queue.put(Update.de_json(json.loads(linha), application.bot))
+        except (ConnectionError, ValueError) as e:
+            logger.warning(f"Conexão com o despachante interrompida: {e}")
+        finally:
+            writer.close()
+    
+    async with application:
+        await application.start()
+        
+        # Um socket que ficou de uma execução anterior (worker morto) é substituído
+        if os.path.exists(caminho_socket):
+            os.remove(caminho_socket)
+        servidor = await asyncio.start_unix_server(receber, caminho_socket, limit=TAMANHO_MAXIMO_ATUALIZACAO + 1)
+        logger.info(f"Worker {_particao[0] + 1}/{_particao[1]} pronto")
+        
+        # Encerrar com SIGTERM do despachante, ou se ele terminou sem avisar
+        while not parar.is_set() and (despachante is None or despachante.is_alive()):
+            try:
+                await asyncio.wait_for(parar.wait(), INTERVALO_SUPERVISAO_WORKERS)
+            except asyncio.TimeoutError:
+                pass
+        
+        servidor.close()
+        # As atualizações já na fila da aplicação são processadas antes de parar
+        await application.stop()
+
+# Despachante: servidor HTTP mínimo para o webhook que só lê o user_id e repassa ao worker da partição
+class Despachante:
+    def __init__(self, token, total_workers, api_url=None, limitar_envios=True, porta_metricas=0):
+        self._token = token
+        self._total = total_workers
+        self._api_url = api_url
+        self._limitar_envios = limitar_envios
+        self._porta_metricas = porta_metricas
+        self._segredo = uuid.uuid4().hex
+        
+        # spawn: os workers não herdam o loop de eventos nem as threads do despachante
+        self._contexto = multiprocessing.get_context('spawn')
+        self._workers = [None] * total_workers
+        # Atualizações aguardando entrega, por worker (criadas em executar, dentro do loop):
+        # se um worker cair, as da sua partição esperam até ele ser reiniciado, sem afetar os outros
+        self._pendentes = None
+        self._conexoes = set()
+        self._parando = None
+    
+    def _iniciar_worker(self, indice):
+        worker = self._contexto.Process(
+            target=executar_worker,
+            args=(indice, self._total, self._token, self._api_url, self._limitar_envios, self._porta_metricas),
+            name=f"worker-{indice}"
+        )
+        worker.start()
+        self._workers[indice] = worker
+    
+    # Função para reiniciar os workers que caíram (a partição continua a mesma)
+    async def _supervisionar(self):
+        while not self._parando.is_set():
+            await asyncio.sleep(INTERVALO_SUPERVISAO_WORKERS)
+            for indice, worker in enumerate(self._workers):
+                if not worker.is_alive() and not self._parando.is_set():
+                    logger.warning(f"Worker {indice} terminou (código {worker.exitcode}), reiniciando")
+                    REINICIOS_WORKERS.labels(str(indice)).inc()
+                    self._iniciar_worker(indice)
+    
+    # Função para entregar as atualizações pendentes a um worker, reconectando quando ele reinicia
+    async def _alimentar_worker(self, indice):
+        caminho = caminho_socket_worker(indice)
+        linha = None
+        while True:
+            try:
+                _, writer = await asyncio.open_unix_connection(caminho)
+            except OSError:
+                # Worker ainda iniciando (ou reiniciando)
+                await asyncio.sleep(0.2)
+                continue
+            
+            try:
+                while True:
+                    if linha is None:
+                        linha = await self._pendentes[indice].get()
+                    writer.write(linha)
+                    await writer.drain()
+                    linha = None
+            except (ConnectionError, OSError):
+                logger.warning(f"Conexão com o worker {indice} perdida, aguardando reinício")
+            finally:
+                writer.close()
+    
+    def despachar(self, atualizacao, corpo):
+        indice = particao_usuario(usuario_da_atualizacao(atualizacao), self._total)
+        # Quebras de linha fora de strings são só espaço em JSON (dentro delas seriam inválidas)
+        self._pendentes[indice].put_nowait(corpo.replace(b'\n', b' ') + b'\n')
+        ATUALIZACOES_DESPACHADAS.labels(str(indice)).inc()
+    
+    # Função para tratar uma requisição do webhook; retorna o status HTTP
+    def _receber(self, metodo, caminho, cabecalhos, corpo):
+        if metodo != 'POST' or caminho.split('?')[0] != CAMINHO_WEBHOOK:
+            return HTTPStatus.NOT_FOUND
+        if cabecalhos.get('x-telegram-bot-api-secret-token') != self._segredo:
+            return HTTPStatus.FORBIDDEN
+        try:
+            atualizacao = json.loads(corpo)
+        except ValueError:
+            return HTTPStatus.BAD_REQUEST
+        if not isinstance(atualizacao, dict):
+            return HTTPStatus.BAD_REQUEST
+        self.despachar(atualizacao, corpo)
+        return HTTPStatus.OK
+    
+    # Conexões HTTP/1.1 com keep-alive vindas da Bot API
+    async def _tratar_conexao(self, reader, writer):
+        self._conexoes.add(writer)
+        try:
+            while True:
+                linha = await reader.readline()
+                if not linha:
+                    break
+                metodo, caminho, _ = linha.decode('latin-1').split(' ', 2)
+                
+                cabecalhos = {}
+                while (linha := await reader.readline()) not in (b'\r\n', b'\n', b''):
+                    nome, _, valor = linha.decode('latin-1').partition(':')
+                    cabecalhos[nome.strip().lower()] = valor.strip()
+                
+                tamanho = int(cabecalhos.get('content-length', 0))
+                if tamanho > TAMANHO_MAXIMO_ATUALIZACAO:
+                    status = HTTPStatus.REQUEST_ENTITY_TOO_LARGE
+                else:
+                    status = self._receber(metodo, caminho, cabecalhos, await reader.readexactly(tamanho))
+                
+                writer.write(f"HTTP/1.1 {status.value} {status.phrase}\r\nContent-Length: 0\r\n\r\n".encode('latin-1'))
+                await writer.drain()
+                if status == HTTPStatus.REQUEST_ENTITY_TOO_LARGE:
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError, ValueError):
+            pass
+        finally:
+            self._conexoes.discard(writer)
+            writer.close()
+    
+    def _parar_workers(self):
+        for worker in self._workers:
+            worker.terminate()
+        for worker in self._workers:
+            worker.join(ESPERA_PARADA_WORKER)
+            if worker.is_alive():
+                logger.warning(f"{worker.name} não terminou a tempo, encerrando")
+                worker.kill()
+    
+    async def executar(self, webhook_url, host='0.0.0.0', porta=PORTA_WEBHOOK_PADRAO):
+        self._parando = asyncio.Event()
+        self._pendentes = [asyncio.Queue() for _ in range(self._total)]
+        loop = asyncio.get_running_loop()
+        for sinal in (signal.SIGINT, signal.SIGTERM):
+            loop.add_signal_handler(sinal, self._parando.set)
+        
+        for indice in range(self._total):
+            self._iniciar_worker(indice)
+        tarefas = [asyncio.create_task(self._alimentar_worker(indice)) for indice in range(self._total)]
+        
+        # As atualizações que chegarem enquanto os workers iniciam esperam na fila de cada um
+        servidor = await asyncio.start_server(self._tratar_conexao, host, porta)
+        bot = Bot(self._token, base_url=f"{self._api_url}/bot") if self._api_url else Bot(self._token)
+        async with bot:
+            await bot.set_webhook(url=webhook_url, secret_token=self._segredo, allowed_updates=Update.ALL_TYPES)
+        logger.info(f"Despachante ouvindo em {host}:{porta}{CAMINHO_WEBHOOK} com {self._total} workers")
+        
+        tarefas.append(asyncio.create_task(self._supervisionar()))
+        await self._parando.wait()
+        
+        logger.info("Encerrando o despachante e os workers")
+        servidor.close()
+        for writer in list(self._conexoes):
+            writer.close()
+        
+        # Entregar o que já foi recebido antes de pedir aos workers que parem
+        inicio = time.monotonic()
+        while any(not pendentes.empty() for pendentes in self._pendentes) and time.monotonic() - inicio < ESPERA_PARADA_WORKER:
+            await asyncio.sleep(0.1)
+        for tarefa in tarefas:
+            tarefa.cancel()
+        await loop.run_in_executor(None, self._parar_workers)
+
+# Função para montar o aplicativo com jobs e handlers.
+# api_url permite apontar para outro servidor da Bot API (ex: o servidor falso do teste_carga.py).
+def construir_aplicacao(token, api_url=None, limitar_envios=True, persistir_conversas=True):
+    builder = Application.builder().token(token).context_types(ContextTypes(user_data=DadosSessao))
+    if api_url:
+        builder = builder.base_url(f"{api_url}/bot").base_file_url(f"{api_url}/file/bot")
+    if limitar_envios:
+        builder = builder.rate_limiter(LimitadorEnvios())
+    if persistir_conversas:
+        builder = builder.persistence(PersistenciaConversas())
+    application = builder.build()
+    
+    # Agendar os lembretes diários e o envio das notificações
+    carregar_indice_lembretes()
+    application.job_queue.run_repeating(verificar_lembretes, interval=60, first=60 - datetime.datetime.now().second)
+    application.job_queue.run_repeating(enviar_notificacoes_pendentes, interval=1)
+    
+    # Agendar o fechamento de caixa automático (e retomar uma execução interrompida ao iniciar)
+    carregar_indice_fechamento_automatico()
+    fuso_local = datetime.datetime.now().astimezone().tzinfo
+    application.job_queue.run_daily(executar_fechamento_automatico, time=HORARIO_FECHAMENTO_AUTOMATICO.replace(tzinfo=fuso_local))
+    application.job_queue.run_once(executar_fechamento_automatico, when=30)
+    
+    # Agendar os lançamentos recorrentes (a primeira execução lança o que venceu com o bot fora do ar)
+    carregar_indice_recorrentes()
+    application.job_queue.run_repeating(processar_recorrentes, interval=INTERVALO_RECORRENTES, first=10)
     
     # Adicionar handlers
     conv_handler = ConversationHandler(
+        name="conversa_principal",
+        persistent=persistir_conversas,
         entry_points=[CommandHandler("start", start)],
         states={
             MENU_PRINCIPAL: [
@@ -2575,15 +5884,97 @@ def main():
             CONFIRMAR_APAGAR_DADOS: [
                 CallbackQueryHandler(confirmar_apagar_dados, pattern='^confirmar_apagar_dados$'),
                 CallbackQueryHandler(callback_configuracoes, pattern='^voltar_config$')
+            ],
+            IMPORTAR_EXTRATO: [
+                # block=False: o download e a leitura do extrato não seguram as atualizações dos outros usuários
+                MessageHandler(filters.Document.ALL, receber_extrato, block=False),
+                CallbackQueryHandler(receber_extrato)
+            ],
+            CONFIRMAR_IMPORTACAO: [
+                CallbackQueryHandler(confirmar_importacao)
+            ],
+            REGRAS_CATEGORIZACAO: [
+                CallbackQueryHandler(callback_regras)
+            ],
+            ADICIONAR_REGRA: [
+                MessageHandler(filters.TEXT & ~filters.COMMAND, adicionar_regra),
+                CallbackQueryHandler(adicionar_regra)
+            ],
+            ORCAMENTOS: [
+                MessageHandler(filters.TEXT & ~filters.COMMAND, definir_orcamento),
+                CallbackQueryHandler(callback_orcamentos)
             ]
         },
-        fallbacks=[CommandHandler("start", start)],
+        fallbacks=[
+            CommandHandler("start", start),
+            # Um extrato ou um lançamento rápido podem ser enviados a qualquer momento
+            MessageHandler(filters.Document.ALL, receber_extrato, block=False),
+            MessageHandler(FILTRO_LANCAMENTO_RAPIDO, lancamento_rapido)
+        ],
     )
     
-    application.add_handler(conv_handler)
+    # Lançamento rápido: os comandos e o "Desfazer" valem em qualquer estado da conversa (e fora dela).
+    # O texto com + ou - é fallback da conversa (os estados que esperam um valor digitado têm prioridade)
+    # e também é tratado fora dela.
+    handlers_lancamento_rapido = [
+        CommandHandler(["s", "e"], lancamento_rapido),
+        CallbackQueryHandler(desfazer_transacao, pattern='^desfazer_'),
+        CallbackQueryHandler(confirmar_lote, pattern='^(confirmar|cancelar)_lote$')
+    ]
+    handler_lancamento_rapido_texto = MessageHandler(FILTRO_LANCAMENTO_RAPIDO, lancamento_rapido)
+    
+    # Consulta de saldo e lançamentos recorrentes (valem em qualquer estado da conversa)
+    handlers_comandos = [
+        CommandHandler("saldo", comando_saldo),
+        CommandHandler("recorrente", comando_recorrente),
+        CommandHandler("recorrentes", comando_recorrentes),
+        CallbackQueryHandler(remover_recorrente, pattern='^rem_recorrente_')
+    ]
     
     # Adicionar handler para mensagens desconhecidas
-    application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, mensagem_desconhecida))
+    handler_desconhecida = MessageHandler(filters.TEXT & ~filters.COMMAND, mensagem_desconhecida)
+    
+    instrumentar_handlers(handlers_lancamento_rapido + handlers_comandos + [conv_handler, handler_lancamento_rapido_texto, handler_desconhecida])
+    
+    # Comando de diagnóstico para administradores (não é instrumentado)
+    application.add_handler(CommandHandler("perfil", comando_perfil))
+    application.add_handlers(handlers_lancamento_rapido)
+    application.add_handlers(handlers_comandos)
+    application.add_handler(conv_handler)
+    application.add_handler(handler_lancamento_rapido_texto)
+    application.add_handler(handler_desconhecida)
+    
+    # O ConversationHandler não expõe a contagem de conversas; _conversations guarda o estado de cada chat
+    CONVERSAS_ATIVAS.set_function(lambda: len(conv_handler._conversations))
+    
+    return application
+
+# Função principal
+def main():
+    # Porta do endpoint de métricas (0 desativa)
+    porta_metricas = int(os.environ.get("PORTA_METRICAS", PORTA_METRICAS_PADRAO))
+    if porta_metricas:
+        iniciar_servidor_metricas(porta_metricas)
+    
+    # Obter o token do bot (substitua pelo seu token real)
+    TOKEN = os.environ.get("TELEGRAM_TOKEN", "7965686857:AAHyp28GLe1p5xklh-pcS-QZCByE45T90J8")
+    
+    # TELEGRAM_API_URL e DESATIVAR_LIMITE_ENVIOS são usados nos testes de carga com o servidor falso
+    api_url = os.environ.get("TELEGRAM_API_URL")
+    limitar_envios = os.environ.get("DESATIVAR_LIMITE_ENVIOS") != "1"
+    
+    # WORKERS > 1: despachante por webhook (WEBHOOK_URL é o endereço público que chega a PORTA_WEBHOOK)
+    workers = int(os.environ.get("WORKERS", 1))
+    if workers > 1:
+        webhook_url = os.environ.get("WEBHOOK_URL")
+        if not webhook_url:
+            logger.error("WEBHOOK_URL é obrigatório com WORKERS > 1")
+            return
+        despachante = Despachante(TOKEN, workers, api_url=api_url, limitar_envios=limitar_envios, porta_metricas=porta_metricas)
+        asyncio.run(despachante.executar(webhook_url, porta=int(os.environ.get("PORTA_WEBHOOK", PORTA_WEBHOOK_PADRAO))))
+        return
+    
+    application = construir_aplicacao(TOKEN, api_url=api_url, limitar_envios=limitar_envios)
     
     # Iniciar o bot
     application.run_polling()
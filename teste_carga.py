@@ -0,0 +1,417 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Teste de carga de ponta a ponta do bot.
+#
+# Sobe um servidor local que imita a Bot API do Telegram (getUpdates/setWebhook, sendMessage,
+# editMessageText, sendPhoto, sendDocument, sendMediaGroup, answerCallbackQuery), inicia o bot
+# apontando para ele e simula milhares de usuários simultâneos percorrendo /start, registro de
+# transação, relatório e gráfico. Ao final, mostra a vazão e a distribuição de latências.
+#
+# Uso:
+#   python teste_carga.py --usuarios 1000 --ciclos 3 --saida carga.json
+#   python teste_carga.py --somente-servidor --porta 8081   # para rodar o bot manualmente:
+#   TELEGRAM_TOKEN=123:FALSO TELEGRAM_API_URL=http://127.0.0.1:8081 python telegram_bot.py
+#   python teste_carga.py --usuarios 1000 --workers 4       # despachante por webhook com 4 workers
+
+import os
+import sys
+import json
+import time
+import random
+import signal
+import socket
+import asyncio
+import argparse
+import datetime
+import tempfile
+from collections import Counter, defaultdict
+from email.parser import BytesParser
+from email.policy import HTTP
+from urllib.parse import parse_qsl
+
+import httpx
+
+TOKEN_FALSO = "123456:FALSO"
+ID_BOT = 123456
+METODOS_COM_RESPOSTA = ('sendMessage', 'editMessageText', 'sendPhoto', 'sendDocument', 'sendMediaGroup')
+TIMEOUT_RESPOSTA = 60
+
+# Servidor HTTP mínimo que responde como a Bot API
+class ServidorApiFalso:
+    def __init__(self):
+        self.atualizacoes = []
+        self.proximo_update_id = 1
+        self.nova_atualizacao = asyncio.Condition()
+        self.webhook_url = None
+        self.webhook_segredo = None
+        self.bot_conectado = asyncio.Event()
+        self.respostas_por_chat = defaultdict(asyncio.Queue)
+        self.chamadas = Counter()
+        self.bytes_recebidos = 0
+        self._proximo_message_id = 1
+        self._cliente_webhook = None
+
+    async def iniciar(self, host='127.0.0.1', porta=0):
+        self._servidor = await asyncio.start_server(self._tratar_conexao, host, porta)
+        self.porta = self._servidor.sockets[0].getsockname()[1]
+        return self.porta
+
+    async def parar(self):
+        self._servidor.close()
+        if self._cliente_webhook:
+            await self._cliente_webhook.aclose()
+
+    # Conexões HTTP/1.1 com keep-alive (o httpx do bot reutiliza as conexões)
+    async def _tratar_conexao(self, reader, writer):
+        try:
+            while True:
+                linha = await reader.readline()
+                if not linha:
+                    break
+                _, caminho, _ = linha.decode('latin-1').split(' ', 2)
+
+                cabecalhos = {}
+                while (linha := await reader.readline()) not in (b'\r\n', b'\n', b''):
+                    nome, _, valor = linha.decode('latin-1').partition(':')
+                    cabecalhos[nome.strip().lower()] = valor.strip()
+
+                corpo = await reader.readexactly(int(cabecalhos.get('content-length', 0)))
+                self.bytes_recebidos += len(corpo)
+
+                metodo = caminho.rstrip('/').rsplit('/', 1)[-1].split('?')[0]
+                parametros, arquivos = self._ler_parametros(cabecalhos.get('content-type', ''), corpo)
+                resposta = json.dumps(await self._processar(metodo, parametros, arquivos)).encode('utf-8')
+
+                writer.write(
+                    b"HTTP/1.1 200 OK\r\nContent-Type: application/json\r\n"
+                    b"Content-Length: " + str(len(resposta)).encode() + b"\r\n\r\n" + resposta
+                )
+                await writer.drain()
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+    # Parâmetros podem vir como JSON, formulário ou multipart (quando há arquivos)
+    def _ler_parametros(self, tipo_conteudo, corpo):
+        if not corpo:
+            return {}, {}
+        if tipo_conteudo.startswith('application/json'):
+            return json.loads(corpo), {}
+        if tipo_conteudo.startswith('multipart/form-data'):
+            mensagem = BytesParser(policy=HTTP).parsebytes(
+                b"Content-Type: " + tipo_conteudo.encode('latin-1') + b"\r\n\r\n" + corpo
+            )
+            parametros, arquivos = {}, {}
+            for parte in mensagem.iter_parts():
+                nome = parte.get_param('name', header='content-disposition')
+                if parte.get_filename():
+                    arquivos[nome] = len(parte.get_payload(decode=True))
+                else:
+                    parametros[nome] = parte.get_payload(decode=True).decode('utf-8')
+            return parametros, arquivos
+        return dict(parse_qsl(corpo.decode('utf-8'))), {}
+
+    def _nova_mensagem(self, chat_id, **campos):
+        mensagem = {
+            'message_id': self._proximo_message_id,
+            'date': int(time.time()),
+            'chat': {'id': int(chat_id), 'type': 'private'},
+            'from': {'id': ID_BOT, 'is_bot': True, 'first_name': "Bot"}
+        }
+        self._proximo_message_id += 1
+        mensagem.update(campos)
+        return mensagem
+
+    async def _processar(self, metodo, parametros, arquivos):
+        self.chamadas[metodo] += 1
+
+        if metodo == 'getMe':
+            resultado = {'id': ID_BOT, 'is_bot': True, 'first_name': "Bot", 'username': "bot_falso"}
+        elif metodo == 'getUpdates':
+            self.bot_conectado.set()
+            resultado = await self._obter_atualizacoes(
+                int(parametros.get('offset') or 0), float(parametros.get('timeout') or 0)
+            )
+        elif metodo == 'setWebhook':
+            self.webhook_url = parametros.get('url') or None
+            self.webhook_segredo = parametros.get('secret_token')
+            if self.webhook_url:
+                self.bot_conectado.set()
+            resultado = True
+        elif metodo == 'deleteWebhook':
+            self.webhook_url = None
+            resultado = True
+        elif metodo == 'answerCallbackQuery':
+            resultado = True
+        elif metodo in METODOS_COM_RESPOSTA:
+            resultado = self._registrar_resposta(metodo, parametros, arquivos)
+        else:
+            resultado = True
+
+        return {'ok': True, 'result': resultado}
+
+    # Registra uma mensagem do bot e avisa o usuário simulado que está esperando no chat
+    def _registrar_resposta(self, metodo, parametros, arquivos):
+        chat_id = int(parametros['chat_id'])
+        teclado = json.loads(parametros['reply_markup']) if parametros.get('reply_markup') else None
+        campos = {}
+        if teclado:
+            campos['reply_markup'] = teclado
+        if metodo in ('sendMessage', 'editMessageText'):
+            campos['text'] = parametros.get('text', '')
+        if metodo == 'editMessageText':
+            campos['edit_date'] = int(time.time())
+
+        if metodo == 'sendMediaGroup':
+            resultado = [
+                self._nova_mensagem(chat_id, document={'file_id': f"arquivo{i}", 'file_unique_id': f"arquivo{i}"})
+                for i, _ in enumerate(json.loads(parametros['media']))
+            ]
+        elif metodo == 'sendPhoto':
+            resultado = self._nova_mensagem(chat_id, photo=[{'file_id': "foto", 'file_unique_id': "foto", 'width': 1, 'height': 1}], **campos)
+        elif metodo == 'sendDocument':
+            resultado = self._nova_mensagem(chat_id, document={'file_id': "arquivo", 'file_unique_id': "arquivo"}, **campos)
+        elif metodo == 'editMessageText':
+            mensagem = self._nova_mensagem(chat_id, **campos)
+            mensagem['message_id'] = int(parametros['message_id'])
+            resultado = mensagem
+        else:
+            resultado = self._nova_mensagem(chat_id, **campos)
+
+        primeira = resultado[0] if isinstance(resultado, list) else resultado
+        self.respostas_por_chat[chat_id].put_nowait((metodo, primeira['message_id'], teclado, sum(arquivos.values())))
+        return resultado
+
+    async def _obter_atualizacoes(self, offset, timeout):
+        async with self.nova_atualizacao:
+            self.atualizacoes = [u for u in self.atualizacoes if u['update_id'] >= offset]
+            if not self.atualizacoes and timeout:
+                try:
+                    await asyncio.wait_for(self.nova_atualizacao.wait(), timeout)
+                except asyncio.TimeoutError:
+                    pass
+            return self.atualizacoes[:100]
+
+    # Entrega uma atualização ao bot: via webhook, se configurado, ou pela fila do getUpdates
+    async def enviar_atualizacao(self, atualizacao):
+        atualizacao['update_id'] = self.proximo_update_id
+        self.proximo_update_id += 1
+
+        if self.webhook_url:
+            if self._cliente_webhook is None:
+                self._cliente_webhook = httpx.AsyncClient(timeout=TIMEOUT_RESPOSTA)
+            cabecalhos = {'X-Telegram-Bot-Api-Secret-Token': self.webhook_segredo} if self.webhook_segredo else {}
+            await self._cliente_webhook.post(self.webhook_url, json=atualizacao, headers=cabecalhos)
+            return
+
+        async with self.nova_atualizacao:
+            self.atualizacoes.append(atualizacao)
+            self.nova_atualizacao.notify_all()
+
+# Usuário simulado: envia mensagens/cliques e espera a resposta do bot com teclado
+class UsuarioSimulado:
+    def __init__(self, servidor, user_id, latencias):
+        self.servidor = servidor
+        self.user_id = user_id
+        self.latencias = latencias
+        self.respostas = servidor.respostas_por_chat[user_id]
+        self.message_id = None
+        self.botoes = []
+        self._usuario = {'id': user_id, 'is_bot': False, 'first_name': f"Usuário {user_id}"}
+
+    async def enviar_texto(self, passo, texto):
+        mensagem = {
+            'message_id': 0,
+            'date': int(time.time()),
+            'chat': {'id': self.user_id, 'type': 'private'},
+            'from': self._usuario,
+            'text': texto
+        }
+        if texto.startswith('/'):
+            mensagem['entities'] = [{'type': 'bot_command', 'offset': 0, 'length': len(texto.split()[0])}]
+        await self._executar(passo, {'message': mensagem})
+
+    # Clica no botão cuja callback_data é igual (ou começa com) o prefixo informado
+    async def clicar(self, passo, prefixo):
+        opcoes = [b for b in self.botoes if b == prefixo] or [b for b in self.botoes if b.startswith(prefixo)]
+        if not opcoes:
+            raise RuntimeError(f"Botão '{prefixo}' não encontrado em {self.botoes}")
+
+        await self._executar(passo, {
+            'callback_query': {
+                'id': f"{self.user_id}-{time.monotonic_ns()}",
+                'from': self._usuario,
+                'chat_instance': str(self.user_id),
+                'data': random.choice(opcoes),
+                'message': {
+                    'message_id': self.message_id,
+                    'date': int(time.time()),
+                    'chat': {'id': self.user_id, 'type': 'private'},
+                    'text': "..."
+                }
+            }
+        })
+
+    # Envia a atualização e espera até o bot responder com um teclado (fim do passo)
+    async def _executar(self, passo, atualizacao):
+        inicio = time.perf_counter()
+        await self.servidor.enviar_atualizacao(atualizacao)
+
+        while True:
+            metodo, message_id, teclado, _ = await asyncio.wait_for(self.respostas.get(), TIMEOUT_RESPOSTA)
+            if teclado:
+                break
+
+        self.latencias[passo].append((time.perf_counter() - inicio) * 1000)
+        self.message_id = message_id
+        self.botoes = [b['callback_data'] for linha in teclado['inline_keyboard'] for b in linha if 'callback_data' in b]
+
+    # Jornada completa: /start, registro de uma saída, relatório do mês e gráfico
+    async def jornada(self):
+        await self.enviar_texto('start', '/start')
+        await self.clicar('registrar_saida', 'registrar_saida')
+        await self.clicar('escolher_categoria', 'cat_')
+        await self.enviar_texto('informar_valor', f"{random.uniform(1, 500):.2f}".replace('.', ','))
+        await self.enviar_texto('informar_descricao', "Teste de carga")
+        await self.clicar('confirmar_transacao', 'confirmar_transacao')
+        await self.clicar('voltar_menu', 'voltar_menu')
+        await self.clicar('relatorios', 'relatorios')
+        await self.clicar('relatorio_mes', 'relatorio_mes')
+        await self.clicar('grafico_relatorio', 'grafico_relatorio')
+
+# Função para calcular um percentil (interpolação linear) de uma lista de valores
+def percentil(valores, p):
+    ordenados = sorted(valores)
+    posicao = (len(ordenados) - 1) * p / 100
+    inferior = int(posicao)
+    superior = min(inferior + 1, len(ordenados) - 1)
+    return ordenados[inferior] + (ordenados[superior] - ordenados[inferior]) * (posicao - inferior)
+
+def resumir_latencias(valores):
+    if not valores:
+        return None
+    return {
+        'quantidade': len(valores),
+        'p50': percentil(valores, 50),
+        'p90': percentil(valores, 90),
+        'p99': percentil(valores, 99),
+        'max': max(valores),
+        'media': sum(valores) / len(valores)
+    }
+
+async def simular_usuario(servidor, user_id, ciclos, atraso_inicial, latencias, erros):
+    await asyncio.sleep(atraso_inicial)
+    usuario = UsuarioSimulado(servidor, user_id, latencias)
+    for _ in range(ciclos):
+        try:
+            await usuario.jornada()
+        except Exception as e:
+            erros[type(e).__name__] += 1
+            return
+
+# Função para obter uma porta TCP livre
+def porta_livre():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+# Inicia o bot em outro processo, com os dados em um diretório temporário.
+# Com workers > 1, o bot sobe no modo despachante e recebe as atualizações por webhook.
+async def iniciar_bot(porta, diretorio, limitar_envios, arquivo_log, workers=1):
+    ambiente = dict(
+        os.environ,
+        TELEGRAM_TOKEN=TOKEN_FALSO,
+        TELEGRAM_API_URL=f"http://127.0.0.1:{porta}",
+        DESATIVAR_LIMITE_ENVIOS="0" if limitar_envios else "1",
+        WORKERS=str(workers)
+    )
+    if workers > 1:
+        porta_webhook = porta_livre()
+        ambiente.update(PORTA_WEBHOOK=str(porta_webhook), WEBHOOK_URL=f"http://127.0.0.1:{porta_webhook}/webhook")
+    return await asyncio.create_subprocess_exec(
+        sys.executable, os.path.join(os.path.dirname(os.path.abspath(__file__)), "telegram_bot.py"),
+        cwd=diretorio, env=ambiente,
+        stdout=asyncio.subprocess.DEVNULL, stderr=arquivo_log or asyncio.subprocess.DEVNULL
+    )
+
+async def executar_teste(args):
+    servidor = ServidorApiFalso()
+    porta = await servidor.iniciar(porta=args.porta)
+
+    if args.somente_servidor:
+        print(f"Servidor da Bot API falso em http://127.0.0.1:{porta} (token {TOKEN_FALSO})", file=sys.stderr)
+        await asyncio.Event().wait()
+
+    arquivo_log = open(args.log_bot, 'w') if args.log_bot else None
+    with tempfile.TemporaryDirectory(prefix="teste_carga_bot_") as diretorio:
+        processo = await iniciar_bot(porta, diretorio, args.limitar_envios, arquivo_log, args.workers)
+        try:
+            await asyncio.wait_for(servidor.bot_conectado.wait(), 60)
+            print(f"Bot conectado. Simulando {args.usuarios} usuários x {args.ciclos} ciclos...", file=sys.stderr)
+
+            latencias = defaultdict(list)
+            erros = Counter()
+            inicio = time.perf_counter()
+            await asyncio.gather(*(
+                simular_usuario(servidor, 1000 + i, args.ciclos, args.rampa * i / args.usuarios, latencias, erros)
+                for i in range(args.usuarios)
+            ))
+            duracao = time.perf_counter() - inicio
+        finally:
+            processo.send_signal(signal.SIGINT)
+            await processo.wait()
+            await servidor.parar()
+            if arquivo_log:
+                arquivo_log.close()
+
+    todas = [valor for valores in latencias.values() for valor in valores]
+    return {
+        'data': datetime.datetime.now().isoformat(timespec='seconds'),
+        'usuarios': args.usuarios,
+        'ciclos': args.ciclos,
+        'limitar_envios': args.limitar_envios,
+        'workers': args.workers,
+        'duracao_s': duracao,
+        'passos_concluidos': len(todas),
+        'vazao_passos_por_s': len(todas) / duracao if duracao else 0,
+        'jornadas_por_s': len(latencias.get('grafico_relatorio', [])) / duracao if duracao else 0,
+        'erros': dict(erros),
+        'latencia_ms': resumir_latencias(todas),
+        'latencia_por_passo_ms': {passo: resumir_latencias(valores) for passo, valores in latencias.items()},
+        'chamadas_api': dict(servidor.chamadas),
+        'bytes_recebidos': servidor.bytes_recebidos
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description="Teste de carga do bot com um servidor da Bot API falso")
+    parser.add_argument('--usuarios', type=int, default=100, help="Usuários simultâneos")
+    parser.add_argument('--ciclos', type=int, default=1, help="Jornadas completas por usuário")
+    parser.add_argument('--rampa', type=float, default=5.0, help="Segundos para todos os usuários começarem")
+    parser.add_argument('--porta', type=int, default=0, help="Porta do servidor falso (0 = qualquer livre)")
+    parser.add_argument('--limitar-envios', action='store_true',
+                        help="Mantém o limitador de envios do bot (por padrão é desativado para medir o bot)")
+    parser.add_argument('--somente-servidor', action='store_true',
+                        help="Apenas sobe o servidor falso, sem iniciar o bot nem gerar carga")
+    parser.add_argument('--workers', type=int, default=1,
+                        help="Processos do bot; acima de 1 usa o despachante por webhook")
+    parser.add_argument('--log-bot', help="Arquivo para o log do processo do bot")
+    parser.add_argument('--saida', help="Arquivo JSON com os resultados")
+    args = parser.parse_args()
+
+    resultado = asyncio.run(executar_teste(args))
+
+    print(f"\nDuração: {resultado['duracao_s']:.1f}s | vazão: {resultado['vazao_passos_por_s']:.1f} passos/s "
+          f"| {resultado['jornadas_por_s']:.2f} jornadas/s | erros: {resultado['erros'] or 0}")
+    print(f"{'passo':<22}{'qtd':>7}{'p50 ms':>10}{'p90 ms':>10}{'p99 ms':>10}{'max ms':>10}")
+    for passo, resumo in resultado['latencia_por_passo_ms'].items():
+        print(f"{passo:<22}{resumo['quantidade']:>7}{resumo['p50']:>10.1f}{resumo['p90']:>10.1f}"
+              f"{resumo['p99']:>10.1f}{resumo['max']:>10.1f}")
+
+    if args.saida:
+        with open(args.saida, 'w', encoding='utf-8') as f:
+            json.dump(resultado, f, ensure_ascii=False, indent=2)
+
+if __name__ == '__main__':
+    main()